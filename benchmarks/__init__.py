@@ -0,0 +1,9 @@
+''' Benchmarks of the dataprep and DRC steps on synthetic layouts. See benchmarks.run
+
+    These use the example technology in tests/tech, so they are not part of the installed package.
+'''
+import os
+
+# The same as tests/conftest.py, so the example technology can be found
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+os.environ.setdefault('KLAYOUT_HOME', os.path.join(repo_dir, 'tests'))
@@ -0,0 +1,90 @@
+''' Synthetic layouts on the layers of the example technology, at any size
+
+    Everything is laid out in rows, one row per waveguide, so that the size of the layout grows with n_waveguides.
+    Shapes are placed with a seeded random number generator, so the same arguments always give the same layout.
+'''
+from __future__ import division, print_function, absolute_import
+import math
+import random
+from lygadgets import pya
+
+from lymask.utilities import LayerSet, tech_layer_properties
+
+
+def make_layout(n_waveguides=10, n_nanowires=None, n_vias=None, n_pads=None,
+                length=500., pitch=10., margin=50., technology='lymask_example_tech', seed=0):
+    ''' Returns a pya.Layout with one top cell called TOP. Lengths are in microns.
+
+        waveguides: wavy 0.5 um paths on wg_deep, length long and pitch apart, with wide photo-only tapers on wg_deep_photo.
+            They are paths, so that paths_to_polys has work to do. Each one has a text label.
+        nanowires: 0.1 um hairpins on m2_nw that cross the waveguides. Default is one per waveguide.
+        vias: v3 squares sitting on the waveguides. Default is two per waveguide.
+        pads: 20 um squares on m5_wiring, in a column to the right, with v5 vias and a wire to the nearest waveguide.
+            Each one sits in a m5_gnd ring. Default is one for every four waveguides.
+        FLOORPLAN is the extent of all of that plus margin.
+    '''
+    if n_nanowires is None:
+        n_nanowires = n_waveguides
+    if n_vias is None:
+        n_vias = 2 * n_waveguides
+    if n_pads is None:
+        n_pads = n_waveguides // 4 + 1
+    rand = random.Random(seed)
+    layer_set = LayerSet.fromFile(tech_layer_properties(technology))
+    layout = pya.Layout()
+    layout.dbu = 0.001
+    top = layout.create_cell('TOP')
+    def shapes(layname):
+        return top.shapes(layout.layer(layer_set.get_as_LayerInfo(layname)))
+
+    # waveguides
+    wave_rows = []
+    for i_wg in range(n_waveguides):
+        y0 = i_wg * pitch
+        amplitude = rand.uniform(0.5, 0.3 * pitch)
+        period = rand.uniform(50, 150)
+        phase = rand.uniform(0, 2 * math.pi)
+        n_points = int(length / 2)
+        points = [pya.DPoint(length * i / n_points, y0 + amplitude * math.sin(2 * math.pi * length * i / n_points / period + phase))
+                  for i in range(n_points + 1)]
+        shapes('wg_deep').insert(pya.DPath(points, 0.5))
+        for x_end in [0, length]:
+            y_end = points[0].y if x_end == 0 else points[-1].y
+            shapes('wg_deep_photo').insert(pya.DBox(x_end - 5, y_end - 1.5, x_end + 5, y_end + 1.5))
+        shapes('wg_deep').insert(pya.DText('wg{}'.format(i_wg), pya.DTrans(pya.DVector(0, y0))))
+        wave_rows.append(points)
+
+    # nanowires
+    for i_nw in range(n_nanowires):
+        row = wave_rows[i_nw % n_waveguides] if n_waveguides > 0 else [pya.DPoint(length / 2, 0)]
+        on_wg = row[rand.randrange(len(row))]
+        legs = [pya.DBox(on_wg.x + dx - 0.05, on_wg.y - 3, on_wg.x + dx + 0.05, on_wg.y + 3) for dx in (-0.3, 0.3)]
+        bend = pya.DBox(on_wg.x - 0.35, on_wg.y + 3, on_wg.x + 0.35, on_wg.y + 3.1)
+        for box in legs + [bend]:
+            shapes('m2_nw').insert(box)
+
+    # vias
+    for i_via in range(n_vias):
+        row = wave_rows[i_via % n_waveguides] if n_waveguides > 0 else [pya.DPoint(length / 2, 0)]
+        on_wg = row[rand.randrange(len(row))]
+        shapes('v3').insert(pya.DBox(on_wg.x - 0.1, on_wg.y - 0.1, on_wg.x + 0.1, on_wg.y + 0.1))
+
+    # pads
+    pad_x = length + 50
+    pad_pitch = max(40, pitch * n_waveguides / max(n_pads, 1))
+    for i_pad in range(n_pads):
+        y_pad = i_pad * pad_pitch
+        pad = pya.DBox(pad_x, y_pad - 10, pad_x + 20, y_pad + 10)
+        shapes('m5_wiring').insert(pad)
+        shapes('v5').insert(pad.enlarged(-8, -8))
+        ring = pya.Region(pad.enlarged(10, 10).to_itype(layout.dbu)) - pya.Region(pad.enlarged(5, 5).to_itype(layout.dbu))
+        shapes('m5_gnd').insert(ring)
+        if n_waveguides > 0:
+            end_point = wave_rows[min(int(y_pad / pitch), n_waveguides - 1)][-1]
+            shapes('m5_wiring').insert(pya.DPath([pya.DPoint(pad_x, y_pad), pya.DPoint(end_point.x + 10, y_pad),
+                                                  pya.DPoint(end_point.x + 10, end_point.y)], 2).polygon())
+
+    floorplan = top.dbbox()
+    floorplan.enlarge(margin, margin)
+    shapes('FLOORPLAN').insert(floorplan)
+    return layout
@@ -0,0 +1,152 @@
+''' Times every dataprep and DRC step on synthetic layouts, across layout sizes, thread counts, and tiles settings
+
+    From the repository folder::
+
+        python -m benchmarks.run -o results.json
+        python -m benchmarks.run --sizes 10 100 1000 --threads 1 4 --tiles auto 4 --save-baseline baseline.json
+        python -m benchmarks.run --sizes 10 100 1000 --threads 1 4 --tiles auto 4 --baseline baseline.json
+
+    Sizes are numbers of waveguides (see layout_generator.make_layout).
+    The decks are dataprep.yml and drc.yml in this folder, with a processor step put in front.
+    With --baseline, steps that got slower are listed, and the exit code is 1.
+    Timings only compare on the same machine, so keep a baseline for each one.
+'''
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import json
+import argparse
+import platform
+import tempfile
+import yaml
+
+from benchmarks.layout_generator import make_layout
+import lymask
+from lygadgets import pya
+from lymask.invocation import _main, _drc_main
+from lymask.profiling import RunProfile
+from lymask.tiling import cpu_count
+
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+decks = dict(dataprep=os.path.join(bench_dir, 'dataprep.yml'),
+             drc=os.path.join(bench_dir, 'drc.yml'))
+technology = 'lymask_example_tech'
+
+#: A step is slower if it takes this fraction longer than the baseline...
+tolerance = 0.25
+#: ...and at least this many seconds longer, so that tiny steps don't flag on noise
+min_difference = 0.01
+
+
+def _deck_with_processor(category, thread_count, tiles, deck_dir):
+    with open(decks[category]) as fx:
+        step_list = yaml.load(fx, Loader=yaml.FullLoader)
+    step_list.insert(0, dict(processor=dict(thread_count=thread_count, tiles=tiles)))
+    ymlfile = os.path.join(deck_dir, '{}_{}_{}.yml'.format(category, thread_count, tiles))
+    with open(ymlfile, 'w') as fx:
+        yaml.dump(step_list, fx)
+    return ymlfile
+
+
+def run_benchmarks(sizes=(10, 100), threads=(1,), tiles=('auto',), categories=('dataprep', 'drc'), repeats=1):
+    ''' Returns a dict with the machine in "meta" and one entry per step in "results".
+        Each entry has category, step, size, threads, tiles, wall_time, and cpu_time.
+        The times are the fastest of the repeats.
+    '''
+    lymask.set_active_technology(technology)
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size in sizes:
+            layout_file = os.path.join(temp_dir, 'synthetic_{}.oas'.format(size))
+            make_layout(size).write(layout_file)
+            for category in categories:
+                for thread_count in threads:
+                    for tile_setting in tiles:
+                        ymlfile = _deck_with_processor(category, thread_count, tile_setting, temp_dir)
+                        fastest = dict()
+                        for _ in range(repeats):
+                            layout = pya.Layout()
+                            layout.read(layout_file)
+                            profile = RunProfile(ymlfile, layout_file, count_geometry=False)
+                            if category == 'drc':
+                                _drc_main(layout, ymlfile, profile=profile)
+                            else:
+                                _main(layout, ymlfile, profile=profile)
+                            for entry in profile.steps:
+                                if entry.step not in fastest or entry.wall_time < fastest[entry.step]['wall_time']:
+                                    fastest[entry.step] = dict(wall_time=entry.wall_time, cpu_time=entry.cpu_time)
+                        for step_name, times in fastest.items():
+                            results.append(dict(category=category, step=step_name, size=size,
+                                                threads=thread_count, tiles=tile_setting, **times))
+    meta = dict(lymask=lymask.__version__, klayout=getattr(pya, '__version__', None),
+                python=platform.python_version(), machine=platform.platform(), cpu_count=cpu_count())
+    return dict(meta=meta, results=results)
+
+
+def _result_key(entry):
+    return (entry['category'], entry['step'], entry['size'], entry['threads'], str(entry['tiles']))
+
+
+def compare(benchmark, baseline):
+    ''' Steps that got slower than in baseline: a list of (entry, baseline wall time).
+        Both are what run_benchmarks returns. Entries that are not in the baseline are skipped
+    '''
+    baseline_times = {_result_key(entry): entry['wall_time'] for entry in baseline['results']}
+    slower = []
+    for entry in benchmark['results']:
+        before = baseline_times.get(_result_key(entry))
+        if before is None:
+            continue
+        if entry['wall_time'] > before * (1 + tolerance) and entry['wall_time'] - before > min_difference:
+            slower.append((entry, before))
+    return slower
+
+
+def summary(benchmark):
+    ''' A little table, slowest steps first '''
+    lines = ['{:>10} {:>10} {:>6} {:>7} {:>5}  {}'.format('wall [s]', 'cpu [s]', 'size', 'threads', 'tiles', 'step')]
+    for entry in sorted(benchmark['results'], key=lambda e: e['wall_time'], reverse=True):
+        lines.append('{:10.3f} {:10.3f} {:>6} {:>7} {:>5}  {} ({})'.format(
+            entry['wall_time'], entry['cpu_time'], entry['size'], entry['threads'], entry['tiles'], entry['step'], entry['category']))
+    return '\n'.join(lines)
+
+
+def _tiles_arg(tiles_str):
+    return tiles_str if tiles_str == 'auto' else int(tiles_str)
+
+
+parser = argparse.ArgumentParser(prog='python -m benchmarks.run', description='Benchmark lymask steps on synthetic layouts')
+parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100], help='Numbers of waveguides')
+parser.add_argument('--threads', type=int, nargs='+', default=[1], help='Thread counts')
+parser.add_argument('--tiles', type=_tiles_arg, nargs='+', default=['auto'], help='Tiles per side, or auto')
+parser.add_argument('--category', choices=['dataprep', 'drc'], nargs='+', default=['dataprep', 'drc'])
+parser.add_argument('--repeats', type=int, default=1, help='Each time is the fastest of this many runs')
+parser.add_argument('-o', '--outfile', default=None, help='Write the results to this JSON file')
+parser.add_argument('--baseline', default=None, help='Compare with the results in this JSON file')
+parser.add_argument('--save-baseline', default=None, metavar='BASELINE', help='Write the results here, as a new baseline')
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    benchmark = run_benchmarks(args.sizes, args.threads, args.tiles, args.category, args.repeats)
+    print(summary(benchmark))
+    for filename in [args.outfile, args.save_baseline]:
+        if filename is not None:
+            with open(filename, 'w') as fx:
+                json.dump(benchmark, fx, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as fx:
+            baseline = json.load(fx)
+        slower = compare(benchmark, baseline)
+        for entry, before in slower:
+            print('Slower: {} ({}) size {}, {} threads, {} tiles: {:.3f} s, was {:.3f} s'.format(
+                entry['step'], entry['category'], entry['size'], entry['threads'], entry['tiles'], entry['wall_time'], before))
+        if len(slower) > 0:
+            return 1
+        print('No steps are slower than the baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
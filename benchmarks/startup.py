@@ -0,0 +1,71 @@
+''' Times how long the lymask command takes to get going
+
+    From the repository folder::
+
+        python -m benchmarks.startup
+
+    The points are: printing the version, printing the help, and starting the first step of a dataprep run.
+    The exit code is 1 if any of them took longer than its budget.
+'''
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+from benchmarks.layout_generator import make_layout
+
+
+technology = 'lymask_example_tech'
+
+#: Seconds allowed from starting the command line to the given point
+startup_budget = dict(version=1.0, help=1.0, first_step=5.0)
+
+
+def startup_times(size=10):
+    ''' Seconds from starting the lymask command to each point of startup_budget.
+        The dataprep run is on a synthetic layout with this many waveguides
+    '''
+    times = dict()
+    for point, args in [('version', ['--version']), ('help', ['-h'])]:
+        start = time.perf_counter()
+        subprocess.check_output(['lymask'] + args)
+        times[point] = time.perf_counter() - start
+    with tempfile.TemporaryDirectory() as temp_dir:
+        layout_file = os.path.join(temp_dir, 'synthetic_{}.oas'.format(size))
+        make_layout(size).write(layout_file)
+        start = time.perf_counter()
+        proc = subprocess.Popen(['lymask', 'dataprep', layout_file, '-o', os.path.join(temp_dir, 'out.oas'), '-t', technology],
+                                stdout=subprocess.PIPE, universal_newlines=True)
+        for line in proc.stdout:
+            if line.startswith('lymask doing'):
+                times['first_step'] = time.perf_counter() - start
+                break
+        proc.stdout.read()
+        proc.wait()
+    return times
+
+
+parser = argparse.ArgumentParser(prog='python -m benchmarks.startup', description='Time the startup of the lymask command')
+parser.add_argument('--size', type=int, default=10, help='Number of waveguides in the dataprep layout')
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    times = startup_times(args.size)
+    over_budget = False
+    for point, budget in startup_budget.items():
+        seconds = times.get(point)
+        if seconds is None:
+            print('{:>12}: never got there'.format(point))
+            over_budget = True
+            continue
+        print('{:>12}: {:.3f} s (budget {:.1f} s)'.format(point, seconds, budget))
+        over_budget = over_budget or seconds > budget
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
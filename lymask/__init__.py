@@ -1,7 +1,31 @@
 __version__ = '0.1.11'
 __lygadget_link__ = ['lygadgets', 'yaml']
 
-from lymask.utilities import active_technology, set_active_technology
-from lymask.invocation import batch_main, batch_drc_main
-from lymask.utilities import get_design_rules
-import lymask.dataprep_steps
+# Importing klayout takes most of a second, so nothing is imported until it is used.
+# That way "lymask --version" and "lymask -h" don't wait for it.
+_lazy_attributes = dict(active_technology='lymask.utilities',
+                        set_active_technology='lymask.utilities',
+                        get_design_rules='lymask.utilities',
+                        batch_main='lymask.invocation',
+                        batch_drc_main='lymask.invocation')
+
+
+def __getattr__(name):
+    import importlib
+    if name in _lazy_attributes:
+        value = getattr(importlib.import_module(_lazy_attributes[name]), name)
+    elif not name.startswith('__'):
+        try:
+            value = importlib.import_module('lymask.' + name)
+        except ModuleNotFoundError as err:
+            if err.name != 'lymask.' + name:
+                raise
+            raise AttributeError("module 'lymask' has no attribute '{}'".format(name))
+    else:
+        raise AttributeError("module 'lymask' has no attribute '{}'".format(name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_lazy_attributes.keys()))
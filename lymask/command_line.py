@@ -1,9 +1,10 @@
 ''' Command line entry points for dataprep and drc
 '''
+import os
+import glob
 import argparse
 from lymask import __version__
 import textwrap
-from lymask.invocation import batch_main, batch_drc_main
 
 top_parser = argparse.ArgumentParser(
     formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -11,10 +12,11 @@ top_parser = argparse.ArgumentParser(
         Available commands are
           dataprep: do some mask dataprep
           drc: do some design rule checking
+          worker: take tiles from remote_host processors
 
         Type "lytest <command> -h" for help on specific commands
         '''))
-top_parser.add_argument('command', type=str, choices=['dataprep', 'drc'], metavar='<command>')
+top_parser.add_argument('command', type=str, choices=['dataprep', 'drc', 'worker'], metavar='<command>')
 top_parser.add_argument('args', nargs=argparse.REMAINDER)
 top_parser.add_argument('-v', '--version', action='version', version='%(prog)s v{}'.format(__version__))
 
@@ -24,30 +26,79 @@ def cm_main():
         cm_dataprep(args.args)
     if args.command == 'drc':
         cm_drc(args.args)
+    if args.command == 'worker':
+        cm_worker(args.args)
 
 
 def add_common_args(sub_parser):
-    sub_parser.add_argument('infile', type=argparse.FileType('rb'),
-                        help='the input gds file')
+    sub_parser.add_argument('infile', nargs='+',
+                        help='the input gds file. Several files or a quoted glob run in parallel processes')
     sub_parser.add_argument('ymlspec', nargs='?', default=None,
                         help='YML file that describes the steps and parameters. Can be relative to technology')
     sub_parser.add_argument('-o', '--outfile', nargs='?', default=None,
-                        help='The output file. Dataprep default is to tack "_proc" onto the end. DRC default is to put .lyrdb on the end')
+                        help='The output file. Dataprep default is to tack "_proc" onto the end. DRC default is to put .lyrdb on the end. '
+                             'DRC results can also go to .sqlite or .db (a database with a spatial index) or .oas or .gds (marker layers). '
+                             'With several input files, this is a directory')
     sub_parser.add_argument('-t', '--technology', nargs='?', default=None,
                         help='The name of technology to use. Must be visible in installed technologies')
+    sub_parser.add_argument('--profile', default=None, metavar='report.json',
+                        help='Write timing, memory, and polygon counts of every step to this JSON file')
+    sub_parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='How many files to process at once, when there are several. Default is the number of cores')
+
+
+def split_positionals(parsed_args):
+    ''' infile takes every positional argument, so pull the ymlspec off the end if it is there.
+        It is the last one if there are several and it ends in .yml or is not a file
+    '''
+    infiles = parsed_args.infile
+    if parsed_args.ymlspec is None and len(infiles) > 1:
+        if infiles[-1].endswith('.yml') or not os.path.isfile(infiles[-1]):
+            parsed_args.ymlspec = infiles.pop()
+    for infile in infiles:
+        if not glob.has_magic(infile) and not os.path.isfile(infile):
+            raise FileNotFoundError('Input file not found: {}'.format(infile))
+    parsed_args.infile = infiles[0] if len(infiles) == 1 else infiles
+    return parsed_args
 
 
 dataprep_parser = argparse.ArgumentParser(prog='lymask dataprep' ,description="Command line mask dataprep")
 add_common_args(dataprep_parser)
+dataprep_parser.add_argument('--cache', default=None, metavar='DIR',
+                    help='Save the result of each step here. A rerun loads the steps before the first one that changed')
+dataprep_parser.add_argument('--drop-unused-layers', action='store_true',
+                    help='Only read the layers in the layer set. The others are left out of the output')
+dataprep_parser.add_argument('--masks-only', action='store_true',
+                    help='Only write the mask layers (100 to 199, and FLOORPLAN)')
+dataprep_parser.add_argument('--split-masks', action='store_true',
+                    help='Write each mask layer to its own file, named like <outfile>_<mask>.oas')
 
 def cm_dataprep(args):
-    dataprep_args = dataprep_parser.parse_args(args)
-    batch_main(dataprep_args.infile.name, ymlspec=dataprep_args.ymlspec, outfile=dataprep_args.outfile, technology=dataprep_args.technology)
+    dataprep_args = split_positionals(dataprep_parser.parse_args(args))
+    from lymask.invocation import batch_main  # after parsing, so that -h is fast
+    batch_main(dataprep_args.infile, ymlspec=dataprep_args.ymlspec, outfile=dataprep_args.outfile, technology=dataprep_args.technology,
+               profile=dataprep_args.profile, cache_dir=dataprep_args.cache, processes=dataprep_args.processes,
+               drop_unused_layers=dataprep_args.drop_unused_layers, masks_only=dataprep_args.masks_only,
+               split_masks=dataprep_args.split_masks)
 
 
 drc_parser = argparse.ArgumentParser(prog='lymask drc' ,description="Command line design rule check")
 add_common_args(drc_parser)
 
 def cm_drc(args):
-    drc_args = drc_parser.parse_args(args)
-    batch_drc_main(drc_args.infile.name, ymlspec=drc_args.ymlspec, outfile=drc_args.outfile, technology=drc_args.technology)
+    drc_args = split_positionals(drc_parser.parse_args(args))
+    from lymask.invocation import batch_drc_main
+    batch_drc_main(drc_args.infile, ymlspec=drc_args.ymlspec, outfile=drc_args.outfile, technology=drc_args.technology,
+                   profile=drc_args.profile, processes=drc_args.processes)
+
+
+worker_parser = argparse.ArgumentParser(prog='lymask worker', description="Run tiles for processors that have this machine as remote_host")
+worker_parser.add_argument('--host', default='localhost',
+                    help='Address to listen on. Use 0.0.0.0 to take tiles from other machines')
+worker_parser.add_argument('-p', '--port', type=int, default=7420,
+                    help='Port to listen on. 0 picks a free one')
+
+def cm_worker(args):
+    worker_args = worker_parser.parse_args(args)
+    from lymask.remote import serve
+    serve(worker_args.host, worker_args.port)
@@ -4,11 +4,14 @@ import os
 import importlib.util
 
 from lygadgets import pya, isGUI, message, message_loud
-from lygadgets import anyCell_to_anyCell
 from lygadgets.gui_objects import gui_view
 
 from lymask.utilities import lys, LayerSet, active_technology, func_info_to_func_and_kwargs
-from lymask.library import dbu, as_region, fast_sized, fast_smoothed, set_threads
+from lymask.mask_writer import is_mask_layer
+from lymask.phidl_session import phidl_step
+from lymask.library import (get_dbu, as_region, invalidate_regions, set_threads, set_remote_hosts, deferred, evaluate_regions,
+                            smoothed_layer, sized_layer, smoothed_regions, sized_regions, set_hierarchical, is_hierarchical,
+                            clear_layer, replace_layer)
 
 
 all_dpfunc_dict = {}
@@ -21,6 +24,89 @@ def dpStep(step_fun):
     return step_fun
 
 
+hierarchical_dpfuncs = set()
+def dpStep_hierarchical(step_fun):
+    ''' A dpStep that only changes shapes locally, so in hierarchical mode it can run once per unique cell.
+        Other steps see the layout flattened (see library.flat_regions) and put their results in the top cell
+    '''
+    hierarchical_dpfuncs.add(step_fun.__name__)
+    return dpStep(step_fun)
+
+
+#: Layers that each step reads and writes, keyed by step name. See dpLayers
+dpfunc_layers = {}
+ALL_LAYERS = 'all layers'
+def dpLayers(reads=(), writes=()):
+    ''' Declares the layers of a step, so that _main can clear layers that nothing needs anymore (see layer_liveness).
+        Put it above @dpStep.
+
+        reads and writes are each a list of layer names, ALL_LAYERS,
+        or a function that takes the kwargs of the step and returns one of those.
+        Reading means that other layers depend on it. Writing means replacing what was there.
+        If a step changes a layer based only on that same layer (flatten, precomp, adding to it), it does not need to say so:
+        when nothing needs the layer after, nothing needs it before either.
+        Steps without a declaration are taken to read every layer.
+    '''
+    def decorator(step_fun):
+        dpfunc_layers[step_fun.__name__] = (reads, writes)
+        return step_fun
+    return decorator
+
+
+def _as_list(layers):
+    return list(layers) if isinstance(layers, (list, tuple)) else [layers]
+
+
+def is_mask_name(layname):
+    ''' Names that are not in the layer set yet are taken to be masks, because mask_map makes those '''
+    try:
+        layer_info = lys.get_as_LayerInfo(layname)
+    except KeyError:
+        return True
+    return layname == 'FLOORPLAN' or is_mask_layer(layer_info)
+
+
+def _declared_layers(declared, kwargs, all_names):
+    if callable(declared):
+        declared = declared(kwargs)
+    if declared == ALL_LAYERS:
+        return set(all_names)
+    return set(declared)
+
+
+def layer_liveness(step_list, is_output=None):
+    ''' Which layers can be cleared after each step, because no later step reads them and they are not in the output.
+        is_output takes a layer name. If it is None, every layer is in the output.
+        Returns one set of names per step, plus one more first for the layers that can be cleared before the first step.
+    '''
+    steps = []
+    all_names = set(lys.keys())
+    for func_info in step_list:
+        func_name, kwargs = func_info_to_func_and_kwargs(func_info)
+        reads, writes = dpfunc_layers.get(func_name, (ALL_LAYERS, ()))
+        steps.append((reads, writes, kwargs))
+        for declared in (reads, writes):
+            if isinstance(declared, (list, tuple)):
+                all_names.update(declared)
+            elif callable(declared):
+                all_names.update(_declared_layers(declared, kwargs, ()))
+    if is_output is None:
+        live = set(all_names)
+    else:
+        live = set(name for name in all_names if is_output(name))
+    # Go backwards. A layer is live if something later reads it before replacing it
+    dead_after = []
+    for reads, writes, kwargs in reversed(steps):
+        writes = _declared_layers(writes, kwargs, all_names)
+        reads = _declared_layers(reads, kwargs, all_names)
+        # Only what this step wrote, or what was still live going in, needs to be cleared again
+        live_before = (live - writes) | reads
+        dead_after.append((all_names - live) & (live_before | writes))
+        live = live_before
+    dead_after.append(all_names - live)
+    return list(reversed(dead_after))
+
+
 def delete_dollar_duplicates(cell):
     ''' pya sometimes adds a second top cell or duplicates of other cells.
         Other layout programs and lithography tools cannot parse this easily.
@@ -45,9 +131,15 @@ def delete_dollar_duplicates(cell):
         delete_dollar_duplicates(child_cell)
 
 
+phidl_dpfuncs = set()
 def dpStep_phidl(step_fun):
     ''' phidl version, where the mutable object is a phidl.Device not a pya.Cell
         Each step must accept one argument that is Device, plus optionals, and not return
+
+        Only the layers that the step declares with dpLayers go into the Device, and only the ones it writes come back.
+        Without a declaration, every layer goes in, and the ones that changed come back.
+        During a run, consecutive phidl steps share one Device, so the layout is converted once for all of them.
+        See lymask.phidl_session
     '''
     try:
         from phidl import Device
@@ -55,11 +147,17 @@ def dpStep_phidl(step_fun):
         raise ImportError('You are probably trying to use phidl dataprep steps within a GUI. This is only supported in batch mode. Not my fault')
     @wraps(step_fun)
     def wrapper(cell, *args, **kwargs):
-        phidl_device = Device()
-        anyCell_to_anyCell(cell, phidl_device)
-        step_fun(phidl_device, *args, **kwargs)
-        anyCell_to_anyCell(phidl_device, cell)
-        delete_dollar_duplicates(cell)
+        all_names = lys.keys()
+        if step_fun.__name__ in dpfunc_layers:
+            reads, writes = dpfunc_layers[step_fun.__name__]
+            written = _declared_layers(writes, kwargs, all_names)
+            laynames = _declared_layers(reads, kwargs, all_names) | written
+        else:
+            # What it wrote is found by comparing the Device before and after
+            laynames, written = set(all_names), None
+        with phidl_step(cell, laynames, written) as phidl_device:
+            step_fun(phidl_device, *args, **kwargs)
+    phidl_dpfuncs.add(step_fun.__name__)
     all_dpfunc_dict[step_fun.__name__] = wrapper
     return wrapper
 
@@ -69,19 +167,18 @@ def dpStep_phidl(step_fun):
 #     device << pg.rectangle((10, 10))
 
 
+@dpLayers()
 @dpStep
 def add_library(cell, filename):
     ''' Imports from the filename, which is a path to a python file.
         Anything within there that is a dpStep gets added to the all_dpfunc_dict for later
     '''
-    if os.path.isfile(filename):
-        pass
-    else:
-        dataprep_relpath = os.path.join(active_technology().eff_path('dataprep'), filename)
-        if os.path.isfile(dataprep_relpath):
-            filename = os.path.realpath(dataprep_relpath)
-        else:
-            raise FileNotFoundError('lymask could not find {}'.format(filename))
+    import_library(filename)
+
+
+def import_library(filename):
+    ''' What add_library does. Returns the full path of the file (see find_library) '''
+    filename = find_library(filename)
     modulename = os.path.splitext(os.path.basename(filename))[0]
     spec = importlib.util.spec_from_file_location(modulename, filename)
     foo = importlib.util.module_from_spec(spec)
@@ -92,8 +189,21 @@ def add_library(cell, filename):
             raise ImportError('You are probably trying to use phidl/gdspy dataprep steps within a GUI. This is only supported in batch mode currently')
         else:
             raise
+    return filename
+
+
+def find_library(filename):
+    ''' Full path of an add_library file. A relative filename can be relative to the dataprep folder of the technology '''
+    if not os.path.isfile(filename):
+        dataprep_relpath = os.path.join(active_technology().eff_path('dataprep'), filename)
+        if os.path.isfile(dataprep_relpath):
+            filename = dataprep_relpath
+        else:
+            raise FileNotFoundError('lymask could not find {}'.format(filename))
+    return os.path.realpath(filename)
 
 
+@dpLayers(reads=ALL_LAYERS)
 @dpStep
 def check_floorplan(cell, fp_safe=50):
     ''' Checks for floorplan. If you didn't make one, this makes one.
@@ -103,36 +213,73 @@ def check_floorplan(cell, fp_safe=50):
         fp_box = cell.dbbox()  # this assumes that, if FLOORPLAN is present, that DRC has verified it forms the extent
         fp_box.enlarge(fp_safe, fp_safe)
         cell.shapes(lys.FLOORPLAN).insert(fp_box)
+        invalidate_regions(cell, 'FLOORPLAN')
 
 
 __warned_about_flattening = False
-@dpStep
+@dpLayers()
+@dpStep_hierarchical
 def flatten(cell):
     global __warned_about_flattening
+    if is_hierarchical():
+        message('Hierarchical mode, so not flattening')
+        return
     if isGUI() and not __warned_about_flattening:
         message_loud('Warning: The flattening step modifies the layout, so be careful about saving.')
         __warned_about_flattening = True
     cell.flatten(True)
+    invalidate_regions(cell)
 
 
-@dpStep
+@dpLayers()
+@dpStep_hierarchical
 def paths_to_polys(cell):
+    ''' Converts the paths of each layer in one go, in cell and each unique cell below it, so it can run before flatten '''
+    converted = []
     for layname in lys.keys():
         lay = lys[layname]
-        for shape in cell.each_shape(lay):
-            if shape.is_path():
-                shape.polygon = shape.simple_polygon
-
-
-@dpStep
+        for one_cell in _unique_cells(cell):
+            shapes = one_cell.shapes(lay)
+            if shapes.is_empty():
+                continue
+            path_iter = one_cell.begin_shapes_rec(lay)
+            path_iter.max_depth = 0
+            path_iter.shape_flags = pya.Shapes.SPaths
+            path_iter.enable_properties()  # paths with properties give polygons with the same properties
+            path_polys = pya.Shapes()  # a copy, because the iterator reads from the shapes that are about to be cleared
+            path_polys.insert(pya.Region(path_iter))
+            if path_polys.is_empty():
+                continue
+            shapes.clear(pya.Shapes.SPaths)
+            shapes.insert(path_polys)
+            converted.append(layname)
+    invalidate_regions(cell, converted)
+
+
+@dpLayers()
+@dpStep_hierarchical
 def erase_text_and_other_junk(cell):
+    ''' Erases the texts of each layer in one go, in cell and each unique cell below it '''
+    erased = []
     for layname in lys.keys():
         lay = lys[layname]
-        for text in cell.shapes(lay).each(pya.Shapes.STexts):
-            cell.shapes(lay).erase(text)
+        for one_cell in _unique_cells(cell):
+            shapes = one_cell.shapes(lay)
+            shape_count = shapes.size()
+            if shape_count == 0:
+                continue
+            shapes.clear(pya.Shapes.STexts)
+            if shapes.size() < shape_count:
+                erased.append(layname)
+    invalidate_regions(cell, erased)
         # zero width paths
 
 
+def _unique_cells(cell):
+    layout = cell.layout()
+    return [cell] + [layout.cell(child_index) for child_index in cell.called_cells()]
+
+
 # Some peole use this, others have already converted
 # @dpStep
 # def convert_wgs(cell):
@@ -155,103 +302,128 @@ def erase_text_and_other_junk(cell):
 #     layer_resize(cell, lys.dp_temp, -delta, layC=lys.m2_nw)
 
 
+@dpLayers()
 @dpStep
-def processor(cell, thread_count=1, tiles=2, remote_host=None):
-    if remote_host is not None:
-        message_loud('Automatic remote hosting is not yet supported')
+def processor(cell, thread_count=1, tiles='auto', remote_host=None, hierarchical=False):
+    ''' hierarchical: keep the cell hierarchy instead of flattening. See library.set_hierarchical.
+        Steps that only change shapes locally (precomp, smooth_floating, paths_to_polys, erase_text_and_other_junk)
+        then run once per unique cell. Steps that need the whole picture (sleeves, ground_plane, invert_tone)
+        put their results into the top cell.
+        remote_host: send the tiles to lymask workers at "host:port", or a list of them. See lymask.remote
+    '''
     set_threads(thread_count, tiles)
+    set_remote_hosts(remote_host)
+    set_hierarchical(hierarchical)
 
 
+@dpLayers(reads=['m2_nw', 'FLOORPLAN'], writes=['m2_nw_photo', 'm2_nw_ebeam'])
 @dpStep
 def nanowire_sleeve(cell, Delta=2.5, delta=0.2, do_photo=True):
-    Delta /= dbu
-    delta /= dbu  # new naming convention?
+    Delta /= get_dbu()
+    delta /= get_dbu()  # new naming convention?
     for dp_lay in ['m2_nw_photo', 'm2_nw_ebeam']:
-        cell.clear(lys[dp_lay])
-    nw_region = as_region(cell, 'm2_nw')
-    nw_compressed = fast_smoothed(nw_region)
-    ebeam_region = fast_sized(nw_compressed, Delta + delta) - nw_region
-    cell.shapes(lys.m2_nw_ebeam).insert(ebeam_region)
+        clear_layer(cell, dp_lay)
+    nw_region = deferred(as_region(cell, 'm2_nw'))
+    nw_compressed = deferred(smoothed_layer(cell, 'm2_nw'))
+    ebeam_region = nw_compressed.sized(Delta + delta) - nw_region
     if do_photo:
-        phoas_region = as_region(cell, 'FLOORPLAN') - fast_sized(nw_compressed, Delta - delta)
+        phoas_region = deferred(as_region(cell, 'FLOORPLAN')) - nw_compressed.sized(Delta - delta)
+        ebeam_region, phoas_region = evaluate_regions([ebeam_region, phoas_region], 'Nanowire sleeve job')
         cell.shapes(lys.m2_nw_photo).insert(phoas_region)
+    else:
+        ebeam_region = ebeam_region.evaluate('Nanowire sleeve job')
+    cell.shapes(lys.m2_nw_ebeam).insert(ebeam_region)
+    invalidate_regions(cell, ['m2_nw_photo', 'm2_nw_ebeam'])
 
 
+@dpLayers(reads=['m2_nw', 'wg_deep', 'wg_deep_photo', 'FLOORPLAN'], writes=['wg_full_photo', 'wg_full_ebeam'])
 @dpStep
 def waveguide_sleeve(cell, Delta_nw_si=2.0, Delta=2.0, delta=0.2, do_photo=True):
     ''' Does a bulk-sleeve for waveguide full, but first adds it under nanowires.
         Endcaps end where the explicit waveguide ends.
         Recognizes the wg_deep_photo layer as a photolith-only layer (lower resolution, faster EBeam write)
     '''
-    Delta_nw_si /= dbu
-    Delta /= dbu
-    delta /= dbu
+    Delta_nw_si /= get_dbu()
+    Delta /= get_dbu()
+    delta /= get_dbu()
     for dp_lay in ['wg_full_photo', 'wg_full_ebeam']:
-        cell.clear(lys[dp_lay])
+        clear_layer(cell, dp_lay)
 
     # add silicon under the nanowires
-    nw_compressed = fast_smoothed(as_region(cell, 'm2_nw'))
-    wg_explicit = as_region(cell, 'wg_deep')
-    nw_except_on_wg = nw_compressed - fast_sized(wg_explicit, Delta_nw_si)
-    wg_all = fast_sized(nw_except_on_wg, Delta_nw_si) + wg_explicit
+    nw_compressed = deferred(smoothed_layer(cell, 'm2_nw'))
+    wg_explicit = deferred(as_region(cell, 'wg_deep'))
+    nw_except_on_wg = nw_compressed - wg_explicit.sized(Delta_nw_si)
+    wg_all = nw_except_on_wg.sized(Delta_nw_si) + wg_explicit
 
     # do the bulk-sleeve
     # wg_compressed = filter_large_polygons(wg_all)
-    wg_compressed = fast_smoothed(wg_all)
-    ebeam_region = fast_sized(wg_compressed, Delta + delta) - wg_all
-    cell.shapes(lys.wg_full_ebeam).insert(ebeam_region)
+    wg_compressed = wg_all.smoothed()
+    ebeam_region = wg_compressed.sized(Delta + delta) - wg_all
     if do_photo:
-        phoas_region = as_region(cell, 'FLOORPLAN') - fast_sized(wg_compressed, Delta - delta)
+        phoas_region = deferred(as_region(cell, 'FLOORPLAN')) - wg_compressed.sized(Delta - delta)
         try:
-            phoas_region -= as_region(cell, 'wg_deep_photo')
+            phoas_region -= deferred(as_region(cell, 'wg_deep_photo'))
         except KeyError: pass
+        ebeam_region, phoas_region = evaluate_regions([ebeam_region, phoas_region], 'Waveguide sleeve job')
         cell.shapes(lys.wg_full_photo).insert(phoas_region)
+    else:
+        ebeam_region = ebeam_region.evaluate('Waveguide sleeve job')
+    cell.shapes(lys.wg_full_ebeam).insert(ebeam_region)
+    invalidate_regions(cell, ['wg_full_photo', 'wg_full_ebeam'])
 
 
+@dpLayers(reads=['wg_deep', 'wg_deep_photo', 'wg_shallow', 'm1_nwpad', 'm4_ledpad', 'm3_res', 'm5_wiring', 'm2_nw',
+                  'GP_KO', 'm5_gnd', 'FLOORPLAN'],
+          writes=['gp_photo'])
 @dpStep
 def ground_plane(cell, Delta_gp=15.0, points_per_circle=100, air_open=None):
+    dbu = get_dbu()
     Delta_gp /= dbu
-    cell.clear(lys.gp_photo)
+    clear_layer(cell, 'gp_photo')
     # Accumulate everything that we don't want to cover in metal
-    gp_exclusion_things = pya.Region()
+    gp_exclusion_things = deferred(pya.Region())
     for layname in ['wg_deep', 'wg_deep_photo', 'wg_shallow', 'm1_nwpad',
                     'm4_ledpad', 'm3_res', 'm5_wiring', 'm2_nw',
                     'GP_KO']:
         try:
-            gp_exclusion_things += fast_smoothed(as_region(cell, layname))
+            gp_exclusion_things += deferred(smoothed_layer(cell, layname))
         except KeyError: pass
     # Where ground plane is explicitly connected to wires, cut it out of the exclusion region
-    gnd_explicit = as_region(cell, 'm5_gnd')
-    gp_exclusion_tight = gp_exclusion_things - fast_sized(gnd_explicit, Delta_gp)
+    gnd_explicit = deferred(as_region(cell, 'm5_gnd'))
+    gp_exclusion_tight = gp_exclusion_things - gnd_explicit.sized(Delta_gp)
     # Inflate the buffer around excluded things and pour
-    gp_exclusion_zone = fast_sized(gp_exclusion_tight, Delta_gp)
-    gp_region = as_region(cell, 'FLOORPLAN') - gp_exclusion_zone
+    gp_exclusion_zone = gp_exclusion_tight.sized(Delta_gp)
+    gp_region = deferred(as_region(cell, 'FLOORPLAN')) - gp_exclusion_zone
 
     # Connect to ground pads
-    gp_region.merge()
-    gp_region = fast_sized(gp_region, 1 / dbu)  # kill narrow spaces
-    gp_region = fast_sized(gp_region, -2 / dbu)  # kill narrow widths
-    gp_region = fast_sized(gp_region, 1 / dbu)
+    gp_region = gp_region.sized(1 / dbu)  # kill narrow spaces
+    gp_region = gp_region.sized(-2 / dbu)  # kill narrow widths
+    gp_region = gp_region.sized(1 / dbu)
+    gp_region = gp_region.evaluate('Ground plane job')
     gp_region += as_region(cell, 'm5_gnd')
     gp_region.round_corners(Delta_gp / 5, Delta_gp / 3, points_per_circle)
     gp_region = gp_region.smoothed(.001)  # avoid some bug in pya
     gp_region.merge()
     cell.shapes(lys.gp_photo).insert(gp_region)
+    invalidate_regions(cell, 'gp_photo')
 
     # Open up to the air
     if air_open is not None:
         Delta_air = 5
         fp_safe = as_region(cell, 'FLOORPLAN')
         air_rects = fp_safe - fp_safe.sized(0, -air_open / dbu, 0)
-        air_region = air_rects & gp_region
-        air_region = fast_sized(air_region, -Delta_air / dbu)
-        air_region = fast_sized(air_region, 4 / dbu)  # kill narrow spaces
-        air_region = fast_sized(air_region, -8 / dbu)  # kill narrow widths
-        air_region = fast_sized(air_region, 4 / dbu)
+        air_region = deferred(air_rects) & deferred(gp_region)
+        air_region = air_region.sized(-Delta_air / dbu)
+        air_region = air_region.sized(4 / dbu)  # kill narrow spaces
+        air_region = air_region.sized(-8 / dbu)  # kill narrow widths
+        air_region = air_region.sized(4 / dbu)
+        air_region = air_region.evaluate('Air opening job')
         air_region.round_corners(Delta_gp / 5, Delta_gp / 3, points_per_circle)
         cell.shapes(lys.gp_v5).insert(air_region)
+        invalidate_regions(cell, 'gp_v5')
 
 
+@dpLayers(reads=lambda kwargs: ['m5_wiring', 'm5_gnd', 'gp_photo', 'wg_deep'] + _as_list(kwargs.get('keepout') or []))
 @dpStep
 def metal_pedestal(cell, pedestal_layer='wg_full_photo', offset=0, keepout=None):
     metal_region = pya.Region()
@@ -259,18 +431,19 @@ def metal_pedestal(cell, pedestal_layer='wg_full_photo', offset=0, keepout=None)
         try:
             metal_region += as_region(cell, layname)
         except: pass
-    valid_metal = metal_region - fast_sized(as_region(cell, lys.wg_deep), offset / dbu)
-    pedestal_region = fast_sized(valid_metal, offset / dbu)
+    valid_metal = deferred(metal_region) - deferred(sized_layer(cell, 'wg_deep', offset / get_dbu()))
+    pedestal_region = valid_metal.sized(offset / get_dbu())
     if keepout is not None:
-        if not isinstance(keepout, (list, tuple)):
-            keepout = [keepout]
-        for ko_layer in keepout:
-            pedestal_region -= as_region(cell, ko_layer)
+        for ko_layer in _as_list(keepout):
+            pedestal_region -= deferred(as_region(cell, ko_layer))
+    pedestal_region = pedestal_region.evaluate('Metal pedestal job')
     cell.shapes(lys[pedestal_layer]).insert(pedestal_region)
+    invalidate_regions(cell, pedestal_layer)
 
 
 has_precomped = dict()
-@dpStep
+@dpLayers()
+@dpStep_hierarchical
 def precomp(cell, **kwargs):
     '''
         Arguments are keyed by layer name with the value of bias in microns, so for example
@@ -294,15 +467,21 @@ def precomp(cell, **kwargs):
         else:
             has_precomped[cell] = set([layer_name])
 
-        # size the layer in place
-        bias = bias_um / dbu
+    # size all of the layers in one job
+    layer_names, regions, sizes = [], [], []
+    for layer_name, bias_um in kwargs.items():
         layer_region = as_region(cell, layer_name)
-        layer_region.size(bias)
-        cell.clear(lys[layer_name])
-        cell.shapes(lys[layer_name]).insert(layer_region)
+        if not layer_region.is_empty():
+            layer_names.append(layer_name)
+            regions.append(layer_region)
+            sizes.append(bias_um / get_dbu())
+    for layer_name, layer_region in zip(layer_names, sized_regions(regions, sizes, 'Precomp job')):
+        replace_layer(cell, layer_name, layer_region)
+    invalidate_regions(cell, layer_names)
 
 
-@dpStep
+@dpLayers(reads=lambda kwargs: sum([_as_list(src) for src in kwargs.values()], []))
+@dpStep_hierarchical
 def mask_map(cell, **kwargs):
     ''' lyp_file is relative to the yml file. If it is None, the same layer properties will be used.
         kwarg keys are destination layers and values are source layers, which can be a list
@@ -326,7 +505,9 @@ def mask_map(cell, **kwargs):
         if not isinstance(src_layers, list):
             src_layers = [src_layers]
         for src in src_layers:
-            cell.copy(lys[src], lys[dest_layer])
+            for one_cell in (_unique_cells(cell) if is_hierarchical() else [cell]):
+                one_cell.copy(lys[src], lys[dest_layer])
+        invalidate_regions(cell, dest_layer)
         new_mask_index += 1
 
 
@@ -348,36 +529,43 @@ def assert_valid_mask_map(mapping):
                 raise
 
 
+@dpLayers(reads=['FLOORPLAN'])
 @dpStep
 def invert_tone(cell, layer):
     inverted = as_region(cell, 'FLOORPLAN') - as_region(cell, layer)
-    cell.clear(lys[layer])
-    cell.shapes(lys[layer]).insert(inverted)
+    replace_layer(cell, layer, inverted)
+    invalidate_regions(cell, layer)
 
 
-@dpStep
+@dpLayers()
+@dpStep_hierarchical
 def smooth_floating(cell, deviation=0.005):
     ''' Removes teeny tiny edges that sometimes show up in curved edges with angles 0 or 90 plus tiny epsilon
     '''
+    layer_names, regions = [], []
     for layer_name in lys.keys():
         layer_region = as_region(cell, layer_name)
-        layer_region = fast_smoothed(layer_region, deviation)
-        cell.clear(lys[layer_name])
-        cell.shapes(lys[layer_name]).insert(layer_region)
+        if not layer_region.is_empty():
+            layer_names.append(layer_name)
+            regions.append(layer_region)
+    for layer_name, layer_region in zip(layer_names, smoothed_regions(regions, deviation, 'Smooth floating job')):
+        replace_layer(cell, layer_name, layer_region)
+    invalidate_regions(cell, layer_names)
 
 
-@dpStep
+@dpLayers(writes=lambda kwargs: [layname for layname in lys.keys() if not is_mask_name(layname)])
+@dpStep_hierarchical
 def clear_nonmask(cell):
     ''' Gets rid of everything except 101--199. That is what we have decided are mask layers.
         Same as clear_others in mask_map
     '''
-    for any_layer in lys.keys():
-        lay = lys[any_layer]
-        is_mask = (100 <= lay and lay < 200) or any_layer == 'FLOORPLAN'
-        if not is_mask:
-            cell.clear(lys[any_layer])
+    nonmask_layers = [any_layer for any_layer in lys.keys() if not is_mask_name(any_layer)]
+    for any_layer in nonmask_layers:
+        clear_layer(cell, any_layer)
+    invalidate_regions(cell, nonmask_layers)
 
 
+@dpLayers(reads=['FLOORPLAN'])
 @dpStep
 def align_corners(cell):
     ''' Puts little boxes in the corners so lithography tools all see the same
@@ -396,8 +584,8 @@ def align_corners(cell):
     for marked_layer in all_layers:
         if marked_layer.name in ['FLOORPLAN']:  # put exceptions here
             continue
-        if cell.shapes(ly.layer(marked_layer)).is_empty():
-            continue
+        if cell.begin_shapes_rec(ly.layer(marked_layer)).at_end():
+            continue  # nothing here or in the cells below
         # do some boolean here to shave off overhangs
         # layer_region = as_region(cell, marked_layer)
         # layer_region = layer_region & as_region(cell, 'FLOORPLAN')
@@ -411,23 +599,19 @@ def align_corners(cell):
                 if marked_layer.name == 'DRC_exclude' or marked_layer.layer == 91:
                     mark = mark.enlarged(1, 1)
                 cell.shapes(ly.layer(marked_layer)).insert(mark)
+    invalidate_regions(cell)
 
 
 def assert_valid_dataprep_steps(step_list):
     ''' This runs before starting calculations to make sure there aren't typos
-        that only show up after waiting for for all of the long steps
+        that only show up after waiting for for all of the long steps.
+        step_list can also be a StepPlan, which has already checked the step names and arguments.
+        This also checks the layers of mask_map, which depend on the layer set.
     '''
-    if any(func_info_to_func_and_kwargs(func_info)[0] == 'add_library' for func_info in step_list):
-        return
-
-    # check function names
-    for func_info in step_list:
-        try:
-            func = all_dpfunc_dict[func_info_to_func_and_kwargs(func_info)[0]]
-        except KeyError as err:
-            message_loud('Function "{}" not supported. Available are {}'.format(func_info[0], all_dpfunc_dict.keys()))
-            raise
-
+    from lymask.step_plan import StepPlan
+    if not isinstance(step_list, StepPlan):
+        step_list = StepPlan(step_list, 'dataprep')
+    for step in step_list.steps:
         # check mask layers
-        if func is mask_map:
-            assert_valid_mask_map(func_info_to_func_and_kwargs(func_info)[1])
+        if step.func is mask_map:
+            assert_valid_mask_map(step.kwargs)
@@ -0,0 +1,185 @@
+''' Where DRC results go
+
+    The default is a pya.ReportDatabase, saved as XML (.lyrdb). Every marker stays in memory until the end,
+    which is a problem when a bad layout has millions of them, and the marker browser can't open the file anyway.
+    The alternatives here take the markers of each rule as soon as it finishes:
+
+        * .sqlite or .db: a SQLite database with a spatial index, committed after each rule. See query_markers
+        * .oas or .gds: a layout with one marker layer per category, named after the category (with _ for spaces)
+
+    The layout is written at the end, but it holds the markers as shapes, which are much smaller than report items.
+    Both have the parts of the ReportDatabase interface that DRC steps use, so steps don't need to know which one they have.
+'''
+from __future__ import division, print_function, absolute_import
+import os
+import sqlite3
+from lygadgets import pya
+
+from lymask.mask_writer import save_options
+
+
+sqlite_extensions = ('.sqlite', '.db')
+layout_extensions = ('.oas', '.gds')
+#: Marker layers of a layout start at this layer number, in the order that categories are made
+first_marker_layer = 1000
+
+
+def open_results(outfile, description, dbu=.001):
+    ''' The place for DRC results, based on the extension of outfile. Call save(outfile) at the end '''
+    extension = os.path.splitext(outfile)[1].lower()
+    if extension in sqlite_extensions:
+        results = SqliteResults(outfile)
+    elif extension in layout_extensions:
+        results = MarkerLayoutResults(dbu)
+    else:
+        results = pya.ReportDatabase(description)
+    results.description = description
+    return results
+
+
+class _ResultId(object):
+    ''' Stands in for categories and cells of a ReportDatabase '''
+    def __init__(self, rdb_id, name):
+        self._rdb_id = rdb_id
+        self._name = name
+        self.description = ''
+
+    def rdb_id(self):
+        return self._rdb_id
+
+    def name(self):
+        return self._name
+
+
+class _Results(object):
+    def __init__(self):
+        self.description = ''
+        self.topcell = None
+        self.categories = []
+        self.cells = []
+        self._item_count = 0
+
+    def create_category(self, name):
+        category = _ResultId(len(self.categories), name)
+        self.categories.append(category)
+        return category
+
+    def create_cell(self, name):
+        rdb_cell = _ResultId(len(self.cells), name)
+        self.cells.append(rdb_cell)
+        return rdb_cell
+
+    def cell_by_qname(self, name):
+        for rdb_cell in self.cells:
+            if rdb_cell.name() == name:
+                return rdb_cell
+        return None
+
+    def num_items(self):
+        return self._item_count
+
+
+class SqliteResults(_Results):
+    ''' Markers go into a SQLite file, one transaction per rule.
+        Shapes are stored as strings in microns (DEdgePair, DPolygon, or DEdge), and their bounding boxes go in an R*Tree
+    '''
+    def __init__(self, filename):
+        super(SqliteResults, self).__init__()
+        self.filename = filename
+        if os.path.isfile(filename):
+            os.remove(filename)
+        self._connection = sqlite3.connect(filename)
+        self._connection.executescript('''
+            CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT, description TEXT);
+            CREATE TABLE cells (id INTEGER PRIMARY KEY, name TEXT);
+            CREATE TABLE markers (id INTEGER PRIMARY KEY, category INTEGER, cell INTEGER, shape TEXT);
+            CREATE VIRTUAL TABLE marker_index USING rtree(id, x1, x2, y1, y2);
+        ''')
+
+    def create_cell(self, name):
+        rdb_cell = super(SqliteResults, self).create_cell(name)
+        with self._connection:
+            self._connection.execute('INSERT INTO cells VALUES (?, ?)', (rdb_cell.rdb_id(), name))
+        return rdb_cell
+
+    def create_items(self, cell_id, category_id, trans, violations):
+        category = self.categories[category_id]
+        markers, boxes = [], []
+        for item in violations.each():
+            shape = _without_properties(item).transformed(trans)
+            box = shape.bbox()
+            self._item_count += 1
+            markers.append((self._item_count, category_id, cell_id, str(shape)))
+            boxes.append((self._item_count, box.left, box.right, box.bottom, box.top))
+        with self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO categories VALUES (?, ?, ?)',
+                                     (category_id, category.name(), category.description))
+            self._connection.executemany('INSERT INTO markers VALUES (?, ?, ?, ?)', markers)
+            self._connection.executemany('INSERT INTO marker_index VALUES (?, ?, ?, ?, ?)', boxes)
+
+    def save(self, filename=None):
+        ''' Everything is already written. This closes the file '''
+        self._connection.close()
+
+
+def _without_properties(item):
+    ''' Newer klayout iterates shapes with properties, and those print the properties too '''
+    if isinstance(item, pya.EdgePair):
+        return pya.EdgePair(item.first, item.second, item.symmetric)
+    elif isinstance(item, pya.Edge):
+        return pya.Edge(item.p1, item.p2)
+    else:
+        return pya.Polygon(item)
+
+
+def query_markers(filename, box=None, category=None):
+    ''' Markers in a SQLite result file, as a list of (category name, cell name, shape string).
+        box is a pya.DBox in microns. Markers with bounding boxes touching it are returned. None means everywhere
+    '''
+    query = ('SELECT categories.name, cells.name, markers.shape FROM markers'
+             ' JOIN categories ON categories.id = markers.category JOIN cells ON cells.id = markers.cell')
+    conditions, parameters = [], []
+    if box is not None:
+        query += ' JOIN marker_index ON marker_index.id = markers.id'
+        conditions.append('marker_index.x2 >= ? AND marker_index.x1 <= ? AND marker_index.y2 >= ? AND marker_index.y1 <= ?')
+        parameters.extend([box.left, box.right, box.bottom, box.top])
+    if category is not None:
+        conditions.append('categories.name = ?')
+        parameters.append(category)
+    if len(conditions) > 0:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    connection = sqlite3.connect(filename)
+    try:
+        return connection.execute(query + ' ORDER BY markers.id', parameters).fetchall()
+    finally:
+        connection.close()
+
+
+class MarkerLayoutResults(_Results):
+    ''' Markers go into a layout. Edge pairs become the polygons between their edges '''
+    def __init__(self, dbu=.001):
+        super(MarkerLayoutResults, self).__init__()
+        self.layout = pya.Layout()
+        self.layout.dbu = dbu
+
+    def create_category(self, name):
+        category = super(MarkerLayoutResults, self).create_category(name)
+        # OASIS names can't have spaces
+        self.layout.layer(pya.LayerInfo(first_marker_layer + category.rdb_id(), 0, name.replace(' ', '_')))
+        return category
+
+    def create_cell(self, name):
+        self.layout.create_cell(name)
+        return super(MarkerLayoutResults, self).create_cell(name)
+
+    def create_items(self, cell_id, category_id, trans, violations):
+        ''' trans is ignored, because the layout has the same database unit as the violations '''
+        marker_cell = self.layout.cell(self.cells[cell_id].name())
+        marker_layer = self.layout.find_layer(first_marker_layer + category_id, 0)
+        if isinstance(violations, pya.EdgePairs):
+            violations = violations.polygons()
+        marker_cell.shapes(marker_layer).insert(violations)
+        self._item_count += violations.count()
+
+    def save(self, filename):
+        self.layout.write(filename, save_options(filename))
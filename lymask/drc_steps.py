@@ -4,7 +4,8 @@ from lygadgets import pya, isGUI, message, message_loud
 from lygadgets.gui_objects import gui_view
 
 from lymask.utilities import lys, LayerSet
-from lymask.library import dbu, as_region, fast_sized, fast_smoothed, set_threads, rdb_create, fast_width, fast_space, fast_separation, turbo, Euclidian
+from lymask.library import get_dbu, as_region, invalidate_regions, fast_sized, fast_smoothed, set_threads, set_remote_hosts, set_hierarchical, is_hierarchical, \
+                           rdb_create, fast_width, fast_space, fast_separation, turbo, Euclidian, replace_layer
 
 
 all_drcfunc_dict = {}
@@ -17,14 +18,27 @@ def drcStep(step_fun):
     return step_fun
 
 
+readonly_drcfuncs = set()
+def drcStep_readonly(step_fun):
+    ''' A drcStep that promises not to change the layout. It only reads layers and writes to the rdb.
+        When multithreaded, consecutive readonly steps have their checks batched together by _drc_main
+    '''
+    readonly_drcfuncs.add(step_fun.__name__)
+    return drcStep(step_fun)
+
+
 __warned_about_flattening = False
 @drcStep
 def flatten(cell, rdb):
     global __warned_about_flattening
+    if is_hierarchical():
+        message('Hierarchical mode, so not flattening')
+        return
     if isGUI() and not __warned_about_flattening:
         message_loud('Warning: The flattening step modifies the layout, so be careful about saving.')
         __warned_about_flattening = True
     cell.flatten(True)
+    invalidate_regions(cell)
 
 @drcStep
 def make_rdbcells(cell, rdb):
@@ -33,10 +47,13 @@ def make_rdbcells(cell, rdb):
 
 
 @drcStep
-def processor(cell, rdb, thread_count=1, tiles=2, remote_host=None):
-    if remote_host is not None:
-        message_loud('Automatic remote hosting is not yet supported')
+def processor(cell, rdb, thread_count=1, tiles='auto', remote_host=None, hierarchical=False):
+    ''' hierarchical: check each unique cell once instead of flattening. See library.set_hierarchical
+        remote_host: send the tiles to lymask workers at "host:port", or a list of them. See lymask.remote
+    '''
     set_threads(thread_count, tiles=tiles)
+    set_remote_hosts(remote_host)
+    set_hierarchical(hierarchical)
 
 
 @drcStep
@@ -52,13 +69,13 @@ def drcX(cell, rdb, on_input=[], on_output=[], none=None):
     for layer in on_input:
         pre_exclude = as_region(cell, layer)
         post_exclude = pre_exclude - as_region(cell, 'DRC_exclude')
-        cell.clear(lys[layer])
-        cell.shapes(lys[layer]).insert(post_exclude)
+        replace_layer(cell, layer, post_exclude)
+        invalidate_regions(cell, layer)
     for layer in on_output:
         pass  # good job you picked the default
 
 
-@drcStep
+@drcStep_readonly
 def width(cell, rdb, layer, value, angle=90, min_projection=0):
     rdb_category = rdb.create_category('{}_Width'.format(layer))
     rdb_category.description = '{} [{:1.3f} um] - Minimum feature width violation'.format(layer, value)
@@ -66,14 +83,14 @@ def width(cell, rdb, layer, value, angle=90, min_projection=0):
 
     # do it
     polys = as_region(cell, layer)
-    violations = fast_width(polys, value / dbu, angle, min_projection / dbu)
+    violations = fast_width(polys, value / get_dbu(), angle, min_projection / get_dbu())
     # violations = polys.width_check(value / dbu, False, Euclidian, angle, None, None)
     # violations = turbo(polys, 'width_check', [value / dbu, False, Euclidian, angle, None, None],
     #                    tile_border=1.1*value, job_name='{}_Width'.format(layer))
     rdb_create(rdb, cell, rdb_category, violations)
 
 
-@drcStep
+@drcStep_readonly
 def space(cell, rdb, layer, value, angle=90, min_projection=0):
     rdb_category = rdb.create_category('{}_Space'.format(layer))
     rdb_category.description = '{} [{:1.3f} um] - Minimum feature spacing violation'.format(layer, value)
@@ -81,13 +98,13 @@ def space(cell, rdb, layer, value, angle=90, min_projection=0):
 
     # do it
     polys = as_region(cell, layer)
-    violations = fast_space(polys, value / dbu, angle, min_projection / dbu)
+    violations = fast_space(polys, value / get_dbu(), angle, min_projection / get_dbu())
     # violations = turbo(polys, 'space_check', [value / dbu, False, Euclidian, angle, None, None],
     #                    tile_border=1.1*value, job_name='{}_Space'.format(layer))
     rdb_create(rdb, cell, rdb_category, violations)
 
 
-@drcStep
+@drcStep_readonly
 def inclusion(cell, rdb, inner, outer, include):
     rdb_category = rdb.create_category('{} in {}'.format(inner, outer))
     rdb_category.description = '{} in {} [{:1.3f} um] - Minimum inclusion violation'.format(inner, outer, include)
@@ -95,14 +112,14 @@ def inclusion(cell, rdb, inner, outer, include):
     # do it
     rin = as_region(cell, inner)
     rout = as_region(cell, outer)
-    small_rout = fast_sized(rout, -include / dbu)
+    small_rout = fast_sized(rout, -include / get_dbu())
     # Note: this could be parallelized, but it is easier I think than sizing
     violations = rin - small_rout
 
     rdb_create(rdb, cell, rdb_category, violations)
 
 
-@drcStep
+@drcStep_readonly
 def exclusion(cell, rdb, lay1, lay2, exclude):
     rdb_category = rdb.create_category('{} from {}'.format(lay1, lay2))
     rdb_category.description = '{} from {} [{:1.3f} um] - Minimum exclusion violation'.format(lay1, lay2, exclude)
@@ -111,7 +128,7 @@ def exclusion(cell, rdb, lay1, lay2, exclude):
     r1 = as_region(cell, lay1)
     r2 = as_region(cell, lay2)
     # r1.separation_check(r2, exclude / dbu)
-    too_close = fast_separation(r1, r2, exclude / dbu)
+    too_close = fast_separation(r1, r2, exclude / get_dbu())
     # This could be parallelized
     overlaps = r1 & r2
 
@@ -123,10 +140,5 @@ def assert_valid_drc_steps(step_list):
     ''' This runs before starting calculations to make sure there aren't typos
         that only show up after waiting for for all of the long steps
     '''
-    # check function names
-    for func_info in step_list:
-        try:
-            func = all_drcfunc_dict[func_info[0]]
-        except KeyError as err:
-            message_loud('Function "{}" not supported. Available are {}'.format(func_info[0], all_drcfunc_dict.keys()))
-            raise
+    from lymask.step_plan import StepPlan
+    StepPlan(step_list, 'drc')
@@ -3,60 +3,174 @@
 '''
 from __future__ import division, print_function, absolute_import
 import os
-import yaml
+import glob
+import json
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from lygadgets import pya, message, message_loud, Technology
 
 from lygadgets.gui_objects import gui_view, gui_active_layout, gui_window, gui_active_technology
 from lymask.utilities import active_technology, set_active_technology, \
                              tech_layer_properties, \
-                             lys, reload_lys, func_info_to_func_and_kwargs
-from lymask.dataprep_steps import all_dpfunc_dict, assert_valid_dataprep_steps
-from lymask.drc_steps import all_drcfunc_dict, assert_valid_drc_steps
+                             lys, layer_context, reload_lys, objview
+from lymask.dataprep_steps import assert_valid_dataprep_steps, layer_liveness, is_mask_name, hierarchical_dpfuncs, phidl_dpfuncs
+from lymask.drc_steps import all_drcfunc_dict, readonly_drcfuncs, assert_valid_drc_steps
+from lymask.library import invalidate_regions, batched_rules, layer_versions, flat_regions, run_settings, region_cache
+from lymask.profiling import RunProfile, record_step
+from lymask.step_cache import StepCache
+from lymask.tiling import cpu_count
+from lymask.mask_writer import write_layout, write_split_masks
+from lymask.phidl_session import phidl_sessions, finish_phidl_sessions, forget_phidl_layers
+from lymask.drc_results import open_results
+from lymask.step_plan import compile_plan
 
 
-def _main(layout, ymlfile, tech_obj=None):
-    with open(ymlfile) as fx:
-        step_list = yaml.load(fx, Loader=yaml.FullLoader)
+def _main(layout, ymlfile, tech_obj=None, profile=None, step_cache=None, is_output=None):
+    ''' profile is a RunProfile, which gets a record for every step on every top cell.
+        step_cache is a StepCache. Steps that it has results for are loaded instead of run,
+        up to the first one that it does not have.
+        is_output takes a layer name and says if it will be written out. None means every layer is.
+        Layers are cleared as soon as no later step needs them (see layer_liveness).
+        lys is in a layer_context of layout while the steps run, so other threads can work on other layouts.
+        Settings from the processor step only last until the end (see run_settings).
+    '''
+    with layer_context(layout), run_settings(), region_cache(layout):
+        return _dataprep_steps(layout, ymlfile, tech_obj, profile, step_cache, is_output)
+
+
+def _dataprep_steps(layout, ymlfile, tech_obj=None, profile=None, step_cache=None, is_output=None):
+    plan = compile_plan(ymlfile, 'dataprep')
     reload_lys(tech_obj, dataprep=True)
-    assert_valid_dataprep_steps(step_list)
-    for func_info in step_list:
-        func_name, kwargs = func_info_to_func_and_kwargs(func_info)
+    assert_valid_dataprep_steps(plan)
+    dead_layers = layer_liveness(plan.step_list, is_output)
+    _clear_dead_layers(layout, dead_layers[0])
+    with phidl_sessions(layout):
+        _run_steps(layout, plan, profile, step_cache, dead_layers)
+    return layout
+
+
+def _run_steps(layout, plan, profile, step_cache, dead_layers):
+    ''' Consecutive phidl steps share their phidl Devices. Those go back into the layout before any other step '''
+    resuming = step_cache is not None
+    for i_step, step in enumerate(plan.steps):
+        func_name, kwargs, func = step.name, step.kwargs, step.func
+        if step_cache is not None:
+            step_key = step_cache.step_key(func_name, kwargs, func)
+            if resuming:
+                record = step_cache.lookup(step_key)
+                resuming = record is not None
+                if resuming and record['kind'] != 'none':
+                    message('lymask loading {} from cache: {}'.format(func_name, kwargs))
+                    step_cache.restore(layout, record, step_key)
+                    _clear_dead_layers(layout, dead_layers[i_step + 1])
+                    continue
+            versions_before = layer_versions()
+        if func_name not in phidl_dpfuncs:
+            finish_phidl_sessions(layout)
         message('lymask doing {}: {}'.format(func_name, kwargs))
-        func = all_dpfunc_dict[func_name]
         for TOP_ind in layout.each_top_cell():
             # call it
             try:
-                func(layout.cell(TOP_ind), **kwargs)
+                with record_step(profile, func_name, kwargs, layout.cell(TOP_ind)), \
+                        flat_regions(func_name not in hierarchical_dpfuncs):
+                    func(layout.cell(TOP_ind), **kwargs)
             except Exception as err:
                 message_loud(str(err))
                 raise
-    return layout
+            if not func.__module__.startswith('lymask.'):
+                # Steps from add_library don't know about the region cache
+                invalidate_regions(layout.cell(TOP_ind))
+        if step_cache is not None:
+            finish_phidl_sessions(layout)  # the cache saves the layout itself
+            step_cache.store(layout, step_key, func_name, versions_before)
+        _clear_dead_layers(layout, dead_layers[i_step + 1])
+
+
+def _clear_dead_layers(layout, laynames):
+    ''' Frees layers in every cell. This does not make new layers for names that are not there '''
+    forget_phidl_layers(layout, laynames)
+    for layname in laynames:
+        try:
+            pya_layer = layout.find_layer(lys.get_as_LayerInfo(layname))
+        except KeyError:
+            continue
+        if pya_layer is None:
+            continue
+        layout.clear_layer(pya_layer)
+        for TOP_ind in layout.each_top_cell():
+            invalidate_regions(layout.cell(TOP_ind), layname)
 
 
-def _drc_main(layout, ymlfile, tech_obj=None):
-    with open(ymlfile) as fx:
-        step_list = yaml.load(fx, Loader=yaml.FullLoader)
-    if func_info_to_func_and_kwargs(step_list[0])[0] != 'make_rdbcells':
-        step_list.insert(0, 'make_rdbcells')
+def _drc_main(layout, ymlfile, tech_obj=None, profile=None, rdb=None):
+    ''' rdb is where the results go: a pya.ReportDatabase, or something from lymask.drc_results.
+        If it is None, a new ReportDatabase is made. Either way, it is returned
+    '''
+    with layer_context(layout), run_settings(), region_cache(layout):
+        return _drc_steps(layout, ymlfile, tech_obj, profile, rdb)
+
+
+def _drc_steps(layout, ymlfile, tech_obj=None, profile=None, rdb=None):
+    plan = compile_plan(ymlfile, 'drc')
     reload_lys(tech_obj, dataprep=True)
-    # assert_valid_drc_steps(step_list)
 
-    rdb = pya.ReportDatabase('DRC: {}'.format(os.path.basename(ymlfile)))
-    rdb.description = 'DRC: {}'.format(os.path.basename(ymlfile))
+    if rdb is None:
+        rdb = pya.ReportDatabase(_drc_description(ymlfile))
+        rdb.description = _drc_description(ymlfile)
 
-    for func_info in step_list:
-        func_name, kwargs = func_info_to_func_and_kwargs(func_info)
-        message('lymask doing {}: {}'.format(func_name, kwargs))
-        func = all_drcfunc_dict[func_name]
+    for stage in _drc_stages(plan.steps):
         for TOP_ind in layout.each_top_cell():
             try:
-                func(layout.cell(TOP_ind), rdb, **kwargs)
+                _drc_stage(layout.cell(TOP_ind), rdb, stage, profile)
             except Exception as err:
                 message_loud(str(err))
                 raise
     return rdb
 
 
+def _drc_stage(cell, rdb, stage, profile=None):
+    ''' When the checks of the stage are batched, they all run after its last step.
+        The profile then gets a batched_rules entry with the time of that,
+        and each step gets the markers that its checks made once the batch ran.
+    '''
+    marker_count = [None]
+    def count_markers(entry):
+        entry.markers += rdb.num_items() - marker_count[0]
+        marker_count[0] = rdb.num_items()
+
+    with batched_rules('lymask DRC rules') as batch:
+        for func_name, kwargs in stage:
+            message('lymask doing {}: {}'.format(func_name, kwargs))
+            func = all_drcfunc_dict[func_name]
+            with record_step(profile, func_name, kwargs, cell, rdb=rdb) as entry:
+                func(cell, rdb, **kwargs)
+            if batch is not None and entry is not None:
+                batch.defer(count_markers, entry)
+        if batch is not None and profile is not None:
+            marker_count[0] = rdb.num_items()
+            with record_step(profile, 'batched_rules', dict(steps=[func_name for func_name, _ in stage]), cell):
+                batch.execute('lymask DRC rules')
+
+
+def _drc_description(ymlfile):
+    return 'DRC: {}'.format(os.path.basename(ymlfile))
+
+
+def _drc_stages(steps):
+    ''' Groups consecutive readonly steps, so their checks can run at the same time.
+        Every other step is a barrier and gets a stage to itself.
+        steps are the steps of a StepPlan. Each stage is a list of (name, kwargs)
+    '''
+    stages = []
+    for step in steps:
+        func_name, kwargs = step.name, step.kwargs
+        if func_name in readonly_drcfuncs and len(stages) > 0 and stages[-1][-1][0] in readonly_drcfuncs:
+            stages[-1].append((func_name, kwargs))
+        else:
+            stages.append([(func_name, kwargs)])
+    return stages
+
+
 def gui_main(ymlfile=None):
     layout = gui_active_layout()
     lys.active_layout = layout
@@ -86,39 +200,251 @@ def gui_drc_main(ymlfile=None):
     gui_window().menu().action('tools_menu.browse_markers').trigger()
 
 
-def batch_main(infile, ymlspec=None, technology=None, outfile=None):
-    # covers everything that is not GUI
+def batch_main(infile, ymlspec=None, technology=None, outfile=None, profile=None, cache_dir=None, processes=None,
+               drop_unused_layers=False, masks_only=False, split_masks=False):
+    ''' covers everything that is not GUI
+
+        If profile is given, a RunProfile is returned with timing, memory, and geometry counts of every step.
+        If profile is a filename, that report is also saved there as JSON.
+
+        If cache_dir is given, the results of each step are saved there. Running again with the same
+        input file and the first N steps unchanged loads those N steps instead of running them (see lymask.step_cache).
+
+        infile can also be a list of files or a glob pattern. See batch_many for what happens then.
+
+        Every layer of the input is written to the output, including the ones that no step uses.
+        With drop_unused_layers, only the layers in the layer set are read, so the rest are left out of the output.
+        masks_only writes only the mask layers (100 to 199, and FLOORPLAN).
+        split_masks writes each mask to its own file, named after outfile and the mask (see lymask.mask_writer).
+    '''
+    file_options = dict(cache_dir=cache_dir, drop_unused_layers=drop_unused_layers,
+                        masks_only=masks_only, split_masks=split_masks)
+    infiles = _expand_infiles(infile)
+    if infiles is not None:
+        return batch_many(infiles, ymlspec, technology, outfile, profile=profile, category='dataprep',
+                          processes=processes, **file_options)
+    ymlfile = resolve_ymlspec(ymlspec, technology, category='dataprep')  # this also sets the technology
+    run_profile = _dataprep_file(infile, ymlfile, active_technology(), outfile, profile, **file_options)
+    return _finish_profile(profile, run_profile)
+
+
+def _dataprep_file(infile, ymlfile, tech_obj, outfile=None, profile=None, cache_dir=None, drop_unused_layers=False,
+                   masks_only=False, split_masks=False):
     if outfile is None:
         outfile = infile[:-4] + '_proc.oas'
     # Load it
-    layout = pya.Layout()
-    layout.read(infile)
+    layer_infos = _deck_layers(ymlfile, tech_obj, 'dataprep') if drop_unused_layers else None
+    layout = _read_layout(infile, layer_infos)
     lys.active_layout = layout
-    ymlfile = resolve_ymlspec(ymlspec, technology, category='dataprep')  # this also sets the technology
-    tech_obj = active_technology()
+    run_profile = _new_profile(profile, ymlfile, infile)
+    step_cache = None if cache_dir is None else StepCache(cache_dir, infile, tech_obj.name, layer_infos)
     # Process it
-    processed = _main(layout, ymlfile=ymlfile, tech_obj=tech_obj)
+    is_output = is_mask_name if masks_only or split_masks else None
+    processed = _main(layout, ymlfile=ymlfile, tech_obj=tech_obj, profile=run_profile, step_cache=step_cache,
+                      is_output=is_output)
     # Write it
-    processed.write(outfile)
+    if split_masks:
+        write_split_masks(processed, outfile)
+    else:
+        write_layout(processed, outfile, masks_only)
+    return run_profile
+
+
+def batch_drc_main(infile, ymlspec=None, technology=None, outfile=None, profile=None, processes=None):
+    ''' covers everything that is not GUI
+
+        profile works the same as in batch_main, and so does infile
+
+        The extension of outfile picks where the results go (see lymask.drc_results).
+        .lyrdb (the default) is a report database for the marker browser. For lots of markers,
+        .sqlite is written rule by rule, and .oas keeps the markers as shapes instead of report items.
+    '''
+    infiles = _expand_infiles(infile)
+    if infiles is not None:
+        return batch_many(infiles, ymlspec, technology, outfile, profile=profile, category='drc', processes=processes)
+    ymlfile = resolve_ymlspec(ymlspec, technology, category='drc')  # this also sets the technology
+    rdb, run_profile = _drc_file(infile, ymlfile, active_technology(), outfile, profile)
+    return _finish_profile(profile, run_profile)
 
 
-def batch_drc_main(infile, ymlspec=None, technology=None, outfile=None):
-    # covers everything that is not GUI
+def _drc_file(infile, ymlfile, tech_obj, outfile=None, profile=None):
     if outfile is None:
         outfile = infile[:-4] + '.lyrdb'
-    # Load it
-    layout = pya.Layout()
-    layout.read(infile)
+    # Load it. Only the report is written, so the layers that no step uses can be skipped
+    layout = _read_layout(infile, _deck_layers(ymlfile, tech_obj, 'drc'))
     lys.active_layout = layout
-    ymlfile = resolve_ymlspec(ymlspec, technology, category='drc')  # this also sets the technology
-    tech_obj = active_technology()
-    # Process it
-    rdb = _drc_main(layout, ymlfile=ymlfile, tech_obj=tech_obj)
+    run_profile = _new_profile(profile, ymlfile, infile)
+    # Process it. Depending on outfile, results might be written as each rule finishes
+    rdb = open_results(outfile, _drc_description(ymlfile), layout.dbu)
+    rdb = _drc_main(layout, ymlfile=ymlfile, tech_obj=tech_obj, profile=run_profile, rdb=rdb)
     # Write it
     rdb.save(outfile)
     # Brief report
     message('DRC violations:', rdb.num_items())
     message('Full report:', outfile)
+    return rdb, run_profile
+
+
+def _read_layout(infile, layer_infos=None):
+    ''' layer_infos are the only layers that get read. None reads them all '''
+    layout = pya.Layout()
+    if layer_infos is None:
+        layout.read(infile)
+    else:
+        layer_map = pya.LayerMap()
+        for i_layer, layer_info in enumerate(layer_infos):
+            layer_map.map(pya.LayerInfo(layer_info.layer, layer_info.datatype), i_layer)
+        load_options = pya.LoadLayoutOptions()
+        load_options.layer_map = layer_map
+        load_options.create_other_layers = False
+        layout.read(infile, load_options)
+    return layout
+
+
+def _deck_layers(ymlfile, tech_obj, category):
+    ''' The layers that the steps of the deck can touch, as a sorted list of LayerInfo.
+        None means it could be any of them, which is the case for steps from add_library.
+
+        Dataprep steps look up layers by name, and some iterate over the whole layer set,
+        so that is every layer in the layer set.
+        DRC steps only see the layers named in their arguments, and DRC_exclude.
+    '''
+    plan = compile_plan(ymlfile, category)
+    reload_lys(tech_obj, dataprep=True)
+    layer_names = set()
+    for step in plan.steps:
+        if not step.func.__module__.startswith('lymask.'):
+            return None
+        layer_names.update(maybe_layer for maybe_layer in step.layers if maybe_layer in lys.keys())
+    if category == 'dataprep':
+        layer_names = set(lys.keys())
+    elif 'DRC_exclude' in lys.keys():
+        layer_names.add('DRC_exclude')
+    layer_infos = set()
+    for layer_name in layer_names:
+        layer_info = lys.get_as_LayerInfo(layer_name)
+        layer_infos.add((layer_info.layer, layer_info.datatype))
+    return [pya.LayerInfo(layer, datatype) for layer, datatype in sorted(layer_infos)]
+
+
+def _expand_infiles(infile):
+    ''' None if infile is just one file, otherwise the list of files '''
+    if isinstance(infile, (list, tuple)):
+        return list(infile)
+    if glob.has_magic(infile):
+        infiles = sorted(glob.glob(infile))
+        if len(infiles) == 0:
+            raise FileNotFoundError('No files match {}'.format(infile))
+        return infiles
+    return None
+
+
+def batch_many(infiles, ymlspec=None, technology=None, outdir=None, profile=None, category='dataprep',
+               processes=None, **file_options):
+    ''' Runs batch_main (or batch_drc_main if category is 'drc') on every one of infiles with a pool of processes.
+        file_options are the other arguments of batch_main, such as cache_dir.
+        Each process finds the technology and the YAML deck once and then takes files until they run out.
+        processes defaults to the number of cores. If the deck has a processor step with more than one thread,
+        you probably want fewer processes.
+
+        Outputs are named like they are for one file. If outdir is given, they go there instead of next to the inputs.
+        If profile is a filename, all of the RunProfiles are saved there together.
+
+        One file failing does not stop the others. At the end, there is a summary of all of them,
+        then a RuntimeError if any failed. Returns a list of one objview per input, in order, with
+        infile, outfile, wall_time, markers (DRC only), error, and profile.
+    '''
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+    jobs = []
+    for infile in infiles:
+        if outdir is None:
+            outfile = None
+        else:
+            outfile = os.path.join(outdir, os.path.basename(_default_outfile(infile, category)))
+        jobs.append((infile, outfile, bool(profile), file_options))
+    processes = min(processes or cpu_count(), len(jobs))
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(ymlspec, technology, category)) as executor:
+        results = list(executor.map(_run_worker, jobs))
+
+    message(_many_summary(results, category))
+    if isinstance(profile, str):
+        with open(profile, 'w') as fx:
+            json.dump([result.profile.to_dict() for result in results if result.profile is not None],
+                      fx, indent=2, default=str)
+        message('Profile report:', profile)
+    failed = [result.infile for result in results if result.error is not None]
+    if len(failed) > 0:
+        raise RuntimeError('{} of {} inputs failed: {}'.format(len(failed), len(results), ', '.join(failed)))
+    return results
+
+
+def _default_outfile(infile, category):
+    if category == 'drc':
+        return infile[:-4] + '.lyrdb'
+    else:
+        return infile[:-4] + '_proc.oas'
+
+
+#: What a pool worker found at startup: (category, ymlfile, tech_obj)
+_worker_setup = None
+
+
+def _init_worker(ymlspec, technology, category):
+    global _worker_setup
+    ymlfile = resolve_ymlspec(ymlspec, technology, category=category)
+    compile_plan(ymlfile, category)
+    _worker_setup = (category, ymlfile, active_technology())
+
+
+def _run_worker(job):
+    infile, outfile, profile, file_options = job
+    category, ymlfile, tech_obj = _worker_setup
+    result = objview(infile=infile, outfile=outfile or _default_outfile(infile, category),
+                     markers=None, error=None, profile=None)
+    start = time.perf_counter()
+    try:
+        if category == 'drc':
+            rdb, result.profile = _drc_file(infile, ymlfile, tech_obj, outfile, profile)
+            result.markers = rdb.num_items()
+        else:
+            result.profile = _dataprep_file(infile, ymlfile, tech_obj, outfile, profile, **file_options)
+    except Exception:
+        result.error = traceback.format_exc()
+        message_loud('{} failed:\n{}'.format(infile, result.error))
+    result.wall_time = time.perf_counter() - start
+    return result
+
+
+def _many_summary(results, category):
+    lines = ['{:>10} {:>10}  {}'.format('wall [s]', 'markers' if category == 'drc' else '', 'file')]
+    for result in results:
+        if result.error is not None:
+            status = 'FAILED'
+        elif category == 'drc':
+            status = str(result.markers)
+        else:
+            status = ''
+        lines.append('{:10.3f} {:>10}  {}'.format(result.wall_time, status, result.infile))
+    lines.append('{:10.3f} {:>10}  total of {} files'.format(sum(result.wall_time for result in results), '', len(results)))
+    return '\n'.join(lines)
+
+
+def _new_profile(profile, ymlfile, infile):
+    if not profile:
+        return None
+    return RunProfile(ymlfile=ymlfile, infile=infile)
+
+
+def _finish_profile(profile, run_profile):
+    if run_profile is None:
+        return None
+    message(run_profile.summary())
+    if isinstance(profile, str):
+        run_profile.save(profile)
+        message('Profile report:', profile)
+    return run_profile
 
 
 def resolve_ymlspec(ymlspec=None, technology=None, category='dataprep'):
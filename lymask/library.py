@@ -3,13 +3,36 @@
 '''
 from __future__ import division, print_function, absolute_import
 from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict
+import os
+import re
+import sys
+import importlib
+import importlib.util
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
 from lymask.utilities import active_technology, lys
+from lymask.tiling import plan_tiles, cpu_count, tile_grid, TileInputs
+from lymask.remote import RemoteTilingProcessor, parse_hosts, _layout_to_bytes, _layout_from_bytes, _layer_region
 from lygadgets import pya, message, message_loud
 
-try:
-    dbu = active_technology().dbu
-except AttributeError:
-    dbu = .001
+def get_dbu():
+    ''' Database unit of the active technology, in microns. It is looked up when needed, not at import,
+        so it follows set_active_technology, and importing does not load the technologies
+    '''
+    try:
+        return active_technology().dbu
+    except AttributeError:
+        return .001
+
+
+def __getattr__(name):
+    # dbu used to be a module constant
+    if name == 'dbu':
+        return get_dbu()
+    raise AttributeError("module 'lymask.library' has no attribute '{}'".format(name))
 
 
 # Metrics enum was added in v0.27
@@ -21,10 +44,59 @@ except AttributeError:
     Projection = pya.Region.Metrics.Projection
 
 
+#: Merged layer regions and (shape count, deep) they were built from, keyed by (weak reference to layout, cell, layer).
+#: A layout that is gone does not match a new one that got its id
+_region_cache = dict()
+#: Layouts that as_region caches regions of. See region_cache
+_cached_layouts = weakref.WeakSet()
+
+
+def _region_key(cell, pya_layer):
+    return (weakref.ref(cell.layout()), cell.cell_index(), pya_layer)
+
+
+@contextmanager
+def region_cache(layout):
+    ''' as_region remembers the merged regions of layout within this context, and forgets them when it exits.
+        Outside of one, as_region reads the layer every time, so writes that did not call invalidate_regions still show up.
+        Nothing from before the context is used.
+        _main and _drc_main run their steps in one.
+    '''
+    if layout in _cached_layouts:
+        yield  # an outer context has it
+        return
+    _forget_layout(layout)
+    _cached_layouts.add(layout)
+    try:
+        yield
+    finally:
+        _cached_layouts.discard(layout)
+        _forget_layout(layout)
+
+
+def _forget_layout(layout):
+    ''' Drops everything cached for layout, and for layouts that are gone '''
+    def stale(source_key):
+        return source_key[0]() in (layout, None)
+    for cache in (_region_cache, _layer_versions):
+        for key in [key for key in list(cache.keys()) if stale(key)]:
+            cache.pop(key, None)
+    with _derived_lock:
+        for derived_key in [derived_key for derived_key in _derived_cache.keys() if stale(derived_key[0])]:
+            del _derived_cache[derived_key]
+
+
 def as_region(cell, layname):
     ''' Mostly a convenience brevity function.
         If a layer isn't in the layer set, return an empty region instead of crashing
         If a list, will return the union of the listed layers
+
+        Within a region_cache (every run has one), the merged region is cached until the layer is written
+        (see invalidate_regions), so repeated reads of big layers skip the extraction and merge.
+        What you get back is a copy, so go ahead and modify it.
+
+        In hierarchical mode (see set_hierarchical), it reads the whole hierarchy below the cell
+        into a deep region, so operations run once per unique cell instead of once per instance.
     '''
     if isinstance(layname, (list, tuple)):
         union = pya.Region()
@@ -32,150 +104,596 @@ def as_region(cell, layname):
             union += as_region(cell, one_lay)
         return union
     else:
-        try:
-            pya_layer = lys[layname]
-        except KeyError:
-            message(f'{layname} not found in layerset.')
-            return pya.Region()
-        return pya.Region(cell.shapes(pya_layer))
-
-
-_thread_count = None
-_tiles = None
-def set_threads(thread_count, tiles=2):
-    ''' Set to None to disable parallel processing '''
-    global _thread_count, _tiles
+        return _cached_region(cell, layname).dup()
+
+
+def _cached_region(cell, layname):
+    ''' Like as_region, but gives the cached object itself. Do not modify it '''
+    try:
+        pya_layer = lys[layname]
+    except KeyError:
+        message(f'{layname} not found in layerset.')
+        return pya.Region()
+    shape_count = _shape_count(cell, pya_layer)
+    if shape_count == 0:
+        return pya.Region()
+    if cell.layout() not in _cached_layouts:
+        return _read_region(cell, pya_layer)
+    key = _region_key(cell, pya_layer)
+    source = (shape_count, _reads_deep())
+    try:
+        region, cached_source = _region_cache[key]
+    except KeyError:
+        cached_source = None
+    # The count is a safety net for writes that did not invalidate
+    if cached_source != source:
+        region = _read_region(cell, pya_layer)
+        _region_cache[key] = (region, source)
+    return region
+
+
+def _read_region(cell, pya_layer):
+    if _settings.deep_store is None:
+        region = pya.Region(cell.shapes(pya_layer))
+    elif _reads_deep():
+        region = pya.Region(cell.begin_shapes_rec(pya_layer), _settings.deep_store)
+    else:
+        region = pya.Region(cell.begin_shapes_rec(pya_layer))
+    region.merge()
+    return region
+
+
+def _shape_count(cell, pya_layer):
+    ''' In hierarchical mode, this counts the shapes in each unique cell below, not each instance '''
+    if _settings.deep_store is None:
+        return cell.shapes(pya_layer).size()
+    layout = cell.layout()
+    shape_count = cell.shapes(pya_layer).size()
+    for child_index in cell.called_cells():
+        shape_count += layout.cell(child_index).shapes(pya_layer).size()
+    return shape_count
+
+
+def invalidate_regions(cell=None, layname=None):
+    ''' Forget cached regions. Steps call this after writing to a layer
+        with cell.clear, shapes().insert, cell.copy, flatten, etc.
+
+        If layname is None, every layer in the cell is forgotten.
+        If cell is None, everything is forgotten.
+    '''
+    if cell is None:
+        _region_cache.clear()
+        with _derived_lock:
+            _derived_cache.clear()
+        return
+    if cell.layout() not in _cached_layouts:
+        return  # nothing is cached for it
+    if layname is None:
+        pya_layers = cell.layout().layer_indexes()
+    else:
+        pya_layers = []
+        for one_lay in (layname if isinstance(layname, (list, tuple)) else [layname]):
+            try:
+                pya_layers.append(lys[one_lay])
+            except KeyError:
+                pass
+    for pya_layer in pya_layers:
+        key = _region_key(cell, pya_layer)
+        _region_cache.pop(key, None)
+        _layer_versions[key] = _layer_versions.get(key, 0) + 1
+    _forget_stale_derived()
+
+
+#: How many times each layer has been invalidated, keyed like _region_cache
+_layer_versions = dict()
+#: Regions derived from layers, least recently used first. Values are (region, estimated bytes)
+_derived_cache = OrderedDict()
+#: Threads working on different layouts share _derived_cache
+_derived_lock = threading.RLock()
+_derived_limit_mb = 500
+#: Rough memory of one polygon in a Region, for the estimate. Smoothed polygons are about this big
+_bytes_per_polygon = 200
+
+
+def layer_versions():
+    ''' A copy of _layer_versions. Comparing two of these tells which layers were written in between '''
+    return dict(_layer_versions)
+
+
+def set_derived_limit(megabytes):
+    ''' Memory allowed for derived regions (see smoothed_layer), estimated from their polygon counts.
+        The least recently used ones are dropped to stay under it. 0 turns the memo off.
+    '''
+    global _derived_limit_mb
+    _derived_limit_mb = megabytes
+    _evict_derived()
+
+
+def _evict_derived():
+    with _derived_lock:
+        total = sum(nbytes for _, nbytes in _derived_cache.values())
+        while total > _derived_limit_mb * 2 ** 20 and len(_derived_cache) > 0:
+            _, (_, nbytes) = _derived_cache.popitem(last=False)
+            total -= nbytes
+
+
+def _forget_stale_derived():
+    ''' Stale entries would never be hit again, but they would take up room until evicted '''
+    with _derived_lock:
+        for derived_key in list(_derived_cache.keys()):
+            source_key, version = derived_key[0], derived_key[1]
+            if _layer_versions.get(source_key, 0) != version[0]:
+                del _derived_cache[derived_key]
+
+
+def _derived_region(cell, layname, func, *args):
+    ''' func(as_region(cell, layname), *args), remembered until the layer is written.
+        The key is (layer, version of the layer, func, args, whether the layer is read as a deep region).
+    '''
+    try:
+        pya_layer = lys[layname]
+    except KeyError:
+        message(f'{layname} not found in layerset.')
+        return pya.Region()
+    if cell.layout() not in _cached_layouts:
+        return func(_cached_region(cell, layname), *args)
+    source_key = _region_key(cell, pya_layer)
+    version = (_layer_versions.get(source_key, 0), _shape_count(cell, pya_layer))
+    derived_key = (source_key, version, func.__name__, args, _reads_deep())
+    with _derived_lock:
+        cached = _derived_cache.get(derived_key)
+        if cached is not None:
+            _derived_cache.move_to_end(derived_key)
+    if cached is not None:
+        region = cached[0]
+    else:
+        # Computed outside of the lock, so other threads are not held up
+        region = func(_cached_region(cell, layname), *args)
+        nbytes = region.count() * _bytes_per_polygon
+        with _derived_lock:
+            _derived_cache[derived_key] = (region, nbytes)
+        _evict_derived()
+    return region.dup()
+
+
+def smoothed_layer(cell, layname, deviation=0.1):
+    ''' Same as fast_smoothed(as_region(cell, layname), deviation),
+        except that steps asking for the same thing again get it for free
+    '''
+    return _derived_region(cell, layname, fast_smoothed, deviation)
+
+
+def sized_layer(cell, layname, xsize):
+    ''' Same as fast_sized(as_region(cell, layname), xsize), remembered like smoothed_layer '''
+    return _derived_region(cell, layname, fast_sized, xsize)
+
+
+class _RunSettings(threading.local):
+    ''' What set_threads, set_remote_hosts, set_hierarchical, and flat_regions change.
+        Like lys in a layer_context, each thread has its own, so threads working on different layouts
+        do not change how the others run. A new thread starts with these defaults.
+    '''
+    thread_count = None
+    tiles = None
+    remote_hosts = None
+    deep_store = None
+    flat_reads = False
+
+_settings = _RunSettings()
+_setting_names = ['thread_count', 'tiles', 'remote_hosts', 'deep_store', 'flat_reads']
+
+
+def set_threads(thread_count, tiles='auto'):
+    ''' Set to None to disable parallel processing. 'auto' uses all of the cores.
+        tiles is the number of tiles per side, or 'auto' to plan them
+        based on where the geometry is and how many threads there are (see lymask.tiling)
+    '''
+    if thread_count == 'auto':
+        thread_count = cpu_count()
     if thread_count == 1:
         thread_count = None
-    _thread_count = thread_count
-    _tiles = tiles
+    _settings.thread_count = thread_count
+    _settings.tiles = tiles
+    if _settings.deep_store is not None:
+        _settings.deep_store.threads = thread_count or 1
+
+
+def set_remote_hosts(remote_host):
+    ''' Tiling jobs go to lymask workers on these hosts instead of running here. See lymask.remote.
+        remote_host is "host:port" or a list of them. None runs tiles here again.
+        The thread count of set_threads is then how many tiles each host works on at once.
+    '''
+    _settings.remote_hosts = parse_hosts(remote_host)
+    if _settings.remote_hosts is not None and _settings.thread_count is None:
+        # so that jobs are tiled at all
+        _settings.thread_count = 1
+        if _settings.tiles is None:
+            _settings.tiles = 'auto'
+
+
+def _tiling_processor():
+    if _settings.remote_hosts is None:
+        return pya.TilingProcessor()
+    else:
+        return RemoteTilingProcessor(_settings.remote_hosts)
+
+
+def set_hierarchical(hierarchical=True):
+    ''' Hierarchical (deep) mode keeps the cell hierarchy instead of needing everything flattened into the top cell.
+        Layers are read through the hierarchy into a DeepShapeStore, and checks run once per unique cell.
+        The tiling processor does not work on deep regions, so the fast_* functions call klayout directly.
+        Parallelism then comes from the deep shape store, which uses the same thread count as set_threads.
+    '''
+    invalidate_regions()
+    if hierarchical:
+        _settings.deep_store = pya.DeepShapeStore()
+        _settings.deep_store.threads = _settings.thread_count or 1
+    else:
+        _settings.deep_store = None
+
+
+def is_hierarchical():
+    return _settings.deep_store is not None
+
+
+@contextmanager
+def flat_regions(flat=True):
+    ''' In hierarchical mode, as_region gives flat regions of everything below the cell while this is active.
+        This is for steps that need the whole layout at once, like sleeves and the ground plane.
+        They write their results into the cell itself. Outside of hierarchical mode, it does nothing
+    '''
+    flat_before = _settings.flat_reads
+    _settings.flat_reads = flat
+    try:
+        yield
+    finally:
+        _settings.flat_reads = flat_before
+
+
+def _reads_deep():
+    return _settings.deep_store is not None and not _settings.flat_reads
+
+
+@contextmanager
+def run_settings():
+    ''' What set_threads, set_remote_hosts, and set_hierarchical change within this context is undone when it exits.
+        _main and _drc_main run in one, so the processor step of a deck does not outlast the run.
+        In hierarchical mode, the run gets a DeepShapeStore of its own, which is dropped at the end.
+    '''
+    settings_before = dict((name, getattr(_settings, name)) for name in _setting_names)
+    if _settings.deep_store is not None:
+        set_hierarchical(True)
+    try:
+        yield
+    finally:
+        for name, value in settings_before.items():
+            setattr(_settings, name, value)
+
+
+def clear_layer(cell, layname):
+    ''' cell.clear, but in hierarchical mode it also clears every cell below. Call invalidate_regions after '''
+    cell.clear(lys[layname])
+    if _settings.deep_store is not None:
+        layout = cell.layout()
+        for child_index in cell.called_cells():
+            layout.cell(child_index).clear(lys[layname])
+
+
+def replace_layer(cell, layname, region):
+    ''' Writes region over what was in the layer. Call invalidate_regions after.
+        A deep region goes back into the hierarchy it came from, so work done once per unique cell stays that way.
+        Anything else goes into cell itself.
+    '''
+    clear_layer(cell, layname)
+    if region.is_deep():
+        region.insert_into(cell.layout(), cell.cell_index(), lys[layname])
+    else:
+        cell.shapes(lys[layname]).insert(region)
 
 
 def _normal_smoothed(unfiltered_region, deviation=0.1):
     smoothed_region = unfiltered_region.dup()
     smoothed_region.merged_semantics = False
-    smoothed_region.smooth(deviation / dbu)
+    smoothed_region.smooth(deviation / get_dbu())
     return smoothed_region
 
 
 def fast_smoothed(unfiltered_region, deviation=0.1):
     ''' Removes any points that would change the shape by less than this deviation.
         This is used to significantly decrease the number of points prior to sizing
-
-        Note: multicore does not work well with this, but it turns out to be pretty fast
     '''
-    # if something goes wrong, you can fall back to regular here by uncommenting
-    return _normal_smoothed(unfiltered_region, deviation)
+    return smoothed_regions([unfiltered_region], deviation)[0]
 
-    temp_region = unfiltered_region.dup()
-    temp_region.merged_semantics = False
 
-    output_region = pya.Region()
-    tp = pya.TilingProcessor()
-    tp.input('in1', temp_region)
-    tp.output('out1', output_region)
-    tp.queue("_output(out1, in1.smoothed({}))".format(deviation / dbu))
-    # tp.tile_size(2000., 2000.)  # Not sure why this was here
-    tp.tiles(_tiles, _tiles)
-    tp.tile_border(5 * deviation, 5 * deviation)
-    tp.threads = _thread_count
-    tp.execute('Smoothing job')
-    return output_region
+def smoothed_regions(regions, deviation=0.1, job_name='Smoothing job'):
+    ''' fast_smoothed of several regions in one tiling job, with one input and one output per region.
+        Empty regions are not part of the job.
+
+        Smoothing a polygon depends on all of it, so clipping to tiles would change the result.
+        Instead, each tile smooths the polygons that are inside it, without clipping (see _whole_polygon_job).
+        Polygons that cross tiles come back from every tile they overlap, so they are deduplicated and smoothed afterwards.
+    '''
+    operations = ['smoothed({})'.format(deviation / get_dbu())] * len(regions)
+    outputs, crossing = _whole_polygon_job(regions, operations, False, job_name)
+    for i_region, region in enumerate(regions):
+        if crossing[i_region] is None:
+            if not region.is_empty():
+                outputs[i_region] = _normal_smoothed(region, deviation)
+            continue
+        unique = pya.Region()
+        seen = set()
+        for polygon in crossing[i_region].each():
+            if polygon not in seen:
+                seen.add(polygon)
+                unique.insert(polygon)
+        outputs[i_region] += _normal_smoothed(unique, deviation)
+    return outputs
+
+
+def sized_regions(regions, sizes, job_name='Sizing job'):
+    ''' fast_sized of several regions in one tiling job, each by its own size in database units.
+        Unlike fast_sized, the polygons are not cut at the tile seams (see _whole_polygon_job),
+        so the result is the same as untiled, and smoothing it later does not depend on the tiles.
+    '''
+    operations = ['sized({})'.format(size) for size in sizes]
+    outputs, crossing = _whole_polygon_job(regions, operations, True, job_name)
+    for i_region, region in enumerate(regions):
+        if crossing[i_region] is None:
+            if not region.is_empty():
+                outputs[i_region] = region.sized(sizes[i_region])
+            continue
+        # Each tile merged only the part of these that it could see, but merging them all together makes them whole
+        outputs[i_region] += crossing[i_region].sized(sizes[i_region])
+        outputs[i_region].merge()
+    return outputs
+
+
+def _whole_polygon_job(regions, operations, merged_semantics, job_name):
+    ''' For operations that depend on whole polygons, so clipping them to tiles would change the result.
+        Each tile runs operations[i] (a Region method call, like "sized(100)") on the polygons of regions[i]
+        that do not touch the tile outline, and outputs the result without clipping.
+        The polygons that touch an outline come back from every tile they touch, for the caller to finish.
+
+        Returns the outputs and those crossing polygons, one per region.
+        The crossing polygons are None for empty regions, and for all of them when the job does not run tiled.
+        Then the caller does the whole thing itself.
+    '''
+    outputs = [pya.Region() for _ in regions]
+    crossing = [None for _ in regions]
+    to_do = [i_region for i_region, region in enumerate(regions) if not region.is_empty()]
+    if (_settings.thread_count is None or len(to_do) == 0
+            or any(regions[i_region].is_deep() for i_region in to_do)):
+        return outputs, crossing
+
+    tp = _tiling_processor()
+    inputs = []
+    for i_region in to_do:
+        temp_region = regions[i_region].dup()
+        temp_region.merged_semantics = merged_semantics
+        inputs.append(temp_region)
+    if _setup_tiles(tp, inputs, 0) == (1, 1):
+        # Nothing to split up
+        return outputs, crossing
+    lines = ['var outline = _tile.edges']
+    for i_input, i_region in enumerate(to_do):
+        crossing[i_region] = pya.Region()
+        tp.input('in{}'.format(i_input + 1), inputs[i_input])
+        tp.output('out{}'.format(i_input + 1), outputs[i_region])
+        tp.output('cross{}'.format(i_input + 1), crossing[i_region])
+        if merged_semantics:
+            lines.append('var inside{0} = in{0}.not_interacting(outline).interacting(_tile)'.format(i_input + 1))
+        else:
+            # Each result has merged semantics again, so it is set back every time
+            lines.append('var apart{0} = in{0}.not_interacting(outline); apart{0}.merged_semantics = false'.format(i_input + 1))
+            lines.append('var inside{0} = apart{0}.interacting(_tile); inside{0}.merged_semantics = false'.format(i_input + 1))
+        lines.append('_output(out{0}, inside{0}.{1}, false)'.format(i_input + 1, operations[i_region]))
+        lines.append('_output(cross{0}, in{0}.interacting(outline), false)'.format(i_input + 1))
+    tp.queue('; '.join(lines))
+    tp.execute(job_name)
+    return outputs, crossing
 
 
 def fast_sized(input_region, xsize):
+    if input_region.is_empty():
+        return pya.Region()
     # if something goes wrong, you can fall back to regular here by uncommenting
-    if _thread_count is None:
+    if _settings.thread_count is None or input_region.is_deep():
         return input_region.sized(xsize)
     else:
         output_region = pya.Region()
-        tp = pya.TilingProcessor()
+        tp = _tiling_processor()
         tp.input('in1', input_region)
         tp.output('out1', output_region)
         tp.queue("_output(out1, in1.sized({}))".format(xsize))
-        tp.tiles(_tiles, _tiles)
-        tp.tile_border(2 * xsize, 2 * xsize)
-        tp.threads = _thread_count
+        _setup_tiles(tp, [input_region], 2 * xsize)
         tp.execute('Sizing job')
         return output_region
 
 
 def fast_width(input_region, width, angle=90, min_projection=0):
+    if input_region.is_empty():
+        return pya.EdgePairs()
     # if something goes wrong, you can fall back to regular here by uncommenting
-    if _thread_count is None:
+    if _settings.thread_count is None or input_region.is_deep():
         return input_region.width_check(width, False, Projection, angle)
     else:
-        output_edge_pairs = pya.EdgePairs()
-        tp = pya.TilingProcessor()
-        tp.input('in1', input_region)
-        tp.output('out1', output_edge_pairs)
         if min_projection is None or min_projection == 0:
             min_projection = 'nil'
-        tp.queue("_output(out1, in1.width_check({}, false, Region.Projection, {}, {}, nil))".format(width, angle, min_projection))
-
+        script = "_output(out1, in1.width_check({}, false, Region.Projection, {}, {}, nil))".format(width, angle, min_projection)
         border = 1.1 * width
-        tp.tile_border(border, border)
-        tp.tiles(_tiles, _tiles)
-        tp.threads = _thread_count
-        tp.execute('Width check job')
-        return output_edge_pairs
+        return _tiled_edge_pairs(script, [input_region], border, 'Width check job')
 
 
 def fast_space(input_region, spacing, angle=90, min_projection=0):
+    if input_region.is_empty():
+        return pya.EdgePairs()
     # if something goes wrong, you can fall back to regular here by uncommenting
-    if _thread_count is None:
+    if _settings.thread_count is None or input_region.is_deep():
         return input_region.space_check(spacing, False, Projection, angle, min_projection)
     else:
-        output_edge_pairs = pya.EdgePairs()
-        tp = pya.TilingProcessor()
-        tp.input('in1', input_region)
-        tp.output('out1', output_edge_pairs)
-        # tp.queue("_output(out1, in1.space_check({}))".format(spacing))
+        # script = "_output(out1, in1.space_check({}))".format(spacing)
         if min_projection is None or min_projection == 0:
             min_projection = 'nil'
-        tp.queue("_output(out1, in1.space_check({}, false, Region.Projection, {}, {}, nil))".format(spacing, angle, min_projection))
-
+        script = "_output(out1, in1.space_check({}, false, Region.Projection, {}, {}, nil))".format(spacing, angle, min_projection)
         border = 1.1 * spacing
-        tp.tile_border(border, border)
-        tp.tiles(_tiles, _tiles)
-        tp.threads = _thread_count
-        tp.execute('Spacing check job')
-        return output_edge_pairs
+        return _tiled_edge_pairs(script, [input_region], border, 'Spacing check job')
 
 
 def fast_separation(r1, r2, exclude):
+    if r1.is_empty() or r2.is_empty():
+        return pya.EdgePairs()
     # if something goes wrong, you can fall back to regular here by uncommenting
-    if _thread_count is None:
+    if _settings.thread_count is None or r1.is_deep() or r2.is_deep():
         return r1.separation_check(r2, exclude)
     else:
-        output_edge_pairs = pya.EdgePairs()
-        tp = pya.TilingProcessor()
-        tp.input('in1', r1)
-        tp.input('in2', r2)
-        tp.output('out1', output_edge_pairs)
-        tp.queue("_output(out1, in1.separation_check(in2, {}))".format(exclude))
-
+        script = "_output(out1, in1.separation_check(in2, {}))".format(exclude)
         border = 2 * exclude
-        tp.tile_border(border, border)
-        tp.tiles(_tiles, _tiles)
-        tp.threads = _thread_count
-        tp.execute('Separation check job')
+        return _tiled_edge_pairs(script, [r1, r2], border, 'Separation check job')
+
+
+def _tiled_edge_pairs(script, inputs, border, job_name):
+    ''' Runs a tiling script that reads in1, in2, ... and writes EdgePairs to out1.
+        Within batched_rules, the script is queued on the batch instead,
+        and the EdgePairs that come back are empty until the batch executes.
+    '''
+    output_edge_pairs = pya.EdgePairs()
+    rule_batch = _current_batch()
+    if rule_batch is not None:
+        rule_batch.queue(script, inputs, output_edge_pairs, border)
         return output_edge_pairs
+    tp = _tiling_processor()
+    for i_input, input_region in enumerate(inputs):
+        tp.input('in{}'.format(i_input + 1), input_region)
+    tp.output('out1', output_edge_pairs)
+    tp.queue(script)
+    _setup_tiles(tp, inputs, border)
+    tp.execute(job_name)
+    return _unique_edge_pairs(output_edge_pairs)
+
+
+def _unique_edge_pairs(edge_pairs):
+    ''' Edge pairs are not clipped to the tile, so one that crosses a tile boundary is found by both tiles '''
+    unique = pya.EdgePairs()
+    seen = set()
+    for ep in edge_pairs.each():
+        if ep not in seen:
+            seen.add(ep)
+            unique.insert(ep)
+    return unique
+
+
+def _setup_tiles(tp, inputs, border):
+    ''' Tile count, border, and threads of a TilingProcessor. Returns the tile count (nx, ny).
+        border is in database units (the TilingProcessor wants microns)
+
+        With one tile, the TilingProcessor leaves _tile nil unless there is a frame.
+        So the frame is set to the extent of the inputs, and scripts can count on _tile either way.
+    '''
+    border = abs(border)
+    dbu = get_dbu()
+    tp.dbu = dbu
+    tp.tile_border(border * dbu, border * dbu)
+    tile_counts = _tile_counts(inputs, border, _settings.thread_count * len(_settings.remote_hosts or [None]))
+    tp.tiles(*tile_counts)
+    if tile_counts == (1, 1) and isinstance(tp, pya.TilingProcessor):
+        # Remote workers always have a frame: their one tile
+        extent = pya.Box()
+        for region in inputs:
+            extent += region.bbox()
+        if not extent.empty():
+            tp.frame = extent.to_dtype(dbu)
+    tp.threads = _settings.thread_count
+    return tile_counts
+
+
+def _tile_counts(inputs, border, thread_count):
+    if _settings.tiles == 'auto':
+        return plan_tiles(inputs, border, thread_count, get_dbu())
+    else:
+        return _settings.tiles, _settings.tiles
+
+
+class RuleBatch(object):
+    ''' Collects the tiled checks of several read-only DRC rules so that they run as one TilingProcessor.
+        Every tile then runs all of the checks, and the thread pool stays full
+        even when each check on its own is small.
+
+        Anything that consumes the outputs has to wait until execute, so rdb_create is deferred too.
+    '''
+    def __init__(self):
+        self.tp = _tiling_processor()
+        self.border = 0
+        self.job_count = 0
+        self.deferred = []
+        # Holding these keeps them alive. The steps that made them are gone by the time we execute
+        self.inputs = []
+        self.outputs = []
+
+    def queue(self, script, inputs, output, border):
+        self.inputs.extend(inputs)
+        self.outputs.append(output)
+        prefix = 'j{}_'.format(self.job_count)
+        for i_input, input_region in enumerate(inputs):
+            self.tp.input(prefix + 'in{}'.format(i_input + 1), input_region)
+        self.tp.output(prefix + 'out1', output)
+        self.tp.queue(re.sub(r'\b(in\d+|out1)\b', prefix + r'\1', script))
+        self.border = max(self.border, border)
+        self.job_count += 1
+
+    def defer(self, func, *args):
+        self.deferred.append((func, args))
+
+    def execute(self, job_name='Rule batch job'):
+        ''' Runs what was queued so far. The batch is then empty, so it can be used again '''
+        if self.job_count > 0:
+            _setup_tiles(self.tp, self.inputs, self.border)
+            self.tp.execute(job_name)
+            for output in self.outputs:
+                output.assign(_unique_edge_pairs(output))
+        # In order, and in this thread, so the report database sees the same thing as a serial run
+        deferred = self.deferred
+        self.__init__()
+        for func, args in deferred:
+            func(*args)
+
+
+#: Each thread has its own batch, so a thread working on another layout does not put its rules in this one
+_rule_batches = threading.local()
+def _current_batch():
+    return getattr(_rule_batches, 'batch', None)
+
+
+@contextmanager
+def batched_rules(job_name='Rule batch job'):
+    ''' DRC steps called within this context have their checks run together when it exits,
+        or before then with the execute of the batch that it gives.
+        Does nothing when running single threaded or hierarchical, in which case it gives None.
+    '''
+    if _settings.thread_count is None or _current_batch() is not None or _settings.deep_store is not None:
+        yield None
+        return
+    batch = RuleBatch()
+    _rule_batches.batch = batch
+    try:
+        yield batch
+    finally:
+        _rule_batches.batch = None
+    batch.execute(job_name)
 
 
 def turbo(input_region, meth_name, meth_args, tile_border=1, job_name='Tiling job'):
-    ''' Speeds things up by tiling. Parameters are determined by _thread_count and _tiles
-        if _thread_count is 1, it does not invoke tile processor at all
+    ''' Speeds things up by tiling. Parameters are determined by set_threads
+        if the thread count is 1, it does not invoke tile processor at all
         tile_border is in microns. Recommended that you make it 1.1 * the critical dimension.
         args is a list.
     '''
     if not isinstance(meth_args, (list, tuple)):
         meth_args = [meth_args]
-    if _thread_count is None:
+    if _settings.thread_count is None or input_region.is_deep():
         return getattr(input_region, meth_name)(*meth_args)
     else:
         output_region = pya.Region()
-        tp = pya.TilingProcessor()
+        tp = _tiling_processor()
         tp.input('in1', input_region)
         tp.output('out1', output_region)
 
@@ -195,27 +713,290 @@ def turbo(input_region, meth_name, meth_args, tile_border=1, job_name='Tiling jo
         job_str = '_output(out1, in1.{}({}))'.format(meth_name, ', '.join(clean_args))
         tp.queue(job_str)
 
-        tp.tile_border(tile_border, tile_border)
-        tp.tiles(_tiles, _tiles)
-        tp.threads = _thread_count
+        _setup_tiles(tp, [input_region] + [arg for arg in meth_args if isinstance(arg, pya.Region)], tile_border / get_dbu())
         tp.execute(job_name)
         return output_region
 
 
+def tile_map(func, regions, border=0, args=(), job_name='Tile map job'):
+    ''' For Python steps that can't be written as a tiling script. Calls func(*tile_regions, *args) on tiles of the regions,
+        in a pool of processes, so it uses more than one core despite the GIL. There is one process per thread of set_threads.
+        Each tile gets the shapes of every region that touch the tile or its border (in database units), unclipped.
+        func returns a pya.Region. That is clipped to the tile, and the pieces from all of the tiles are merged.
+        Tiles at the edge are not clipped on the outside, so anything that func makes outside of the regions is kept.
+
+        func has to be a module level function, so that the processes can find it. Functions in add_library files are fine.
+        Without threads, or with hierarchical regions, it calls func on the whole regions here.
+    '''
+    if getattr(func, '__qualname__', '<').startswith('<') or '<locals>' in func.__qualname__:
+        raise ValueError('tile_map needs a module level function, not {!r}'.format(func))
+    if _settings.thread_count is None or any(region.is_deep() for region in regions):
+        return func(*(list(regions) + list(args)))
+    tile_inputs = TileInputs(regions, get_dbu())
+    output_region = pya.Region()
+    if tile_inputs.extent.empty():
+        return output_region
+    nx, ny = _tile_counts(regions, border, _settings.thread_count)
+    merged_semantics = [region.merged_semantics for region in regions]
+    with ProcessPoolExecutor(max_workers=_settings.thread_count) as executor:
+        futures = []
+        for tile in tile_grid(tile_inputs.extent, nx, ny):
+            tile_layout = tile_inputs.cut(tile.enlarged(pya.Vector(border, border)))
+            if tile_layout is not None:
+                clip = _clip_box(tile, tile_inputs.extent)
+                futures.append(executor.submit(_map_tile, _TileFunction(func), (clip.left, clip.bottom, clip.right, clip.top),
+                                               _layout_to_bytes(tile_layout), merged_semantics, tuple(args)))
+        for future in futures:
+            output_region.insert(_layer_region(_layout_from_bytes(future.result()), 0))
+    message('{}: {} tiles in {} processes'.format(job_name, len(futures), _settings.thread_count))
+    return output_region.merged()
+
+
+def _clip_box(tile, extent, far=2 ** 30):
+    ''' The tile, but reaching out to far on the sides where it is at the edge of the extent.
+        Results that stick out of the extent are then kept, and by only one tile
+    '''
+    return pya.Box(-far if tile.left == extent.left else tile.left,
+                   -far if tile.bottom == extent.bottom else tile.bottom,
+                   far if tile.right == extent.right else tile.right,
+                   far if tile.top == extent.top else tile.top)
+
+
+def _map_tile(func, clip, payload, merged_semantics, args):
+    ''' What a tile_map process does with one tile. The output comes back as OASIS bytes '''
+    tile_layout = _layout_from_bytes(payload)
+    regions = []
+    for i_region, merged in enumerate(merged_semantics):
+        regions.append(_layer_region(tile_layout, i_region))
+        regions[-1].merged_semantics = merged
+    clipped = func(*(regions + list(args))) & pya.Region(pya.Box(*clip))
+    output_layout = pya.Layout()
+    output_layout.dbu = tile_layout.dbu
+    output_layout.create_cell('TILE').shapes(output_layout.layer(0, 0)).insert(clipped)
+    return _layout_to_bytes(output_layout)
+
+
+#: Modules that _TileFunction imported from files, keyed by the file
+_file_modules = dict()
+class _TileFunction(object):
+    ''' Pickles a function by name, like pickle does, and also by the file it is in.
+        Files from add_library are run, not imported, so the processes can't import them by name
+    '''
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args):
+        return self.func(*args)
+
+    def __getstate__(self):
+        filename = getattr(sys.modules.get(self.func.__module__), '__file__', None)
+        if filename is None and hasattr(self.func, '__code__'):
+            filename = self.func.__code__.co_filename
+        if filename is not None:
+            filename = os.path.realpath(filename)
+        return self.func.__module__, self.func.__qualname__, filename
+
+    def __setstate__(self, state):
+        module_name, qualname, filename = state
+        module = sys.modules.get(module_name)
+        if module is None:
+            try:
+                module = importlib.import_module(module_name)
+            except ImportError:
+                pass
+        module_file = getattr(module, '__file__', None)
+        if filename is not None and (module_file is None or os.path.realpath(module_file) != filename):
+            if filename not in _file_modules:
+                spec = importlib.util.spec_from_file_location(module_name, filename)
+                _file_modules[filename] = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(_file_modules[filename])
+            module = _file_modules[filename]
+        self.func = module
+        for name in qualname.split('.'):
+            self.func = getattr(self.func, name)
+
+
+class RegionExpr(object):
+    ''' A Region operation that has not run yet. Make one with deferred(region).
+        Sizing and booleans build up an expression. evaluate compiles the whole thing
+        into one tiling script, so each tile is read once and all of the operations run on it together.
+        The tile border is the sum of the sizing borders along the deepest chain of operations.
+
+        Subexpressions that are used more than once are only computed once per tile.
+        Without threads, or with hierarchical regions, it just runs the Region methods in order.
+    '''
+    def __init__(self, op, args=(), children=(), value=None):
+        self.op = op
+        self.args = tuple(args)
+        self.children = tuple(children)
+        self.value = value  # a pya.Region once it is known
+
+    def _binary(self, op, other):
+        if not isinstance(other, RegionExpr):
+            other = deferred(other)
+        return RegionExpr(op, children=(self, other))
+
+    def __add__(self, other):
+        return self._binary('+', other)
+
+    def __sub__(self, other):
+        return self._binary('-', other)
+
+    def __and__(self, other):
+        return self._binary('&', other)
+
+    def __or__(self, other):
+        return self._binary('|', other)
+
+    def __xor__(self, other):
+        return self._binary('^', other)
+
+    def sized(self, *args):
+        ''' Same arguments as Region.sized, in database units '''
+        return RegionExpr('sized', args=args, children=(self,))
+
+    def smoothed(self, deviation=0.1):
+        ''' Smoothing is not local (see fast_smoothed), so it can't go in a tiling script.
+            This evaluates everything up to here, then smooths the whole region right away.
+            That evaluation is not tiled: smoothing pieces cut at the tile seams would not give the same polygons.
+        '''
+        if self.value is None:
+            # Anything else that uses this expression can take the result instead of computing it again
+            self.value = self._run(dict())
+            self.children = ()
+        return deferred(fast_smoothed(self.value, deviation))
+
+    def evaluate(self, job_name='Fused job'):
+        return evaluate_regions([self], job_name)[0]
+
+    def _halo(self, memo):
+        ''' How far outside of a tile this expression has to look, in database units '''
+        if id(self) not in memo:
+            if self.value is not None:
+                halo = 0
+            else:
+                halo = max(child._halo(memo) for child in self.children)
+                if self.op == 'sized':
+                    halo += 2 * max(abs(arg) for arg in self.args[:2])
+            memo[id(self)] = halo
+        return memo[id(self)]
+
+    def _leaves(self, leaves):
+        if self.value is not None:
+            if all(leaf is not self for leaf in leaves):
+                leaves.append(self)
+        else:
+            for child in self.children:
+                child._leaves(leaves)
+        return leaves
+
+    def _run(self, memo):
+        ''' Plain Region methods in this thread '''
+        if self.value is not None:
+            return self.value
+        if id(self) not in memo:
+            operands = [child._run(memo) for child in self.children]
+            if self.op == 'sized':
+                memo[id(self)] = operands[0].sized(*self.args)
+            else:
+                memo[id(self)] = _region_binaries[self.op](*operands)
+        return memo[id(self)]
+
+    def _compile(self, names, lines):
+        ''' Writes statements for this and its children into lines. Returns the variable holding the result '''
+        if id(self) not in names:
+            operands = [child._compile(names, lines) for child in self.children]
+            var_name = 'v{}'.format(len(lines) + 1)
+            if self.op == 'sized':
+                expression = '{}.sized({})'.format(operands[0], ', '.join(str(arg) for arg in self.args))
+            else:
+                expression = '{} {} {}'.format(operands[0], self.op, operands[1])
+            lines.append('var {} = {}'.format(var_name, expression))
+            names[id(self)] = var_name
+        return names[id(self)]
+
+
+_region_binaries = {'+': lambda a, b: a + b,
+                    '-': lambda a, b: a - b,
+                    '&': lambda a, b: a & b,
+                    '|': lambda a, b: a | b,
+                    '^': lambda a, b: a ^ b}
+
+
+def deferred(region):
+    ''' Start a RegionExpr from a pya.Region '''
+    return RegionExpr('region', value=region)
+
+
+def evaluate_regions(exprs, job_name='Fused job'):
+    ''' Computes several RegionExprs in one tiling job. Returns a list of pya.Region '''
+    leaves = []
+    for expr in exprs:
+        expr._leaves(leaves)
+    if (_settings.thread_count is None or any(leaf.value.is_deep() for leaf in leaves)
+            or all(leaf.value.is_empty() for leaf in leaves)):
+        memo = dict()
+        return [expr._run(memo).dup() for expr in exprs]
+
+    tp = _tiling_processor()
+    names = dict()
+    for i_leaf, leaf in enumerate(leaves):
+        names[id(leaf)] = 'in{}'.format(i_leaf + 1)
+        tp.input(names[id(leaf)], leaf.value)
+    lines = []
+    outputs = []
+    for i_expr, expr in enumerate(exprs):
+        var_name = expr._compile(names, lines)
+        outputs.append(pya.Region())
+        tp.output('out{}'.format(i_expr + 1), outputs[-1])
+        lines.append('_output(out{}, {})'.format(i_expr + 1, var_name))
+    tp.queue('; '.join(lines))
+    halo_memo = dict()
+    _setup_tiles(tp, [leaf.value for leaf in leaves], max(expr._halo(halo_memo) for expr in exprs))
+    tp.execute(job_name)
+    return outputs
+
+
 def rdb_create(rdb, cell, category, violations):
+    rule_batch = _current_batch()
+    if rule_batch is not None:
+        rule_batch.defer(_rdb_create, rdb, cell, category, violations)
+    else:
+        _rdb_create(rdb, cell, category, violations)
+
+
+def _rdb_create(rdb, cell, category, violations):
     rdb_cell = rdb.cell_by_qname(cell.name)
-    trans_to_um = pya.CplxTrans(dbu)
-    drc_exclude = as_region(cell, 'DRC_exclude')
-    if isinstance(violations, pya.EdgePairs):
-        # This handles edge pairs
-        cleaned_violations = pya.EdgePairs()
-        for ep in violations.each():
-            edges = pya.Edges([ep.first, ep.second])
-            # If drc_exclude touches it at all, don't add it
-            if drc_exclude.interacting(edges).is_empty():
-                cleaned_violations.insert(ep)
+    trans_to_um = pya.CplxTrans(get_dbu())
+    # Extracted once per cell and shared by all the categories, until DRC_exclude is written
+    drc_exclude = _cached_region(cell, 'DRC_exclude')
+    if drc_exclude.is_empty() or violations.is_empty():
+        cleaned_violations = violations
+    elif isinstance(violations, pya.EdgePairs):
+        cleaned_violations = _edge_pairs_not_touching(violations, drc_exclude)
     else:
         # Everything else
         cleaned_violations = violations.outside(drc_exclude)
     rdb.create_items(rdb_cell.rdb_id(), category.rdb_id(), trans_to_um, cleaned_violations)
 
+
+def _edge_pairs_not_touching(edge_pairs, region):
+    ''' Edge pairs where neither edge touches the region.
+        The search is one spatially indexed pass over all of the edges together.
+        After that, it is just a set lookup per edge pair, and that is skipped if nothing touches.
+
+        Note: EdgePairs.not_interacting (klayout >= 0.29.6) is not the same thing.
+        It counts the area between the edges, so it would also drop pairs that enclose an exclusion without touching it.
+    '''
+    all_edges = edge_pairs.edges()
+    all_edges.merged_semantics = False  # keep them exactly as they are in the pairs
+    touching = all_edges.interacting(region)
+    if touching.is_empty():
+        return edge_pairs
+    touching = set(touching.each())
+    cleaned = pya.EdgePairs()
+    for ep in edge_pairs.each():
+        if ep.first not in touching and ep.second not in touching:
+            cleaned.insert(ep)
+    return cleaned
+
@@ -0,0 +1,102 @@
+''' Writing dataprep results for the mask shop
+
+    Mask layers are 100 to 199, plus FLOORPLAN, the same as in clear_nonmask.
+    OASIS files get CBLOCK compression, strict mode, and repetition detection.
+
+    Writing holds the Python GIL, so separate mask files are written by forked processes, which see the layout without copying it.
+    Where fork is not available, they are written one after another.
+'''
+from __future__ import division, print_function, absolute_import
+import os
+import multiprocessing
+from lygadgets import pya
+
+from lymask.tiling import cpu_count
+from lymask.utilities import lys
+
+
+#: OASIS repetition detection effort. Higher levels search harder for arrays, and rarely find more
+oasis_compression_level = 2
+
+
+def is_mask_layer(layer_info):
+    return 100 <= layer_info.layer < 200 or is_floorplan(layer_info)
+
+
+def is_floorplan(layer_info):
+    ''' By name, or by the layer and datatype of FLOORPLAN in lys, because layers read from GDS have no names '''
+    if layer_info.name == 'FLOORPLAN':
+        return True
+    try:
+        floorplan = lys.get_as_LayerInfo('FLOORPLAN')
+    except KeyError:
+        return False
+    return layer_info.layer == floorplan.layer and layer_info.datatype == floorplan.datatype
+
+
+def save_options(outfile, layout=None, layer_indexes=None):
+    ''' SaveLayoutOptions for the format of outfile. If layer_indexes is given, only those layers are written '''
+    options = pya.SaveLayoutOptions()
+    options.set_format_from_filename(outfile)
+    if options.format == 'OASIS':
+        options.oasis_write_cblocks = True
+        options.oasis_strict_mode = True
+        options.oasis_compression_level = oasis_compression_level
+    if layer_indexes is not None:
+        options.deselect_all_layers()
+        for layer_index in layer_indexes:
+            options.add_layer(layer_index, layout.get_info(layer_index))
+    return options
+
+
+def write_layout(layout, outfile, masks_only=False):
+    ''' Writes the layout with tuned options. If masks_only, the other layers are left out '''
+    if masks_only:
+        layer_indexes = [layer_index for layer_index in layout.layer_indexes() if is_mask_layer(layout.get_info(layer_index))]
+    else:
+        layer_indexes = None
+    layout.write(outfile, save_options(outfile, layout, layer_indexes))
+
+
+def mask_files(layout, outfile):
+    ''' Where each mask goes when split: (layer index, filename).
+        The mask name goes after the base name of outfile. FLOORPLAN is not a mask, so it is not written.
+    '''
+    base, extension = os.path.splitext(outfile)
+    layer_files = []
+    for layer_index in layout.layer_indexes():
+        layer_info = layout.get_info(layer_index)
+        if not is_mask_layer(layer_info) or is_floorplan(layer_info):
+            continue
+        mask_name = layer_info.name or '{}_{}'.format(layer_info.layer, layer_info.datatype)
+        layer_files.append((layer_index, '{}_{}{}'.format(base, mask_name, extension)))
+    return layer_files
+
+
+def _write_one_mask(layout, layer_file):
+    layer_index, filename = layer_file
+    layout.write(filename, save_options(filename, layout, [layer_index]))
+    return filename
+
+
+_forked_layout = None
+def _write_one_forked_mask(layer_file):
+    return _write_one_mask(_forked_layout, layer_file)
+
+
+def write_split_masks(layout, outfile, processes=None):
+    ''' One file per mask layer (see mask_files). Returns the filenames '''
+    global _forked_layout
+    layer_files = mask_files(layout, outfile)
+    processes = min(processes or cpu_count(), len(layer_files))
+    # Daemonic processes, like the ones in multiprocessing.Pool, can't start their own
+    can_fork = 'fork' in multiprocessing.get_all_start_methods() and not multiprocessing.current_process().daemon
+    if processes <= 1 or not can_fork:
+        return [_write_one_mask(layout, layer_file) for layer_file in layer_files]
+    _forked_layout = layout
+    try:
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            return pool.map(_write_one_forked_mask, layer_files)
+    finally:
+        _forked_layout = None
+
@@ -0,0 +1,245 @@
+''' One phidl Device for a run of dpStep_phidl steps, instead of a round trip through the whole layout for each of them.
+
+    Within phidl_sessions(layout), a cell keeps its Device from one phidl step to the next.
+    A layer goes into the Device the first time a step declares it (see dpLayers), as one gdspy PolygonSet per layer.
+    The layers that a step writes come back out when the session finishes:
+    before the next step that is not a phidl step, before the step cache saves, and at the end.
+    They replace what the cell had, and what was below it, because that all went into the Device flattened.
+    Layers that were only read stay as they are. Shapes on layers that no step declared are added to the cell.
+    Both ways go through one GDS stream in memory, not point by point.
+    After each step, the layers it wrote are snapped to the database grid in the Device (see PhidlSession.snap),
+    so the steps give the same geometry as they would one at a time.
+
+    Outside of phidl_sessions (for example, calling a step yourself), the Device goes back into the cell after each step.
+'''
+from __future__ import division, print_function, absolute_import
+import io
+import hashlib
+import threading
+from contextlib import contextmanager
+from lygadgets import pya
+
+from lymask.utilities import lys
+from lymask.library import invalidate_regions, replace_layer
+from lymask.remote import _layout_to_bytes, _layout_from_bytes
+
+
+#: PhidlSession of each cell that has one, keyed by (id of layout, cell index)
+_sessions = dict()
+#: ids of layouts whose sessions last until they are finished
+_persistent_layouts = set()
+_sessions_lock = threading.Lock()
+
+
+class PhidlSession(object):
+    def __init__(self, cell):
+        from phidl import Device
+        self.cell = cell
+        self.device = Device(cell.name)
+        #: Names of the layers that are in the Device
+        self.laynames = set()
+        #: Names of the layers that go back into the cell
+        self.written = set()
+
+    def convert(self, laynames):
+        ''' Puts these layers of the cell into the Device, unless they are already there '''
+        import gdspy
+        layout = self.cell.layout()
+        regions = dict()
+        for layname in sorted(set(laynames) - self.laynames):
+            try:
+                layer_info = lys.get_as_LayerInfo(layname)
+            except KeyError:
+                continue
+            self.laynames.add(layname)
+            pya_layer = layout.find_layer(layer_info)
+            if pya_layer is None:
+                continue
+            regions[(layer_info.layer, layer_info.datatype)] = pya.Region(self.cell.begin_shapes_rec(pya_layer))
+        for (layer, datatype), polygons in _regions_to_arrays(regions, layout.dbu).items():
+            self.device.add(gdspy.PolygonSet(polygons, layer=layer, datatype=datatype))
+
+    def forget(self, laynames):
+        ''' Drops layers from the Device without writing them back. For layers that nothing needs anymore '''
+        specs = []
+        for layname in set(laynames) & self.laynames:
+            layer_info = lys.get_as_LayerInfo(layname)
+            specs.append((layer_info.layer, layer_info.datatype))
+            self.laynames.discard(layname)
+            self.written.discard(layname)
+        if len(specs) > 0:
+            self.device.remove_layers(layers=specs)
+
+    def snap(self, laynames):
+        ''' Puts these layers of the Device through the database grid, the same way as writing them into the cell
+            and converting them again would. So the next step sees what it would have seen without the session
+        '''
+        import gdspy
+        specs = sorted(set(_spec(layname) for layname in set(laynames) & self.laynames))
+        if len(specs) == 0:
+            return
+        dbu = self.cell.layout().dbu
+        self.device.flatten()
+        by_spec = self.device.get_polygons(by_spec=True)
+        regions = _arrays_to_regions(dict((spec, by_spec.get(spec, [])) for spec in specs), dbu)
+        self.device.remove_layers(layers=specs, include_labels=False)
+        for (layer, datatype), polygons in _regions_to_arrays(regions, dbu).items():
+            self.device.add(gdspy.PolygonSet(polygons, layer=layer, datatype=datatype))
+
+    def changed_laynames(self, digests_before):
+        ''' Names of the layers in the Device that are different from when layer_digests gave digests_before '''
+        digests = layer_digests(self.device)
+        changed = set(spec for spec in set(digests) | set(digests_before) if digests.get(spec) != digests_before.get(spec))
+        return set(layname for layname in self.laynames if _spec(layname) in changed)
+
+    def finish(self):
+        ''' Writes the written layers of the Device back into the cell '''
+        layout = self.cell.layout()
+        converted = set(_spec(layname) for layname in self.laynames)
+        written = dict((_spec(layname), layname) for layname in self.written)
+        by_spec = dict()
+        for spec, polygons in self.device.get_polygons(by_spec=True).items():
+            if spec in written or spec not in converted:
+                by_spec[spec] = polygons
+        regions = _arrays_to_regions(by_spec, layout.dbu)
+        for spec, layname in sorted(written.items(), key=lambda item: item[1]):
+            region = regions.pop(spec, pya.Region())
+            pya_layer = layout.find_layer(lys.get_as_LayerInfo(layname))
+            if region.is_empty() and pya_layer is None:
+                continue
+            if pya_layer is not None:
+                for child_index in self.cell.called_cells():
+                    layout.cell(child_index).clear(pya_layer)
+            replace_layer(self.cell, layname, region)
+        for (layer, datatype), region in regions.items():
+            # Nobody said these would be written, so they are added
+            self.cell.shapes(layout.layer(layer, datatype)).insert(region)
+        if len(regions) > 0:
+            invalidate_regions(self.cell)
+        else:
+            invalidate_regions(self.cell, sorted(self.written))
+
+
+def _spec(layname):
+    layer_info = lys.get_as_LayerInfo(layname)
+    return (layer_info.layer, layer_info.datatype)
+
+
+def layer_digests(device):
+    ''' A hash of the polygons on each (layer, datatype) of the Device, to see which ones a step changed '''
+    import numpy as np
+    digests = dict()
+    for spec, polygons in device.get_polygons(by_spec=True).items():
+        digest = hashlib.sha1()
+        for points in polygons:
+            digest.update(np.ascontiguousarray(points, dtype=np.float64).tobytes())
+        digests[spec] = digest.hexdigest()
+    return digests
+
+
+_stream_cell_name = 'LYMASK_PHIDL'
+
+
+def _regions_to_arrays(regions, dbu):
+    ''' The polygons of regions, keyed by (layer, datatype), as numpy arrays of points in microns.
+        They go through one GDS stream, and GDS has no holes, so klayout cuts them to the hull on the way
+    '''
+    import gdspy
+    if len(regions) == 0:
+        return dict()
+    layout = pya.Layout()
+    layout.dbu = dbu
+    stream_cell = layout.create_cell(_stream_cell_name)
+    for (layer, datatype), region in regions.items():
+        stream_cell.shapes(layout.layer(layer, datatype)).insert(region)
+    library = gdspy.GdsLibrary(unit=1e-6)
+    library.read_gds(io.BytesIO(_layout_to_bytes(layout, format='GDS2')), units='convert')
+    return library.cells[_stream_cell_name].get_polygons(by_spec=True)
+
+
+def _arrays_to_regions(by_spec, dbu):
+    ''' The other way from _regions_to_arrays. The points are snapped to the database unit '''
+    import gdspy
+    if len(by_spec) == 0:
+        return dict()
+    library = gdspy.GdsLibrary(unit=1e-6, precision=dbu * 1e-6)
+    stream_cell = library.new_cell(_stream_cell_name)
+    for (layer, datatype), polygons in by_spec.items():
+        if len(polygons) > 0:
+            stream_cell.add(gdspy.PolygonSet(polygons, layer=layer, datatype=datatype))
+    stream = io.BytesIO()
+    library.write_gds(stream)
+    layout = _layout_from_bytes(stream.getvalue())
+    regions = dict()
+    for pya_layer in layout.layer_indexes():
+        layer_info = layout.get_info(pya_layer)
+        regions[(layer_info.layer, layer_info.datatype)] = pya.Region(layout.top_cell().shapes(pya_layer))
+    return regions
+
+
+def _session(cell):
+    key = (id(cell.layout()), cell.cell_index())
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = PhidlSession(cell)
+        return _sessions[key]
+
+
+def _layout_sessions(layout, remove=False):
+    with _sessions_lock:
+        keys = [key for key in _sessions.keys() if key[0] == id(layout)]
+        if remove:
+            return [_sessions.pop(key) for key in keys]
+        return [_sessions[key] for key in keys]
+
+
+@contextmanager
+def phidl_step(cell, laynames, written=None):
+    ''' Gives the Device for one phidl step, with these layers in it.
+        written are the names of the layers that the step changes. If None, they are the ones that are different after
+    '''
+    layout = cell.layout()
+    session = _session(cell)
+    session.convert(laynames)
+    if written is None:
+        digests_before = layer_digests(session.device)
+    try:
+        yield session.device
+    except Exception:
+        if id(layout) not in _persistent_layouts:
+            _layout_sessions(layout, remove=True)
+        raise
+    if written is None:
+        written = session.changed_laynames(digests_before)
+    session.written.update(set(written) & session.laynames)
+    if id(layout) not in _persistent_layouts:
+        finish_phidl_sessions(layout)
+    else:
+        session.snap(written)
+
+
+def finish_phidl_sessions(layout):
+    ''' Writes every Device of the layout back into its cell '''
+    for session in _layout_sessions(layout, remove=True):
+        session.finish()
+
+
+def forget_phidl_layers(layout, laynames):
+    for session in _layout_sessions(layout):
+        session.forget(laynames)
+
+
+@contextmanager
+def phidl_sessions(layout):
+    ''' Consecutive phidl steps on the layout share their Devices until finish_phidl_sessions.
+        Any that are still open at the end are finished, unless there was an error
+    '''
+    with _sessions_lock:
+        _persistent_layouts.add(id(layout))
+    try:
+        yield
+        finish_phidl_sessions(layout)
+    finally:
+        with _sessions_lock:
+            _persistent_layouts.discard(id(layout))
+        _layout_sessions(layout, remove=True)
@@ -0,0 +1,137 @@
+''' Performance records for dataprep and DRC runs, so you can tell which step is slow
+'''
+from __future__ import division, print_function, absolute_import
+import sys
+import time
+import json
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from lygadgets import pya
+
+from lymask.utilities import objview
+
+
+def peak_rss_mb():
+    ''' High-water mark of resident memory for this process. None if the OS doesn't say '''
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss / 2 ** 20  # bytes
+    else:
+        return maxrss / 2 ** 10  # kilobytes
+
+
+def geometry_counts(cell, vertices=False):
+    ''' Number of polygons and vertices on all layers of the cell, including its children.
+        Boxes and paths count as polygons. Texts and edges are not counted.
+        Polygons are counted by klayout in a deep region, which counts each unique cell once
+        and multiplies by how many times it is placed, so a hierarchical layout is not flattened.
+        Vertices are None unless asked for, because that walks every shape in python.
+    '''
+    layout = cell.layout()
+    store = pya.DeepShapeStore()
+    polygon_count = 0
+    for layer_index in layout.layer_indexes():
+        polygon_count += pya.Region(cell.begin_shapes_rec(layer_index), store).count()
+    if not vertices:
+        return polygon_count, None
+    vertex_count = 0
+    for layer_index in layout.layer_indexes():
+        shape_iter = cell.begin_shapes_rec(layer_index)
+        while not shape_iter.at_end():
+            polygon = shape_iter.shape().polygon
+            if polygon is not None:
+                vertex_count += polygon.num_points()
+            shape_iter.next()
+    return polygon_count, vertex_count
+
+
+class RunProfile(object):
+    ''' One record per step per top cell, in the order they ran.
+        Each record is an objview with
+
+            step, kwargs, cell: what ran
+            wall_time, cpu_time: in seconds. cpu_time includes all threads, so it can exceed wall_time
+            peak_rss_mb: memory high-water mark of the process after the step.
+                It never goes down, so look for the step where it jumps.
+            polygons_in, vertices_in, polygons_out, vertices_out: only if count_geometry.
+                The vertices are None unless count_vertices, which is much slower
+            markers: number of DRC items created by the step, only for DRC
+
+        Use save to get JSON that can be compared from run to run.
+    '''
+    def __init__(self, ymlfile=None, infile=None, count_geometry=True, count_vertices=False):
+        self.ymlfile = ymlfile
+        self.infile = infile
+        self.count_geometry = count_geometry
+        self.count_vertices = count_vertices
+        self.steps = []
+        self._last_counts = dict()
+
+    def _counts(self, cell):
+        key = (id(cell.layout()), cell.cell_index())
+        if key not in self._last_counts:
+            self._last_counts[key] = geometry_counts(cell, self.count_vertices)
+        return self._last_counts[key]
+
+    @contextmanager
+    def record(self, step_name, kwargs, cell, rdb=None):
+        ''' Wrap the call of one step on one cell '''
+        entry = objview(step=step_name, kwargs=dict(kwargs), cell=cell.name)
+        if self.count_geometry:
+            entry.polygons_in, entry.vertices_in = self._counts(cell)
+        if rdb is not None:
+            items_before = rdb.num_items()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        yield entry
+        entry.wall_time = time.perf_counter() - wall_start
+        entry.cpu_time = time.process_time() - cpu_start
+        entry.peak_rss_mb = peak_rss_mb()
+        if rdb is not None:
+            entry.markers = rdb.num_items() - items_before
+        if self.count_geometry:
+            self._last_counts.pop((id(cell.layout()), cell.cell_index()), None)
+            entry.polygons_out, entry.vertices_out = self._counts(cell)
+        self.steps.append(entry)
+
+    @property
+    def wall_time(self):
+        return sum(entry.wall_time for entry in self.steps)
+
+    @property
+    def cpu_time(self):
+        return sum(entry.cpu_time for entry in self.steps)
+
+    def to_dict(self):
+        return dict(ymlfile=self.ymlfile, infile=self.infile,
+                    wall_time=self.wall_time, cpu_time=self.cpu_time,
+                    steps=[dict(entry) for entry in self.steps])
+
+    def save(self, filename):
+        with open(filename, 'w') as fx:
+            json.dump(self.to_dict(), fx, indent=2, default=str)
+
+    def summary(self):
+        ''' A little table, slowest steps first '''
+        lines = ['{:>10} {:>10} {:>10}  {}'.format('wall [s]', 'cpu [s]', 'rss [MB]', 'step (cell)')]
+        for entry in sorted(self.steps, key=lambda e: e.wall_time, reverse=True):
+            rss = '-' if entry.peak_rss_mb is None else '{:.0f}'.format(entry.peak_rss_mb)
+            lines.append('{:10.3f} {:10.3f} {:>10}  {} ({})'.format(entry.wall_time, entry.cpu_time, rss, entry.step, entry.cell))
+        lines.append('{:10.3f} {:10.3f} {:>10}  total'.format(self.wall_time, self.cpu_time, ''))
+        return '\n'.join(lines)
+
+
+@contextmanager
+def record_step(profile, step_name, kwargs, cell, rdb=None):
+    ''' Same as profile.record, but does nothing if profile is None '''
+    if profile is None:
+        yield None
+    else:
+        with profile.record(step_name, kwargs, cell, rdb=rdb) as entry:
+            yield entry
@@ -0,0 +1,381 @@
+''' Running tiling jobs on worker processes, which can be on other machines.
+
+    Start a worker on each machine with "lymask worker --port 7420". Then give the processor step
+    remote_host: "machine1:7420, machine2:7420" (or a list). Workers on localhost are fine for testing.
+
+    RemoteTilingProcessor stands in for pya.TilingProcessor, so the fast_* functions, RuleBatch, and evaluate_regions
+    don't change. It cuts the extent into the usual tile grid and takes the shapes touching each tile and its border,
+    unclipped, like the TilingProcessor does. Each tile goes to a worker with the tiling script.
+    The worker runs the script with a TilingProcessor that has just that one tile, and sends the outputs back.
+    Tiles that have no input shapes are not sent, so scripts must not make something out of nothing (like _tile - in1).
+    Region outputs are the same after merging, but not the same polygons: a worker's one tile is the whole frame,
+    and the TilingProcessor lets outputs reach into the tile border at the edges of the frame.
+
+    Protocol, over TCP: every message is two 8 byte big-endian lengths, then a JSON header and a binary payload.
+    Requests have the script, tile, border, and input/output names in the header, and the input shapes as OASIS in the payload.
+    Replies have region outputs as OASIS and edge pairs as int64 arrays (x1, y1, x2, y2, x3, y3, x4, y4, symmetric).
+    There is no authentication. Only run workers on a network you trust.
+'''
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import json
+import socket
+import struct
+import tempfile
+import threading
+import traceback
+import socketserver
+from array import array
+import queue
+from lygadgets import pya, message, message_loud
+
+from lymask.tiling import TileInputs, tile_grid
+
+
+default_port = 7420
+#: Seconds to wait for a worker to connect. Tiles can take a long time, so replies have no timeout
+connect_timeout = 10
+#: A tile that loses its connection this many times is probably crashing the workers, so the job stops
+max_tile_attempts = 3
+_length_format = '>QQ'
+_length_size = struct.calcsize(_length_format)
+
+
+def parse_hosts(remote_host):
+    ''' "host:port, host2" or a list of them into [(host, port), ...]. None gives None '''
+    if remote_host is None:
+        return None
+    if isinstance(remote_host, str):
+        remote_host = remote_host.split(',')
+    hosts = []
+    for host in remote_host:
+        host = host.strip()
+        if ':' in host:
+            name, port = host.rsplit(':', 1)
+            hosts.append((name, int(port)))
+        elif host:
+            hosts.append((host, default_port))
+    if len(hosts) == 0:
+        raise ValueError('No remote hosts in {!r}'.format(remote_host))
+    return hosts
+
+
+def _send(sock, header, payload=b''):
+    header_bytes = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack(_length_format, len(header_bytes), len(payload)) + header_bytes)
+    sock.sendall(payload)
+
+
+def _receive_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 2 ** 20))
+        if not chunk:
+            raise ConnectionError('Connection closed in the middle of a message')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _receive(sock):
+    ''' Returns (header, payload), or (None, None) if the other end closed before a new message '''
+    first = sock.recv(_length_size)
+    if not first:
+        return None, None
+    lengths = first + _receive_exactly(sock, _length_size - len(first))
+    header_size, payload_size = struct.unpack(_length_format, lengths)
+    header = json.loads(_receive_exactly(sock, header_size).decode('utf-8'))
+    return header, _receive_exactly(sock, payload_size)
+
+
+def _layout_to_bytes(layout, format='OASIS'):
+    options = pya.SaveLayoutOptions()
+    options.format = format
+    if hasattr(layout, 'write_bytes'):
+        return layout.write_bytes(options)
+    # klayout < 0.29.9 only writes files
+    handle, filename = tempfile.mkstemp(suffix='.oas')
+    os.close(handle)
+    try:
+        layout.write(filename, options)
+        with open(filename, 'rb') as fx:
+            return fx.read()
+    finally:
+        os.remove(filename)
+
+
+def _layout_from_bytes(data):
+    layout = pya.Layout()
+    if hasattr(layout, 'read_bytes'):
+        layout.read_bytes(data)
+        return layout
+    handle, filename = tempfile.mkstemp(suffix='.oas')
+    try:
+        with os.fdopen(handle, 'wb') as fx:
+            fx.write(data)
+        layout.read(filename)
+    finally:
+        os.remove(filename)
+    return layout
+
+
+def _layer_region(layout, layer_number):
+    ''' A copy of the shapes of one layer in the top cell of a layout that came over the wire.
+        Not a Region of the layout itself, because that would be empty once the layout is gone
+    '''
+    layer_index = layout.find_layer(layer_number, 0)
+    if layer_index is None or layout.cells() == 0:
+        return pya.Region()
+    return pya.Region(layout.top_cell().shapes(layer_index))
+
+
+def _edge_pairs_to_bytes(edge_pairs):
+    values = array('q')
+    for ep in edge_pairs.each():
+        values.extend([ep.first.p1.x, ep.first.p1.y, ep.first.p2.x, ep.first.p2.y,
+                       ep.second.p1.x, ep.second.p1.y, ep.second.p2.x, ep.second.p2.y, int(ep.symmetric)])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _edge_pairs_from_bytes(data):
+    values = array('q')
+    values.frombytes(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    edge_pairs = pya.EdgePairs()
+    for i in range(0, len(values), 9):
+        x1, y1, x2, y2, x3, y3, x4, y4, symmetric = values[i:i + 9]
+        edge_pairs.insert(pya.EdgePair(pya.Edge(x1, y1, x2, y2), pya.Edge(x3, y3, x4, y4), bool(symmetric)))
+    return edge_pairs
+
+
+def run_tile(header, payload):
+    ''' What a worker does with one request. Returns the reply (header, payload) '''
+    dbu = header['dbu']
+    inputs = _layout_from_bytes(payload)
+    tp = pya.TilingProcessor()
+    tp.dbu = dbu
+    tp.frame = pya.DBox(*header['tile']) * dbu
+    tp.tiles(1, 1)
+    tp.tile_border(*header['border'])
+    regions = []  # the TilingProcessor does not keep them alive
+    for i_input, (name, merged_semantics) in enumerate(header['inputs']):
+        regions.append(_layer_region(inputs, i_input))
+        regions[-1].merged_semantics = merged_semantics
+        tp.input(name, regions[-1])
+    outputs = []
+    for name, kind in header['outputs']:
+        outputs.append(pya.Region() if kind == 'region' else pya.EdgePairs())
+        tp.output(name, outputs[-1])
+    tp.queue(header['script'])
+    tp.execute('Remote tile')
+
+    reply_layout = pya.Layout()
+    reply_layout.dbu = dbu
+    reply_cell = reply_layout.create_cell('TILE')
+    edge_pair_bytes = []
+    for i_output, ((name, kind), output) in enumerate(zip(header['outputs'], outputs)):
+        if kind == 'region':
+            reply_cell.shapes(reply_layout.layer(i_output, 0)).insert(output)
+        else:
+            edge_pair_bytes.append(_edge_pairs_to_bytes(output))
+    layout_bytes = _layout_to_bytes(reply_layout)
+    reply = dict(layout_size=len(layout_bytes), edge_pair_sizes=[len(data) for data in edge_pair_bytes])
+    return reply, layout_bytes + b''.join(edge_pair_bytes)
+
+
+class _TileHandler(socketserver.BaseRequestHandler):
+    ''' One connection can send any number of tiles, one at a time '''
+    def handle(self):
+        while True:
+            header, payload = _receive(self.request)
+            if header is None:
+                return
+            try:
+                reply, reply_payload = run_tile(header, payload)
+            except Exception:
+                reply, reply_payload = dict(error=traceback.format_exc()), b''
+            _send(self.request, reply, reply_payload)
+
+
+if hasattr(os, 'fork'):
+    # Each connection gets its own process, so one machine can work on several tiles at once
+    class _WorkerServer(socketserver.ForkingMixIn, socketserver.TCPServer):
+        allow_reuse_address = True
+else:
+    class _WorkerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+
+
+def serve(host='localhost', port=default_port):
+    ''' Runs a worker until it is interrupted. Use host '' or 0.0.0.0 to take tiles from other machines.
+        port 0 picks a free port. The address is printed when it is ready.
+    '''
+    server = _WorkerServer((host, port), _TileHandler)
+    try:
+        message('lymask worker listening on {}:{}'.format(*server.server_address[:2]))
+        sys.stdout.flush()
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class RemoteTilingProcessor(object):
+    ''' Has the parts of pya.TilingProcessor that lymask.library uses, but execute sends the tiles to workers.
+        threads is how many tiles each host gets at once
+    '''
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.dbu = .001
+        self.threads = 1
+        self._inputs = []
+        self._outputs = []
+        self._scripts = []
+        self._border = (0, 0)
+        self._tiles = (1, 1)
+
+    def input(self, name, region):
+        if not isinstance(region, pya.Region):
+            raise TypeError('Remote tiling only takes Region inputs, not {}'.format(type(region).__name__))
+        self._inputs.append((name, region))
+
+    def output(self, name, receiver):
+        if isinstance(receiver, pya.Region):
+            kind = 'region'
+        elif isinstance(receiver, pya.EdgePairs):
+            kind = 'edge_pairs'
+        else:
+            raise TypeError('Remote tiling only outputs to Region or EdgePairs, not {}'.format(type(receiver).__name__))
+        self._outputs.append((name, kind, receiver))
+
+    def queue(self, script):
+        self._scripts.append(script)
+
+    def tile_border(self, bx, by):
+        ''' In microns, like the TilingProcessor '''
+        self._border = (bx, by)
+
+    def tiles(self, nx, ny):
+        self._tiles = (nx, ny)
+
+    def execute(self, job_name='Remote tiling job'):
+        tile_inputs = TileInputs([region for name, region in self._inputs], self.dbu)
+        if tile_inputs.extent.empty():
+            return
+        header = dict(script='; '.join(self._scripts), dbu=self.dbu, border=list(self._border),
+                      inputs=[[name, region.merged_semantics] for name, region in self._inputs],
+                      outputs=[[name, kind] for name, kind, _ in self._outputs])
+        border_dbu = pya.Vector(int(round(self._border[0] / self.dbu)), int(round(self._border[1] / self.dbu)))
+        job = _RemoteJob(tile_inputs, header, tile_grid(tile_inputs.extent, *self._tiles), border_dbu)
+        replies = job.run(self.hosts, max(self.threads or 1, 1))
+
+        for i_tile in sorted(replies.keys()):
+            reply, payload = replies[i_tile]
+            region_layout = _layout_from_bytes(payload[:reply['layout_size']])
+            offset = reply['layout_size']
+            edge_pair_sizes = iter(reply['edge_pair_sizes'])
+            for i_output, (name, kind, receiver) in enumerate(self._outputs):
+                if kind == 'region':
+                    receiver.insert(_layer_region(region_layout, i_output))
+                else:
+                    size = next(edge_pair_sizes)
+                    receiver.insert(_edge_pairs_from_bytes(payload[offset:offset + size]))
+                    offset += size
+        message('{}: {} tiles on {} remote host(s)'.format(job_name, len(replies), len(self.hosts)))
+
+
+class _RemoteJob(object):
+    ''' The tiles of one execute, handed out to connections as they finish their last tile '''
+    def __init__(self, tile_inputs, header, tiles, border):
+        self.tile_inputs = tile_inputs
+        self.header = header
+        self.tiles = tiles
+        self.border = border
+        self.lock = threading.Lock()
+        self.replies = dict()
+        self.error = None
+        self.attempts = dict()
+
+    def _request(self, i_tile):
+        ''' The shapes touching the tile and its border, or None if there aren't any '''
+        tile = self.tiles[i_tile]
+        tile_layout = self.tile_inputs.cut(tile.enlarged(self.border))
+        if tile_layout is None:
+            return None
+        header = dict(self.header, tile=[tile.left, tile.bottom, tile.right, tile.top])
+        return header, _layout_to_bytes(tile_layout)
+
+    def run(self, hosts, connections_per_host):
+        ''' Returns {tile index: (reply header, reply payload)}. Tiles whose connection fails go to the others '''
+        pending = list(range(len(self.tiles)))
+        live_hosts = list(hosts)
+        while len(pending) > 0:
+            connections = []
+            for host in list(live_hosts):
+                for _ in range(connections_per_host):
+                    try:
+                        sock = socket.create_connection(host, timeout=connect_timeout)
+                    except socket.error as err:
+                        message_loud('Could not connect to lymask worker at {}:{}: {}'.format(host[0], host[1], err))
+                        live_hosts.remove(host)
+                        break
+                    sock.settimeout(None)
+                    connections.append((host, sock))
+            if len(connections) == 0:
+                raise RuntimeError('No lymask workers left with {} tiles to go'.format(len(pending)))
+            to_do = queue.Queue()
+            for i_tile in pending:
+                to_do.put(i_tile)
+            failed = []
+            threads = [threading.Thread(target=self._work, args=(host, sock, to_do, failed)) for host, sock in connections]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if self.error is not None:
+                raise RuntimeError('A lymask worker failed on a tile:\n' + self.error)
+            for i_tile in failed:
+                if self.attempts[i_tile] >= max_tile_attempts:
+                    raise RuntimeError('Tile {} lost its lymask worker {} times. '
+                                       'Look at the worker logs'.format(self.tiles[i_tile], self.attempts[i_tile]))
+            # Whatever was not taken because connections died along the way
+            while not to_do.empty():
+                failed.append(to_do.get())
+            pending = failed
+        return self.replies
+
+    def _work(self, host, sock, to_do, failed):
+        try:
+            while self.error is None:
+                try:
+                    i_tile = to_do.get_nowait()
+                except queue.Empty:
+                    return
+                with self.lock:
+                    request = self._request(i_tile)
+                if request is None:
+                    continue
+                try:
+                    _send(sock, *request)
+                    reply, reply_payload = _receive(sock)
+                    if reply is None:
+                        raise ConnectionError('Worker closed the connection')
+                except socket.error as err:
+                    message_loud('Lost lymask worker at {}:{}: {}'.format(host[0], host[1], err))
+                    with self.lock:
+                        failed.append(i_tile)
+                        self.attempts[i_tile] = self.attempts.get(i_tile, 0) + 1
+                    return
+                with self.lock:
+                    if 'error' in reply:
+                        self.error = reply['error']
+                    else:
+                        self.replies[i_tile] = (reply, reply_payload)
+        finally:
+            sock.close()
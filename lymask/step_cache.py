@@ -0,0 +1,146 @@
+''' On-disk cache of dataprep step results, so that a rerun can skip the steps that have not changed
+
+    Each step gets a key that hashes the input file, the technology, and the names and kwargs of every step up to and including it.
+    Python files that steps come from are hashed in too: add_library files, and the source of any step that is not part of lymask.
+    After a step runs, the layers that it wrote are saved under that key.
+    On a rerun, the steps with saved results are loaded instead of run, until the first step whose key is new.
+
+    Written layers are the ones the step passed to invalidate_regions.
+    If a step invalidated every layer of a cell (flatten, align_corners, steps from add_library), the whole layout is saved.
+    So is every step that wrote something in hierarchical mode.
+    Steps that wrote nothing (processor, check_floorplan with a floorplan present) run again every time,
+    because they can have other effects such as setting the thread count.
+'''
+from __future__ import division, print_function, absolute_import
+import os
+import json
+import hashlib
+import inspect
+from lygadgets import pya
+
+from lymask import __version__
+from lymask.utilities import lys
+from lymask.library import layer_versions, invalidate_regions, is_hierarchical
+from lymask.dataprep_steps import find_library
+
+
+def file_hash(filename):
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as fx:
+        for chunk in iter(lambda: fx.read(2 ** 20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class StepCache(object):
+    ''' Keys are chained: call step_key once per step, in order '''
+    def __init__(self, cache_dir, infile, tech_name=None, layer_infos=None):
+        ''' layer_infos are the layers that were read from infile, if not all of them '''
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        if layer_infos is not None:
+            layer_infos = [str(layer_info) for layer_info in layer_infos]
+        input_info = [__version__, tech_name, file_hash(infile), layer_infos]
+        self.key = hashlib.sha256(json.dumps(input_info).encode()).hexdigest()
+        self._source_hashes = dict()
+
+    def step_key(self, func_name, kwargs, func=None):
+        ''' func is the step function. If it is given, editing the file it comes from changes the key '''
+        step_info = json.dumps([self.key, func_name, kwargs, self._source_hash(func_name, kwargs, func)],
+                               sort_keys=True, default=str)
+        self.key = hashlib.sha256(step_info.encode()).hexdigest()
+        return self.key
+
+    def _source_hash(self, func_name, kwargs, func):
+        source_files = []
+        if func_name == 'add_library':
+            source_files.append(find_library(**kwargs))
+        if func is not None and not func.__module__.startswith('lymask.'):
+            source_files.append(inspect.getsourcefile(inspect.unwrap(func)))
+        hashes = []
+        for source_file in source_files:
+            if source_file not in self._source_hashes:
+                self._source_hashes[source_file] = file_hash(source_file)
+            hashes.append(self._source_hashes[source_file])
+        return hashes
+
+    def _path(self, key, extension):
+        return os.path.join(self.cache_dir, key + extension)
+
+    def lookup(self, key):
+        ''' The record of a step that ran before, or None '''
+        try:
+            with open(self._path(key, '.json')) as fx:
+                return json.load(fx)
+        except (IOError, ValueError):
+            return None
+
+    def store(self, layout, key, func_name, versions_before):
+        ''' Saves what the step wrote. versions_before is layer_versions() from before the step '''
+        written = set()
+        full = False
+        for version_key, version in layer_versions().items():
+            layout_ref, cell_index, pya_layer = version_key
+            if layout_ref() is not layout or versions_before.get(version_key) == version:
+                continue
+            written.add((cell_index, pya_layer))
+        for cell_index in set(cell_index for cell_index, _ in written):
+            if all((cell_index, pya_layer) in written for pya_layer in layout.layer_indexes()):
+                full = True
+        # Layer snapshots only have the top cells, and in hierarchical mode steps write to the cells below too
+        full = full or (len(written) > 0 and is_hierarchical())
+        record = dict(step=func_name)
+        if full:
+            record['kind'] = 'layout'
+            layout.write(self._path(key, '.oas'))
+        elif len(written) > 0:
+            record['kind'] = 'layers'
+            pya_layers = sorted(set(pya_layer for _, pya_layer in written))
+            record['layers'] = [_info_to_list(layout.get_info(pya_layer)) for pya_layer in pya_layers]
+            snapshot = pya.Layout()
+            snapshot.dbu = layout.dbu
+            for top_index in layout.each_top_cell():
+                cell = layout.cell(top_index)
+                snapshot_cell = snapshot.create_cell(cell.name)
+                for pya_layer in pya_layers:
+                    snapshot_layer = snapshot.layer(layout.get_info(pya_layer))
+                    snapshot_cell.shapes(snapshot_layer).insert(cell.shapes(pya_layer))
+            snapshot.write(self._path(key, '.oas'))
+        else:
+            record['kind'] = 'none'
+        # The record goes last, so an interrupted write is a miss, not a half-loaded step
+        with open(self._path(key, '.json'), 'w') as fx:
+            json.dump(record, fx)
+
+    def restore(self, layout, record, key):
+        ''' Puts the saved results of a step into the layout '''
+        if record['kind'] == 'layout':
+            layout.clear()
+            layout.read(self._path(key, '.oas'))
+            lys.forget_indexes()  # the layer indexes of the layout are new
+        else:
+            snapshot = pya.Layout()
+            snapshot.read(self._path(key, '.oas'))
+            named_infos = [_list_to_info(info_list) for info_list in record['layers']]
+            for layer_info in named_infos:
+                pya_layer = layout.layer(layer_info)
+                snapshot_layer = snapshot.find_layer(layer_info)
+                for top_index in layout.each_top_cell():
+                    cell = layout.cell(top_index)
+                    cell.clear(pya_layer)
+                    snapshot_cell = snapshot.cell(cell.name)
+                    if snapshot_layer is not None and snapshot_cell is not None:
+                        cell.shapes(pya_layer).insert(snapshot_cell.shapes(snapshot_layer))
+            # Steps like mask_map add layers to the layer set as well as the layout
+            for layer_info in named_infos:
+                if layer_info.name and layer_info.name not in lys.keys():
+                    lys[layer_info.name] = layer_info
+        invalidate_regions()
+
+
+def _info_to_list(layer_info):
+    return [layer_info.layer, layer_info.datatype, layer_info.name]
+
+
+def _list_to_info(info_list):
+    return pya.LayerInfo(*info_list)
@@ -0,0 +1,113 @@
+''' Compiling a YAML deck into a plan: the steps, with their functions looked up and their arguments checked
+
+    Compiling checks every step name and its keyword arguments, so a typo fails before any geometry work
+    instead of after the long steps. Libraries from add_library are imported while compiling, so their steps get checked too.
+    Plans are remembered by the hash of the deck, so a deck is parsed and checked once per process.
+    The key also has the active technology and the folder of the deck,
+    because relative add_library files can be found in different places for the same deck.
+'''
+from __future__ import division, print_function, absolute_import
+import os
+import inspect
+import hashlib
+import yaml
+from lygadgets import message_loud
+
+from lymask.utilities import func_info_to_func_and_kwargs, objview, active_technology
+from lymask.dataprep_steps import all_dpfunc_dict, import_library
+from lymask.drc_steps import all_drcfunc_dict
+
+try:
+    _Loader = yaml.CFullLoader  # libyaml is much faster for big generated decks
+except AttributeError:
+    _Loader = yaml.FullLoader
+
+
+class StepPlan(object):
+    ''' A checked list of steps. Each one is an objview with
+
+            name: the step name in the deck
+            func: the step function
+            kwargs: a dict, even if the deck gave none
+            layers: strings in the arguments, which might be layer names, sorted
+
+        category is 'dataprep' or 'drc'. DRC plans always start with make_rdbcells.
+    '''
+    def __init__(self, step_list, category='dataprep', ymlfile=None):
+        self.category = category
+        self.ymlfile = ymlfile
+        #: Full path to modification time of each add_library file, so the plan can tell if it is out of date
+        self.libraries = dict()
+        func_dict = all_drcfunc_dict if category == 'drc' else all_dpfunc_dict
+        step_list = list(step_list or [])
+        if category == 'drc' and (len(step_list) == 0 or func_info_to_func_and_kwargs(step_list[0])[0] != 'make_rdbcells'):
+            step_list.insert(0, 'make_rdbcells')
+        self.steps = []
+        for func_info in step_list:
+            func_name, kwargs = func_info_to_func_and_kwargs(func_info)
+            kwargs = dict(kwargs or {})
+            if func_name == 'add_library':
+                library_file = import_library(**kwargs)
+                self.libraries[library_file] = os.path.getmtime(library_file)
+            try:
+                func = func_dict[func_name]
+            except KeyError:
+                message_loud('Function "{}" not supported. Available are {}'.format(func_name, func_dict.keys()))
+                raise
+            _assert_valid_kwargs(func, func_name, kwargs, category)
+            self.steps.append(objview(name=func_name, func=func, kwargs=kwargs, layers=_string_args(kwargs)))
+
+    @property
+    def step_list(self):
+        ''' The steps in the form of the deck, for functions that take those '''
+        return [{step.name: step.kwargs} for step in self.steps]
+
+    def is_current(self):
+        ''' False if one of its libraries has changed since it was compiled '''
+        for library_file, mtime in self.libraries.items():
+            if not os.path.isfile(library_file) or os.path.getmtime(library_file) != mtime:
+                return False
+        return True
+
+
+_signatures = dict()
+def _assert_valid_kwargs(func, func_name, kwargs, category):
+    cell_args = (None, None) if category == 'drc' else (None,)  # DRC steps also get the rdb
+    try:
+        signature = _signatures[func]
+    except KeyError:
+        try:
+            signature = inspect.signature(func)
+        except ValueError:
+            signature = None  # no signature to check, such as a builtin
+        _signatures[func] = signature
+    if signature is None:
+        return
+    try:
+        signature.bind(*cell_args, **kwargs)
+    except TypeError as err:
+        message_loud('Step "{}" can not take {}: {}'.format(func_name, kwargs, err))
+        raise TypeError('Step "{}" can not take {}: {}'.format(func_name, kwargs, err))
+
+
+def _string_args(kwargs):
+    strings = set()
+    for arg in kwargs.values():
+        for maybe_layer in (arg if isinstance(arg, (list, tuple)) else [arg]):
+            if isinstance(maybe_layer, str):
+                strings.add(maybe_layer)
+    return sorted(strings)
+
+
+_plans = dict()
+def compile_plan(ymlfile, category='dataprep'):
+    ''' The StepPlan of a deck file. It is compiled again only if the file or its libraries change '''
+    with open(ymlfile, 'rb') as fx:
+        deck_bytes = fx.read()
+    tech_name = getattr(active_technology(), 'name', None)
+    key = (category, hashlib.sha256(deck_bytes).hexdigest(), tech_name, os.path.dirname(os.path.realpath(ymlfile)))
+    plan = _plans.get(key)
+    if plan is None or not plan.is_current():
+        plan = StepPlan(yaml.load(deck_bytes, Loader=_Loader), category, ymlfile)
+        _plans[key] = plan
+    return plan
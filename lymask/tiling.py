@@ -0,0 +1,192 @@
+''' Deciding how to tile a job based on where the geometry actually is.
+
+    Dies are mostly empty with a few dense clusters. An N x N grid over the full extent
+    puts a whole cluster in one tile, so one thread does all of the work while the rest do nothing.
+    The planner builds a quadtree of polygon density, splitting only the nodes that are too heavy for one thread,
+    then picks the tile pitch that it thinks will finish soonest with the available threads.
+
+    The TilingProcessor only does uniform grids, so empty areas can't be skipped outright.
+    They still get tiles, but an empty tile only costs the fixed per-tile overhead, and that is part of the cost estimate.
+'''
+from __future__ import division, print_function, absolute_import
+import math
+import os
+from lygadgets import pya
+
+
+#: The first survey splits the extent into this many bins per side
+survey_bins = 32
+#: Later surveys split heavy nodes into this many bins per side
+refine_bins = 4
+#: Stop splitting quadtree nodes when they are this deep
+max_depth = 4
+#: A node is split if it holds more than 1 / (split_factor * threads) of everything
+split_factor = 4
+#: Below this many polygons, the survey costs more than it saves
+small_job = 10000
+#: Cost of one tile, even an empty one, in units of polygons processed (about 70 us)
+tile_overhead = 20
+#: Tiles are not allowed to be smaller than this many tile borders
+min_tile_borders = 4
+#: Upper limit on tiles per side
+max_tiles_per_side = 256
+
+
+def cpu_count():
+    return os.cpu_count() or 1
+
+
+class _CountReceiver(pya.TileOutputReceiver):
+    ''' Puts the number that each tile outputs into a list of lists '''
+    def __init__(self, counts):
+        self.counts = counts
+
+    def put(self, ix, iy, tile, obj, dbu, clip):
+        self.counts[ix][iy] += obj
+
+
+def density_map(regions, frame, bins=survey_bins, dbu=.001):
+    ''' Number of polygons touching each bin of a bins x bins grid over frame (a pya.Box in database units).
+        Returns a list indexed [ix][iy]. The survey is itself a tiling job, so it is native.
+        It runs in one thread because starting threads takes longer than counting.
+    '''
+    counts = [[0] * bins for _ in range(bins)]
+    receiver = _CountReceiver(counts)
+    tp = pya.TilingProcessor()
+    tp.dbu = dbu
+    tp.frame = frame.to_dtype(dbu)
+    tp.output('counts', receiver)
+    for i_input, region in enumerate(regions):
+        tp.input('in{}'.format(i_input + 1), region)
+        tp.queue('_output(counts, in{}.count)'.format(i_input + 1))
+    tp.tiles(bins, bins)
+    tp.execute('Density survey')
+    return counts
+
+
+def density_quadtree(regions, extent, target, min_size=0, dbu=.001):
+    ''' Leaves of a quadtree over extent, as a list of (pya.Box, polygon count).
+        Nodes holding more than target are surveyed again at finer resolution. Empty leaves are left out.
+    '''
+    raw_regions = []
+    for region in regions:
+        raw_region = region.dup()
+        raw_region.merged_semantics = False  # counting does not need merging
+        raw_regions.append(raw_region)
+    leaves = []
+    to_split = [(extent, 0, raw_regions)]
+    while len(to_split) > 0:
+        node, depth, parent_regions = to_split.pop()
+        if depth == 0:
+            bins = survey_bins
+            node_regions = parent_regions
+        else:
+            # only look at what is in this node, so refining does not cost as much as the first survey
+            bins = refine_bins
+            node_box = pya.Region(node)
+            node_regions = [region.interacting(node_box) for region in parent_regions]
+        counts = density_map(node_regions, node, bins, dbu)
+        bin_w = node.width() / bins
+        bin_h = node.height() / bins
+        for ix in range(bins):
+            for iy in range(bins):
+                if counts[ix][iy] == 0:
+                    continue
+                child = pya.Box(int(node.left + ix * bin_w), int(node.bottom + iy * bin_h),
+                                int(node.left + (ix + 1) * bin_w), int(node.bottom + (iy + 1) * bin_h))
+                if counts[ix][iy] > target and depth + 1 < max_depth and min(bin_w, bin_h) / refine_bins > min_size:
+                    to_split.append((child, depth + 1, node_regions))
+                else:
+                    leaves.append((child, counts[ix][iy]))
+    return leaves
+
+
+def plan_tiles(regions, border=0, thread_count=None, dbu=.001):
+    ''' Returns (nx, ny) for TilingProcessor.tiles.
+        regions are the inputs of the job. border is the tile border in database units.
+    '''
+    thread_count = thread_count or 1
+    even_split = math.ceil(math.sqrt(thread_count))
+    extent = pya.Box()
+    total = 0
+    for region in regions:
+        extent += region.bbox()
+        total += region.count()
+    if extent.empty() or total < small_job:
+        return even_split, even_split
+
+    border = abs(border)
+    min_pitch = max(min_tile_borders * border, 1)
+    # Finer than this, the overhead of all of the tiles would be more than the work itself
+    useful_pitch = max(extent.width(), extent.height()) / math.sqrt(total / tile_overhead)
+    leaves = density_quadtree(regions, extent, total / (split_factor * thread_count), max(min_pitch, useful_pitch), dbu)
+    if len(leaves) == 0:
+        return even_split, even_split
+
+    # Go down the quadtree levels of a uniform grid and estimate how long each would take
+    best_cost, best_tiles = None, (even_split, even_split)
+    n_side = 1
+    while n_side <= max_tiles_per_side:
+        pitch = max(extent.width(), extent.height()) / n_side
+        if n_side > 1 and pitch < min_pitch:
+            break
+        nx = max(1, math.ceil(extent.width() / pitch))
+        ny = max(1, math.ceil(extent.height() / pitch))
+        border_factor = ((pitch + 2 * border) / pitch) ** 2  # each tile also processes its border
+        loads = dict()
+        for leaf, count in leaves:
+            # spread a leaf evenly over the tiles it covers
+            ix0 = min(int((leaf.left - extent.left) / pitch), nx - 1)
+            ix1 = min(int((leaf.right - extent.left) / pitch), nx - 1)
+            iy0 = min(int((leaf.bottom - extent.bottom) / pitch), ny - 1)
+            iy1 = min(int((leaf.top - extent.bottom) / pitch), ny - 1)
+            share = count * border_factor / ((ix1 - ix0 + 1) * (iy1 - iy0 + 1))
+            for tx in range(ix0, ix1 + 1):
+                for ty in range(iy0, iy1 + 1):
+                    loads[tx, ty] = loads.get((tx, ty), 0) + share
+        balanced_load = sum(loads.values()) / thread_count
+        work = max(max(loads.values()), balanced_load)
+        cost = work + nx * ny * tile_overhead / thread_count
+        if best_cost is None or cost < best_cost:
+            best_cost, best_tiles = cost, (nx, ny)
+        elif work == balanced_load:
+            # Threads are already evenly loaded, so finer tiles only add overhead
+            break
+        n_side *= 2
+    return best_tiles
+
+
+def tile_grid(extent, nx, ny):
+    ''' The boxes of an nx by ny grid that covers extent exactly '''
+    xs = [extent.left + int(round(i * extent.width() / nx)) for i in range(nx + 1)]
+    ys = [extent.bottom + int(round(j * extent.height() / ny)) for j in range(ny + 1)]
+    return [pya.Box(xs[i], ys[j], xs[i + 1], ys[j + 1]) for i in range(nx) for j in range(ny)]
+
+
+class TileInputs(object):
+    ''' Regions cut up for tiles outside of the TilingProcessor, but the way it does it:
+        a tile gets every shape that touches the tile or its border, unclipped.
+        The regions are copied into a layout first, so that each tile is a lookup in its spatial index.
+    '''
+    def __init__(self, regions, dbu=.001):
+        self.layout = pya.Layout()
+        self.layout.dbu = dbu
+        self._cell = self.layout.create_cell('TILE_INPUTS')
+        self._layers = []
+        self.extent = pya.Box()
+        for i_region, region in enumerate(regions):
+            self._layers.append(self.layout.layer(i_region, 0))
+            self._cell.shapes(self._layers[-1]).insert(region)
+            self.extent += region.bbox()
+
+    def cut(self, box):
+        ''' A layout with the shapes of region i that touch box on layer (i, 0). None if there aren't any '''
+        tile_layout = pya.Layout()
+        tile_layout.dbu = self.layout.dbu
+        tile_cell = tile_layout.create_cell('TILE')
+        empty = True
+        for i_region, layer_index in enumerate(self._layers):
+            shapes = tile_cell.shapes(tile_layout.layer(i_region, 0))
+            shapes.insert(self._cell.begin_shapes_rec_touching(layer_index, box))
+            empty = empty and shapes.is_empty()
+        return None if empty else tile_layout
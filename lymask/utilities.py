@@ -1,6 +1,10 @@
 from __future__ import division, print_function, absolute_import
 import os
+import json
+import hashlib
 import yaml
+import threading
+from contextlib import contextmanager
 from lygadgets import isGUI, pya, message, message_loud, lyp_to_layerlist, patch_environment
 from lygadgets.technology import Technology, klayout_last_open_technology
 from lygadgets.gui_objects import gui_view, gui_active_technology
@@ -69,13 +73,25 @@ def tech_dataprep_layer_properties(pya_tech=None):
     '''
     pya_tech = resolve_pya_tech(pya_tech)
     dataprep_path = pya_tech.eff_path('dataprep')
+    try:
+        walk_key = (dataprep_path, os.path.getmtime(dataprep_path))
+    except OSError:
+        walk_key = None
+    lyp_file = _dataprep_lyp_files.get(walk_key)
+    if lyp_file is not None and os.path.isfile(lyp_file):
+        return lyp_file
     for root, dirnames, filenames in os.walk(dataprep_path, followlinks=True):
         for filename in filenames:
             if filename.endswith('.lyp'):
-                return os.path.join(root, filename)
+                lyp_file = os.path.join(root, filename)
+                _dataprep_lyp_files[walk_key] = lyp_file
+                return lyp_file
     else:
         return tech_layer_properties()
 
+#: What tech_dataprep_layer_properties found, keyed by (dataprep directory, its mtime)
+_dataprep_lyp_files = dict()
+
 
 def func_info_to_func_and_kwargs(func_info):
     ''' There are several ways to specify commands in the YML file. This parses them into function name and arguments
@@ -128,9 +144,26 @@ class LayerSet(dict):
 
             for layname in lys.keys():
                 lay = lys[layname]
+
+        Looked up layer indexes are remembered, so a repeated name is a dict hit.
+        They are forgotten when active_layout or the layer changes.
+        Call forget_indexes if the layers of the layout change some other way, such as Layout.clear.
     '''
     active_layout = None
 
+    @property
+    def _indexes(self):
+        return self.__dict__.setdefault('_index_cache', dict())
+
+    def forget_indexes(self):
+        self._indexes.clear()
+
+    def for_layout(self, layout):
+        ''' A new LayerSet with the same layers, looking them up in layout '''
+        new_obj = LayerSet(self.items())
+        new_obj.active_layout = layout
+        return new_obj
+
     def __call__(self, *args, **kwargs):
         return self.__getitem__(args[0])
 
@@ -141,6 +174,7 @@ class LayerSet(dict):
     def __setattr__(self, attrname, val):
         if attrname in ['active_layout']:  # exceptions
             self.__dict__[attrname] = val
+            self.forget_indexes()
         else:
             self.__setitem__(attrname, val)
 
@@ -160,6 +194,11 @@ class LayerSet(dict):
         return val
 
     def __getitem__(self, item):
+        if type(item) is str:
+            try:
+                return self._indexes[item]
+            except KeyError:
+                pass
         val = self.get_as_LayerInfo(item)
         try:
             answer = self.active_layout.layer(val)
@@ -167,6 +206,8 @@ class LayerSet(dict):
             if "no attribute 'layer'" in err.args[0]:
                 err.args = ('You didn\'t set active_layout for this LayerSet, so you can not get items from it', )
             raise
+        if type(item) is str:
+            self._indexes[item] = answer
         return answer
 
     def __setitem__(self, key, value):
@@ -177,23 +218,21 @@ class LayerSet(dict):
         if not value.is_named():
             value.name = key
         dict.__setitem__(self, key, value)
+        self._indexes.pop(key, None)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._indexes.pop(key, None)
+
+    def clear(self):
+        dict.clear(self)
+        self.forget_indexes()
 
     @classmethod
     def fromFile(cls, filename):
         new_obj = cls()
-        all_layers = lyp_to_layerlist(filename)
-        for one_layer in all_layers:
-            try:
-                group_members = one_layer['group-members']
-            except KeyError:  # it is a real layer
-                short_name = name2shortName(one_layer['name'])
-                new_obj[short_name] = source2pyaLayerInfo(one_layer['source'])
-            else:  # it is a group
-                if not isinstance(group_members, list):
-                    group_members = [group_members]
-                for memb in group_members:
-                    short_name = name2shortName(memb['name'])
-                    new_obj[short_name] = source2pyaLayerInfo(memb['source'])
+        for name, source in lyp_layer_sources(filename):
+            new_obj[name2shortName(name)] = source2pyaLayerInfo(source)
         return new_obj
 
     def append(self, other, doubles_ok=False):
@@ -209,6 +248,64 @@ class LayerSet(dict):
         self.append(other, doubles_ok=True)
 
 
+#: Parsed lyp files are saved here, so the XML is not parsed again until the file changes.
+#: Off (None) unless the LYMASK_CACHE environment variable names a folder, for example ~/.cache/lymask
+lyp_cache_dir = os.environ.get('LYMASK_CACHE') or None
+_lyp_sources = dict()
+
+
+def _parse_lyp_sources(filename):
+    sources = []
+    for one_layer in lyp_to_layerlist(filename):
+        try:
+            group_members = one_layer['group-members']
+        except KeyError:  # it is a real layer
+            sources.append((one_layer['name'], one_layer['source']))
+        else:  # it is a group
+            if not isinstance(group_members, list):
+                group_members = [group_members]
+            for memb in group_members:
+                sources.append((memb['name'], memb['source']))
+    return sources
+
+
+def lyp_layer_sources(filename):
+    ''' (name, source) of every layer in the lyp file, including group members, in order.
+        Remembered in memory and in lyp_cache_dir, keyed by the path, modification time, and size of the file.
+    '''
+    filename = os.path.realpath(filename)
+    stat = os.stat(filename)
+    key = [filename, stat.st_mtime_ns, stat.st_size]
+    try:
+        return _lyp_sources[tuple(key)]
+    except KeyError:
+        pass
+    sources = None
+    if lyp_cache_dir is not None:
+        cache_file = os.path.join(lyp_cache_dir, 'lyp-' + hashlib.sha256(filename.encode()).hexdigest()[:32] + '.json')
+        try:
+            with open(cache_file) as fx:
+                record = json.load(fx)
+            if record['key'] == key:
+                sources = [tuple(name_source) for name_source in record['sources']]
+        except (IOError, ValueError, KeyError):
+            pass
+    if sources is None:
+        sources = _parse_lyp_sources(filename)
+        if lyp_cache_dir is not None:
+            try:
+                os.makedirs(lyp_cache_dir, exist_ok=True)
+                # Written to the side and moved, so other processes never read half of it
+                temp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+                with open(temp_file, 'w') as fx:
+                    json.dump(dict(key=key, sources=sources), fx)
+                os.replace(temp_file, cache_file)
+            except OSError:
+                pass  # it is just slower next time
+    _lyp_sources[tuple(key)] = sources
+    return sources
+
+
 def name2shortName(name_str):
     ''' Good to have this function separate because
         it may differ for different naming conventions.
@@ -233,7 +330,69 @@ def source2pyaLayerInfo(source_str):
     return pya.LayerInfo(int(layer), int(datatype))
 
 
-lys = LayerSet()
+class ActiveLayerSet(object):
+    ''' The type of lys. It passes everything through to the LayerSet of the layer_context
+        that this thread is in, or to the default LayerSet outside of any context.
+        That way, steps can keep using lys while several layouts are processed in different threads.
+    '''
+    def __init__(self, default):
+        object.__setattr__(self, '_default', default)
+
+    def _current(self):
+        layer_set = getattr(_thread_layers, 'layer_set', None)
+        return self._default if layer_set is None else layer_set
+
+    def __getattr__(self, attrname):
+        return getattr(self._current(), attrname)
+
+    def __setattr__(self, attrname, val):
+        setattr(self._current(), attrname, val)
+
+    def __delattr__(self, attrname):
+        delattr(self._current(), attrname)
+
+    def __call__(self, *args, **kwargs):
+        return self._current()(*args, **kwargs)
+
+    def __getitem__(self, item):
+        return self._current()[item]
+
+    def __setitem__(self, key, value):
+        self._current()[key] = value
+
+    def __delitem__(self, key):
+        del self._current()[key]
+
+    def __contains__(self, key):
+        return key in self._current()
+
+    def __iter__(self):
+        return iter(self._current())
+
+    def __len__(self):
+        return len(self._current())
+
+    def __repr__(self):
+        return repr(self._current())
+
+
+_thread_layers = threading.local()
+lys = ActiveLayerSet(LayerSet())
+
+
+@contextmanager
+def layer_context(layout):
+    ''' Within this context, lys looks up layers in layout, for this thread only.
+        It starts with the layers that lys has when entering. Layers added within the context are dropped when it exits.
+    '''
+    outer = getattr(_thread_layers, 'layer_set', None)
+    _thread_layers.layer_set = lys._current().for_layout(layout)
+    try:
+        yield _thread_layers.layer_set
+    finally:
+        _thread_layers.layer_set = outer
+
+
 def reload_lys(technology=None, clear=False, dataprep=False):
     ''' Updates lys from the lyp files. Also updates the layer display in GUI mode.
         If any of the layers are already there, it does nothing.
@@ -2,3 +2,5 @@ import os
 
 test_dir = os.path.realpath(os.path.dirname(__file__))
 os.environ['KLAYOUT_HOME'] = test_dir
+# The suite does not write lyp caches into the home folder, even if they are turned on
+os.environ.pop('LYMASK_CACHE', None)
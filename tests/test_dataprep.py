@@ -1,4 +1,7 @@
 import os, sys
+import json
+import shutil
+import threading
 import subprocess
 import pytest
 import pya
@@ -36,6 +39,32 @@ def test_lyp_loading():
         batch_main(layout_file, ymlspec='bad_masks', technology='lymask_example_tech')
 
 
+def test_lyp_cache(tmp_path):
+    import shutil
+    from lymask import utilities
+    from lymask.utilities import LayerSet
+    lyp_file = str(tmp_path / 'layers.lyp')
+    shutil.copy(os.path.join(test_dir, 'tech', 'lymask_example_tech', 'klayout_layers_example.lyp'), lyp_file)
+    orig_cache_dir = utilities.lyp_cache_dir
+    assert orig_cache_dir is None  # off unless LYMASK_CACHE is set
+    utilities.lyp_cache_dir = str(tmp_path / 'cache')
+    try:
+        parsed = dict(LayerSet.fromFile(lyp_file))
+        assert len(os.listdir(utilities.lyp_cache_dir)) == 1
+        utilities._lyp_sources.clear()  # like a new process
+        assert dict(LayerSet.fromFile(lyp_file)) == parsed
+        # an edited file is parsed again
+        with open(lyp_file) as fx:
+            lyp_text = fx.read()
+        with open(lyp_file, 'w') as fx:
+            fx.write(lyp_text.replace('m5_wiring', 'm5_renamed'))
+        os.utime(lyp_file, ns=(0, 0))
+        edited = LayerSet.fromFile(lyp_file)
+        assert 'm5_renamed' in edited and 'm5_wiring' not in edited
+    finally:
+        utilities.lyp_cache_dir = orig_cache_dir
+
+
 def test_from_technology():
     batch_main(layout_file, ymlspec='default', outfile=outfile, technology='lymask_example_tech')
     run_xor(outfile, reffile)
@@ -50,3 +79,505 @@ def test_cm_from_tech():
     subprocess.check_call(command)
     run_xor(outfile, reffile)
 
+
+
+def test_startup():
+    # importing should not load klayout or the technologies. For how long startup takes, see benchmarks.startup
+    loaded = subprocess.check_output([sys.executable, '-c', 'import sys, lymask; print("pya" in sys.modules)'])
+    assert loaded.decode().strip() == 'False'
+    for args in [['--version'], ['-h']]:
+        subprocess.check_output(['lymask'] + args)
+    proc = subprocess.Popen(['lymask', 'dataprep', layout_file, '-o', outfile, '-t', 'lymask_example_tech'],
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    for line in proc.stdout:
+        if line.startswith('lymask doing'):
+            break
+    else:
+        raise AssertionError('No step was started')
+    proc.stdout.read()
+    assert proc.wait() == 0
+
+
+def test_region_cache():
+    from lymask.utilities import lys
+    from lymask import library
+    from lymask.library import as_region, invalidate_regions, region_cache
+    lymask.set_active_technology('lymask_example_tech')
+    layout = pya.Layout()
+    layout.read(layout_file)
+    lys.active_layout = layout
+    lymask.utilities.reload_lys(dataprep=True)
+    cell = layout.top_cell()
+    cell.flatten(True)
+
+    raw = pya.Region(cell.shapes(lys.wg_deep))
+    raw.merged_semantics = False
+    sized = raw.sized(100)
+    assert sized.count() == raw.count()
+    with region_cache(layout):
+        first = as_region(cell, 'wg_deep')
+        first.size(1000)  # callers get a copy, so this should not leak into the cache
+        assert (as_region(cell, 'wg_deep') ^ raw.merged()).is_empty()
+
+        # same shape count, different shapes: only invalidation catches this
+        cell.clear(lys.wg_deep)
+        cell.shapes(lys.wg_deep).insert(sized)
+        invalidate_regions(cell, 'wg_deep')
+        assert (as_region(cell, 'wg_deep') ^ sized.merged()).is_empty()
+    assert len(library._region_cache) == 0
+
+    # outside of a region_cache, nothing is remembered, so that rewrite shows up without invalidating
+    as_region(cell, 'wg_deep')
+    cell.clear(lys.wg_deep)
+    cell.shapes(lys.wg_deep).insert(raw)
+    assert (as_region(cell, 'wg_deep') ^ raw.merged()).is_empty()
+
+
+def test_derived_memo():
+    from lymask.utilities import lys
+    from lymask import library
+    from lymask.library import smoothed_layer, invalidate_regions, region_cache
+    lymask.set_active_technology('lymask_example_tech')
+    layout = pya.Layout()
+    layout.read(layout_file)
+    lys.active_layout = layout
+    lymask.utilities.reload_lys(dataprep=True)
+    cell = layout.top_cell()
+    cell.flatten(True)
+
+    invalidate_regions()
+    with region_cache(layout):
+        first = smoothed_layer(cell, 'm2_nw')
+        first.size(1000)  # a copy again
+        assert len(library._derived_cache) == 1
+        second = smoothed_layer(cell, 'm2_nw')
+        assert len(library._derived_cache) == 1
+        assert (second ^ library.fast_smoothed(library.as_region(cell, 'm2_nw'))).is_empty()
+
+        cell.clear(lys.m2_nw)
+        invalidate_regions(cell, 'm2_nw')
+        assert len(library._derived_cache) == 0
+        assert smoothed_layer(cell, 'm2_nw').is_empty()
+
+        smoothed_layer(cell, 'wg_deep')
+        library.set_derived_limit(0)
+        try:
+            assert len(library._derived_cache) == 0
+        finally:
+            library.set_derived_limit(500)
+
+
+def test_profile():
+    report_file = os.path.join(test_dir, '1_profile_run.json')
+    profile = batch_main(layout_file, ymlspec='default', outfile=outfile, technology='lymask_example_tech',
+                         profile=report_file)
+    step_names = [entry.step for entry in profile.steps]
+    assert step_names[:3] == ['processor', 'flatten', 'check_floorplan']
+    for entry in profile.steps:
+        assert entry.wall_time >= 0
+        assert entry.polygons_out >= 0
+    ground_plane = profile.steps[step_names.index('ground_plane')]
+    assert ground_plane.polygons_out > ground_plane.polygons_in
+    assert ground_plane.vertices_out is None  # that one is opt-in
+
+    from lymask.profiling import geometry_counts
+    result = pya.Layout()
+    result.read(outfile)
+    polygons, vertices = geometry_counts(result.top_cell(), vertices=True)
+    assert polygons == geometry_counts(result.top_cell())[0] > 0
+    assert vertices >= 3 * polygons
+    # each unique cell is counted once, times how many times it is placed
+    array_layout = pya.Layout()
+    top, child = array_layout.create_cell('TOP'), array_layout.create_cell('CHILD')
+    child.shapes(array_layout.layer(1, 0)).insert(pya.Box(0, 0, 100, 100))
+    child.shapes(array_layout.layer(2, 0)).insert(pya.Box(0, 0, 50, 50))
+    child.shapes(array_layout.layer(2, 0)).insert(pya.Text('not counted', 0, 0))
+    top.insert(pya.CellInstArray(child.cell_index(), pya.Trans(), pya.Vector(200, 0), pya.Vector(0, 200), 10, 10))
+    assert geometry_counts(top, vertices=True) == (200, 800)
+    with open(report_file) as fx:
+        assert len(json.load(fx)['steps']) == len(profile.steps)
+
+
+def test_deferred():
+    from lymask import library
+    from lymask.library import deferred, evaluate_regions
+    wires = pya.Region()
+    for i in range(40):
+        wires.insert(pya.Box(i * 3000, 0, i * 3000 + 500, 200000))
+    pads = pya.Region(pya.Box(-10000, 90000, 130000, 110000))
+
+    fp = wires.sized(1000) - pads.sized(3000)
+    expected_sleeve = (fp.sized(2000) + pads) - wires
+    expected_core = fp.sized(-200) & pads.sized(5000)
+
+    library.set_threads(4, tiles=3)
+    try:
+        fused = deferred(wires).sized(1000) - deferred(pads).sized(3000)
+        sleeve = (fused.sized(2000) + deferred(pads)) - deferred(wires)
+        core = fused.sized(-200) & deferred(pads).sized(5000)
+        sleeve, core = evaluate_regions([sleeve, core])
+    finally:
+        library.set_threads(None)
+    assert (sleeve ^ expected_sleeve).is_empty()
+    assert (core ^ expected_core).is_empty()
+
+    # smoothing gets the same polygons as without tiles, not pieces cut at the seams
+    wavy = pya.Region()
+    for i in range(40):
+        wavy.insert(pya.Polygon([pya.Point(i * 3000 + 3 * (j % 2), j * 5000) for j in range(41)] +
+                                [pya.Point(i * 3000 + 500, 200000), pya.Point(i * 3000 + 500, 0)]))
+    expected_smooth = library._normal_smoothed(wavy.sized(1000) + pads, 0.01)
+    library.set_threads(4, tiles=3)
+    try:
+        smooth = (deferred(wavy).sized(1000) + deferred(pads)).smoothed(0.01).value
+    finally:
+        library.set_threads(None)
+    assert sorted(str(polygon) for polygon in smooth.each()) == sorted(str(polygon) for polygon in expected_smooth.each())
+
+
+def test_smoothed_regions():
+    from lymask import library
+    from lymask.library import smoothed_regions
+    rings, dots = pya.Region(), pya.Region()
+    for i in range(30):
+        # polygons that cross tiles, with near-straight edges to smooth away
+        rings.insert(pya.Polygon([pya.Point(0, i * 4000), pya.Point(60000, i * 4000 + 3), pya.Point(120000, i * 4000),
+                                  pya.Point(120000, i * 4000 + 2000), pya.Point(0, i * 4000 + 2000)]))
+        for j in range(30):
+            dots.insert(pya.Box(j * 4000, i * 4000 + 2500, j * 4000 + 1000, i * 4000 + 3500))
+    expected = [library._normal_smoothed(region, 0.01) for region in [rings, dots]]
+
+    library.set_threads(4, tiles=3)
+    try:
+        smoothed = smoothed_regions([rings, pya.Region(), dots], 0.01)
+    finally:
+        library.set_threads(None)
+    assert smoothed[1].is_empty()
+    for region, expected_region in zip([smoothed[0], smoothed[2]], expected):
+        assert region.count() == expected_region.count()
+        assert (region ^ expected_region).is_empty()
+
+    # overlapping polygons are smoothed one by one, not merged first. One tile is the same as none
+    overlapping = pya.Region()
+    for i in range(30):
+        for j in range(40):
+            overlapping.insert(pya.Polygon([pya.Point(j * 3000, i * 4000), pya.Point(j * 3000 + 2000, i * 4000 + 3),
+                                            pya.Point(j * 3000 + 4000, i * 4000), pya.Point(j * 3000 + 4000, i * 4000 + 2000),
+                                            pya.Point(j * 3000, i * 4000 + 2000)]))
+    expected = library._normal_smoothed(overlapping, 0.01)
+    for tiles in [3, 1]:
+        library.set_threads(2, tiles=tiles)
+        try:
+            smoothed = smoothed_regions([overlapping], 0.01)[0]
+        finally:
+            library.set_threads(None)
+        assert sorted(str(polygon) for polygon in smoothed.each()) == sorted(str(polygon) for polygon in expected.each())
+
+
+def test_tiled_dataprep(tmp_path):
+    # the masks do not depend on how many threads or tiles there are, other than snapping to the grid
+    with open(dataprep_file) as fx:
+        deck = fx.read()
+    layouts = []
+    for i_run, processor in enumerate(['thread_count: 1', 'thread_count: 2, tiles: 3', 'thread_count: 2, tiles: 1']):
+        deck_file = str(tmp_path / 'deck{}.yml'.format(i_run))
+        with open(deck_file, 'w') as fx:
+            fx.write(deck.replace('processor: {thread_count: 1}', 'processor: {{{}}}'.format(processor)))
+        output = str(tmp_path / 'out{}.oas'.format(i_run))
+        batch_main(layout_file, ymlspec=deck_file, outfile=output, technology='lymask_example_tech')
+        layouts.append(pya.Layout())
+        layouts[-1].read(output)
+    untiled = layouts[0]
+    for layout in layouts[1:]:
+        for layer_index in untiled.layer_indexes():
+            layer_info = untiled.get_info(layer_index)
+            region1 = pya.Region(untiled.top_cell().shapes(layer_index))
+            region2 = pya.Region(layout.top_cell().shapes(layout.layer(layer_info)))
+            # where sizing is cut at a seam, the corner can snap to the grid differently
+            assert (region1 ^ region2).sized(-1).is_empty(), layer_info
+
+
+def test_tile_map(tmp_path):
+    import importlib.util
+    from lymask import library
+    # like add_library, the file is run but not importable by name
+    library_file = str(tmp_path / 'my_tiled_steps.py')
+    with open(library_file, 'w') as fx:
+        fx.write('def ring(region, keepout, width):\n    return region.sized(width) - region - keepout\n')
+    spec = importlib.util.spec_from_file_location('my_tiled_steps', library_file)
+    my_tiled_steps = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(my_tiled_steps)
+
+    wires, keepout = pya.Region(), pya.Region()
+    for i in range(40):
+        wires.insert(pya.Box(0, i * 3000, 100000, i * 3000 + 1000))  # crossing every tile
+        keepout.insert(pya.Box(i * 2500, 0, i * 2500 + 500, 120000))
+    expected = my_tiled_steps.ring(wires, keepout, 300)
+
+    library.set_threads(2, tiles=3)
+    try:
+        tiled = library.tile_map(my_tiled_steps.ring, [wires, keepout], border=600, args=(300,))
+        with pytest.raises(ValueError):
+            library.tile_map(lambda region: region, [wires])
+    finally:
+        library.set_threads(None)
+    assert (tiled ^ expected).is_empty()
+    assert tiled.count() == expected.count()
+
+
+def test_paths_and_texts():
+    from lymask.utilities import lys, layer_context
+    from lymask.dataprep_steps import paths_to_polys, erase_text_and_other_junk
+    lymask.set_active_technology('lymask_example_tech')
+    layout = pya.Layout()
+    top = layout.create_cell('TOP')
+    child = layout.create_cell('CHILD')
+    top.insert(pya.CellInstArray(child.cell_index(), pya.Trans(0, 5000)))
+    wg_path = pya.Path([pya.Point(0, 0), pya.Point(10000, 0), pya.Point(10000, 8000)], 500)
+    with layer_context(layout):
+        for cell in [top, child]:
+            cell.shapes(lys['wg_deep']).insert(wg_path)
+            cell.shapes(lys['wg_deep']).insert(pya.Text('label', 0, 0))
+        net_path = pya.Path([pya.Point(0, 20000), pya.Point(10000, 20000)], 500)
+        top.shapes(lys['wg_deep']).insert(net_path, layout.properties_id({'net': 'bus'}))
+        paths_to_polys(top)
+        erase_text_and_other_junk(top)
+        for cell in [top, child]:
+            shapes = [shape for shape in cell.shapes(lys['wg_deep']).each() if shape.prop_id == 0]
+            assert len(shapes) == 1
+            assert shapes[0].is_polygon()
+            assert shapes[0].polygon == wg_path.polygon()
+        # properties go along with the conversion
+        net_shapes = [shape for shape in top.shapes(lys['wg_deep']).each() if shape.prop_id != 0]
+        assert len(net_shapes) == 1 and net_shapes[0].is_polygon()
+        assert net_shapes[0].polygon == net_path.polygon()
+        assert net_shapes[0].properties() == {'net': 'bus'}
+
+
+def test_step_cache(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    uncached = str(tmp_path / 'uncached.oas')
+    batch_main(layout_file, ymlspec='default', outfile=uncached, technology='lymask_example_tech')
+    for i_run in range(2):
+        profile = batch_main(layout_file, ymlspec='default', outfile=outfile, technology='lymask_example_tech',
+                             profile=True, cache_dir=cache_dir)
+        ran = [entry.step for entry in profile.steps]
+        if i_run == 0:
+            assert 'ground_plane' in ran
+        else:
+            # only steps that write nothing run again
+            assert ran == ['processor']
+        layout1, layout2 = pya.Layout(), pya.Layout()
+        layout1.read(uncached)
+        layout2.read(outfile)
+        for layer_index in layout1.layer_indexes():
+            layer_info = layout1.get_info(layer_index)
+            region1 = pya.Region(layout1.top_cell().shapes(layer_index))
+            region2 = pya.Region(layout2.top_cell().shapes(layout2.layer(layer_info)))
+            assert (region1 ^ region2).is_empty(), layer_info
+        # mask_map named the layer, even when it came from the cache
+        assert layout2.find_layer(pya.LayerInfo('mask_wg_ebeam')) is not None
+
+    # editing a library file changes the keys from its add_library on, so its steps run again
+    library_file = str(tmp_path / 'my_steps.py')
+    deck_file = str(tmp_path / 'deck.yml')
+    with open(deck_file, 'w') as fx:
+        fx.write('- add_library: {{filename: {}}}\n- my_step\n'.format(library_file))
+    for box_size, expected in [(1000, ['add_library', 'my_step']),
+                               (1000, ['add_library']),
+                               (2000, ['add_library', 'my_step'])]:
+        with open(library_file, 'w') as fx:
+            fx.write('from lygadgets import pya\nfrom lymask.dataprep_steps import dpStep\n\n'
+                     '@dpStep\ndef my_step(cell):\n'
+                     '    cell.shapes(cell.layout().layer(1, 0)).insert(pya.Box(0, 0, {0}, {0}))\n'.format(box_size))
+        profile = batch_main(layout_file, ymlspec=deck_file, outfile=outfile, technology='lymask_example_tech',
+                             profile=True, cache_dir=cache_dir)
+        assert [entry.step for entry in profile.steps] == expected
+
+
+def test_phidl_session(tmp_path):
+    pytest.importorskip('phidl')
+    library_file = str(tmp_path / 'my_phidl_steps.py')
+    with open(library_file, 'w') as fx:
+        fx.write('import phidl.geometry as pg\n'
+                 'from lymask.utilities import lys\n'
+                 'from lymask.dataprep_steps import dpStep_phidl, dpLayers\n\n'
+                 'def spec(layname):\n'
+                 '    layer_info = lys.get_as_LayerInfo(layname)\n'
+                 '    return (layer_info.layer, layer_info.datatype)\n\n'
+                 "@dpLayers(reads=lambda kwargs: [kwargs['source']], writes=lambda kwargs: [kwargs['target']])\n"
+                 '@dpStep_phidl\n'
+                 'def phidl_grow(device, source, target, distance):\n'
+                 '    grown = pg.offset(pg.extract(device, layers=[spec(source)]), distance=distance, layer=spec(target))\n'
+                 '    device.remove_layers(layers=[spec(target)])\n'
+                 '    device.add_ref(grown)\n')
+    steps = ['add_library: {{filename: {}}}'.format(library_file),
+             'phidl_grow: {source: wg_deep, target: wg_full_photo, distance: 0.5}',
+             'phidl_grow: {source: wg_full_photo, target: wg_full_photo, distance: 0.5}']
+    # the two steps share a Device. In the baseline, flatten between them sends each one through the layout
+    outputs = []
+    for name, deck in [('shared', steps), ('baseline', steps[:2] + ['flatten'] + steps[2:])]:
+        deck_file = str(tmp_path / (name + '.yml'))
+        with open(deck_file, 'w') as fx:
+            fx.write(''.join('- {}\n'.format(step) for step in ['flatten'] + deck))
+        outputs.append(str(tmp_path / (name + '.oas')))
+        batch_main(layout_file, ymlspec=deck_file, outfile=outputs[-1], technology='lymask_example_tech')
+    source, shared, baseline = pya.Layout(), pya.Layout(), pya.Layout()
+    source.read(layout_file)
+    source.top_cell().flatten(True)
+    shared.read(outputs[0])
+    baseline.read(outputs[1])
+    def layer_region(layout, layer_info):
+        return pya.Region(layout.top_cell().begin_shapes_rec(layout.layer(layer_info)))
+    grown_layer = pya.LayerInfo(219, 0)
+    assert not layer_region(shared, grown_layer).is_empty()
+    assert (layer_region(shared, grown_layer) ^ layer_region(baseline, grown_layer)).is_empty()
+    # layers that were only read are not written back
+    for layer_info in [pya.LayerInfo(22, 0), pya.LayerInfo(16, 0)]:
+        assert (layer_region(shared, layer_info) ^ layer_region(source, layer_info)).is_empty(), layer_info
+        assert shared.top_cell().shapes(shared.layer(layer_info)).size() == source.top_cell().shapes(source.layer(layer_info)).size()
+
+
+def test_hierarchical(tmp_path):
+    from lymask import library
+    layout = pya.Layout()
+    layout.read(layout_file)
+    unit_cell = layout.top_cell()
+    unit_bbox = unit_cell.bbox()
+    arrayed = layout.create_cell('ARRAY')
+    pitch = 2 * max(unit_bbox.width(), unit_bbox.height())
+    arrayed.insert(pya.CellInstArray(unit_cell.cell_index(), pya.Trans(), pya.Vector(pitch, 0), pya.Vector(0, pitch), 2, 1))
+    array_file = str(tmp_path / 'array.oas')
+    layout.write(array_file)
+    flat_file, hier_file = str(tmp_path / 'flat.oas'), str(tmp_path / 'hier.oas')
+    batch_main(array_file, ymlspec='default', outfile=flat_file, technology='lymask_example_tech')
+    batch_main(array_file, ymlspec='hierarchical', outfile=hier_file, technology='lymask_example_tech')
+    assert not library.is_hierarchical()  # the processor step only lasts for its run
+
+    flat, hier = pya.Layout(), pya.Layout()
+    flat.read(flat_file)
+    hier.read(hier_file)
+    assert flat.cells() == 1 and hier.cells() == layout.cells()
+    for layer_info, tolerance in [('m2_nw_ebeam', 0), ('m2_nw_photo', 0), ('FLOORPLAN', 0),
+                                  (pya.LayerInfo(22, 0), 3)]:  # precomp sized wg_deep per cell, so allow rounding
+        layer_info = pya.LayerInfo(layer_info) if isinstance(layer_info, str) else layer_info
+        flat_region = pya.Region(flat.top_cell().begin_shapes_rec(flat.find_layer(layer_info)))
+        hier_region = pya.Region(hier.top_cell().begin_shapes_rec(hier.find_layer(layer_info)))
+        assert not flat_region.is_empty()
+        assert (flat_region ^ hier_region).sized(-tolerance).is_empty(), layer_info
+
+
+def test_mask_output(tmp_path):
+    from lymask.mask_writer import write_split_masks
+    masks_file = str(tmp_path / 'masks.oas')
+    batch_main(layout_file, ymlspec='default', outfile=outfile, technology='lymask_example_tech')
+    batch_main(layout_file, ymlspec='default', outfile=masks_file, technology='lymask_example_tech', masks_only=True)
+    full, masks = pya.Layout(), pya.Layout()
+    full.read(outfile)
+    masks.read(masks_file)
+    mask_infos = [masks.get_info(layer_index) for layer_index in masks.layer_indexes()]
+    assert sorted(info.layer for info in mask_infos) == [99, 101, 102, 103, 104, 105]
+    for layer_info in mask_infos:
+        region1 = pya.Region(full.top_cell().shapes(full.find_layer(layer_info)))
+        region2 = pya.Region(masks.top_cell().shapes(masks.find_layer(layer_info)))
+        assert (region1 ^ region2).is_empty()
+
+    # GDS has no layer names, so a FLOORPLAN that comes from one is found by its number
+    gds_file = str(tmp_path / 'src.gds')
+    source = pya.Layout()
+    source.read(layout_file)
+    source.top_cell().shapes(source.layer(99, 0)).insert(source.top_cell().bbox().enlarged(10000, 10000))
+    source.write(gds_file)
+    batch_main(gds_file, ymlspec='default', outfile=masks_file, technology='lymask_example_tech', masks_only=True)
+    gds_masks = pya.Layout()
+    gds_masks.read(masks_file)
+    assert sorted(gds_masks.get_info(layer_index).layer for layer_index in gds_masks.layer_indexes()) == [99, 101, 102, 103, 104, 105]
+
+    split_files = write_split_masks(masks, str(tmp_path / 'split.oas'), processes=2)
+    assert len(split_files) == 5
+    one_mask = pya.Layout()
+    one_mask.read(str(tmp_path / 'split_mask_wg_ebeam.oas'))
+    assert [str(one_mask.get_info(layer_index)) for layer_index in one_mask.layer_indexes()] == ['mask_wg_ebeam (103/0)']
+
+
+def test_layer_liveness():
+    from lymask.utilities import lys, reload_lys
+    from lymask.dataprep_steps import layer_liveness, is_mask_name
+    lymask.set_active_technology('lymask_example_tech')
+    reload_lys(dataprep=True)
+    steps = ['flatten',
+             {'waveguide_sleeve': {'Delta': 2.5}},
+             {'mask_map': {'mask_wg_ebeam': 'wg_full_ebeam'}},
+             'align_corners']
+    dead = layer_liveness(steps, is_mask_name)
+    assert 'wg_full_ebeam' in dead[0]  # replaced by waveguide_sleeve before anything reads it
+    assert 'wg_deep' in dead[2] and 'wg_full_ebeam' not in dead[2]
+    assert 'wg_full_ebeam' in dead[3]
+    assert not any('FLOORPLAN' in step_dead or 'mask_wg_ebeam' in step_dead for step_dead in dead)
+    # every layer goes to the output by default
+    assert not any(layer_liveness(steps)[2:])
+    # steps that don't declare their layers might read anything
+    assert 'wg_deep' not in layer_liveness(['flatten', 'some_library_step'], is_mask_name)[1]
+
+
+def test_layer_context():
+    from lymask.utilities import lys, layer_context
+    from lymask.invocation import _main, resolve_ymlspec
+    ymlfile = resolve_ymlspec('default', 'lymask_example_tech')
+    serial = pya.Layout()
+    serial.read(layout_file)
+    _main(serial, ymlfile)
+    layouts = [pya.Layout(), pya.Layout()]
+    layouts[1].layer(pya.LayerInfo(999, 0))  # so that the layer indexes are different
+    for layout in layouts:
+        layout.read(layout_file)
+    with layer_context(layouts[1]):
+        assert lys['wg_deep'] == layouts[1].find_layer(lys.get_as_LayerInfo('wg_deep'))
+        with layer_context(layouts[0]):
+            assert lys['wg_deep'] == layouts[0].find_layer(lys.get_as_LayerInfo('wg_deep'))
+        assert lys['wg_deep'] == layouts[1].find_layer(lys.get_as_LayerInfo('wg_deep'))
+
+    threads = [threading.Thread(target=_main, args=(layout, ymlfile)) for layout in layouts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for layout in layouts:
+        for layer_index in serial.layer_indexes():
+            layer_info = serial.get_info(layer_index)
+            region1 = pya.Region(serial.top_cell().shapes(layer_index))
+            region2 = pya.Region(layout.top_cell().shapes(layout.layer(layer_info)))
+            assert (region1 ^ region2).is_empty(), layer_info
+    # layers added by the steps stay in their context
+    assert 'mask_wg_ebeam' not in lys
+
+
+def test_step_plan(tmp_path):
+    from lymask.step_plan import compile_plan
+    plan = compile_plan(dataprep_file)
+    assert compile_plan(dataprep_file) is plan
+    # the same deck somewhere else is another plan, since its libraries could be too
+    os.makedirs(str(tmp_path / 'elsewhere'))
+    moved_file = str(tmp_path / 'elsewhere' / 'default.yml')
+    shutil.copyfile(dataprep_file, moved_file)
+    assert compile_plan(moved_file).ymlfile == moved_file
+    assert [step.name for step in plan.steps][:2] == ['processor', 'flatten']
+    assert plan.steps[1].kwargs == dict()
+    assert 'wg_full_ebeam' in plan.steps[7].layers
+
+    # mistakes are found before reading any layout, including in steps from libraries
+    library_file = str(tmp_path / 'my_steps.py')
+    with open(library_file, 'w') as fx:
+        fx.write('from lymask.dataprep_steps import dpStep\n\n'
+                 '@dpStep\ndef my_step(cell, size=1):\n    pass\n')
+    deck_file = str(tmp_path / 'deck.yml')
+    for step_text, error in [('my_step: {size: 2}', None),
+                             ('my_step: {sise: 2}', TypeError),
+                             ('my_stepp', KeyError)]:
+        with open(deck_file, 'w') as fx:
+            fx.write('- add_library: {{filename: {}}}\n- {}\n'.format(library_file, step_text))
+        if error is None:
+            assert compile_plan(deck_file).steps[1].kwargs == dict(size=2)
+        else:
+            with pytest.raises(error):
+                compile_plan(deck_file)
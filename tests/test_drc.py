@@ -1,6 +1,8 @@
 import os, sys
+import threading
 import subprocess
 import xmltodict
+import pya
 from collections import OrderedDict
 
 import lymask
@@ -76,3 +78,257 @@ def test_multithreaded():
     batch_drc_main(layout_file, ymlspec='multithreaded', outfile=outfile_multithread, technology='lymask_example_tech')
     assert_equal(outfile_multithread, reffile)
 
+
+
+def test_multithreaded_profile():
+    # Batched checks run after their steps, but the markers should still be credited to the steps that made them
+    serial = batch_drc_main(layout_file, ymlspec='default', outfile=outfile, technology='lymask_example_tech', profile=True)
+    threaded = batch_drc_main(layout_file, ymlspec='multithreaded', outfile=outfile_multithread,
+                              technology='lymask_example_tech', profile=True)
+    def step_markers(profile):
+        return [(entry.step, entry.markers) for entry in profile.steps if entry.step != 'batched_rules']
+    assert step_markers(threaded) == step_markers(serial)
+    assert dict(step_markers(threaded))['inclusion'] > 0
+    assert 'batched_rules' in [entry.step for entry in threaded.steps]
+
+
+def test_readonly_stages():
+    from lymask.invocation import _drc_stages
+    from lymask.step_plan import StepPlan
+    step_list = ['make_rdbcells',
+                 {'processor': {'thread_count': 2}},
+                 {'width': {'layer': 'wg_deep', 'value': 0.2}},
+                 {'space': {'layer': 'wg_deep', 'value': 0.2}},
+                 {'drcX': {'on_input': ['v3']}},
+                 {'inclusion': {'inner': 'v3', 'outer': 'wg_deep', 'include': 0.1}},
+                 {'exclusion': {'lay1': 'm5_wiring', 'lay2': 'wg_deep', 'exclude': 0.5}}]
+    stage_names = [[func_name for func_name, _ in stage] for stage in _drc_stages(StepPlan(step_list, 'drc').steps)]
+    assert stage_names == [['make_rdbcells'], ['processor'], ['width', 'space'], ['drcX'], ['inclusion', 'exclusion']]
+
+
+def test_hierarchical():
+    outfile_hier = os.path.join(test_dir, '2_drc_hierarchical_run.lyrdb')
+    batch_drc_main(layout_file, ymlspec='default', outfile=outfile, technology='lymask_example_tech')
+    batch_drc_main(layout_file, ymlspec='hierarchical', outfile=outfile_hier, technology='lymask_example_tech')
+    assert_equal(outfile_hier, outfile)
+
+    # Now array the whole thing. Every instance should get its own top-level markers
+    layout = pya.Layout()
+    layout.read(layout_file)
+    unit_cell = layout.top_cell()
+    unit_bbox = unit_cell.bbox()
+    arrayed = layout.create_cell('ARRAY')
+    pitch = 2 * max(unit_bbox.width(), unit_bbox.height())
+    arrayed.insert(pya.CellInstArray(unit_cell.cell_index(), pya.Trans(),
+                                     pya.Vector(pitch, 0), pya.Vector(0, pitch), 3, 2))
+    array_file = os.path.join(test_dir, '2_drc_array_run.oas')
+    layout.write(array_file)
+    batch_drc_main(array_file, ymlspec='hierarchical', outfile=outfile_hier, technology='lymask_example_tech')
+
+    rdb_single = pya.ReportDatabase()
+    rdb_single.load(outfile)
+    rdb_arrayed = pya.ReportDatabase()
+    rdb_arrayed.load(outfile_hier)
+    assert rdb_arrayed.num_items() == 6 * rdb_single.num_items()
+
+
+def test_flat_then_hierarchical(tmp_path):
+    # Nothing from one run should leak into the next, so alternating flat and hierarchical runs in one process agree
+    from lymask import library
+    layout = pya.Layout()
+    layout.read(layout_file)
+    unit_cell = layout.top_cell()
+    unit_bbox = unit_cell.bbox()
+    arrayed = layout.create_cell('ARRAY')
+    pitch = 2 * max(unit_bbox.width(), unit_bbox.height())
+    arrayed.insert(pya.CellInstArray(unit_cell.cell_index(), pya.Trans(),
+                                     pya.Vector(pitch, 0), pya.Vector(0, pitch), 3, 2))
+    array_file = str(tmp_path / 'array.oas')
+    layout.write(array_file)
+
+    def category_counts(rdb_file):
+        rdb = pya.ReportDatabase()
+        rdb.load(rdb_file)
+        return {category.name(): category.num_items() for category in rdb.each_category()}
+
+    flat_file, hier_file = str(tmp_path / 'flat.lyrdb'), str(tmp_path / 'hier.lyrdb')
+    for _ in range(2):
+        batch_drc_main(layout_file, ymlspec='default', outfile=flat_file, technology='lymask_example_tech')
+        batch_drc_main(array_file, ymlspec='hierarchical', outfile=hier_file, technology='lymask_example_tech')
+        flat_counts, hier_counts = category_counts(flat_file), category_counts(hier_file)
+        assert flat_counts['v3 in wg_deep'] > 0
+        assert hier_counts == {name: 6 * count for name, count in flat_counts.items()}
+        assert not library.is_hierarchical()
+        assert len(library._region_cache) == 0
+
+
+def test_exclude_edge_pairs():
+    from lymask.library import _edge_pairs_not_touching
+    edge_pairs = pya.EdgePairs()
+    edge_pairs.insert(pya.EdgePair(pya.Edge(0, 0, 0, 100), pya.Edge(50, 100, 50, 0)))
+    edge_pairs.insert(pya.EdgePair(pya.Edge(1000, 0, 1000, 100), pya.Edge(1050, 100, 1050, 0)))
+    exclude = pya.Region(pya.Box(-10, 40, 0, 60))  # touches the first edge of the first pair
+    exclude.insert(pya.Box(1020, 40, 1030, 60))  # sits between the edges of the second pair, but does not touch
+    assert _edge_pairs_not_touching(edge_pairs, exclude).count() == 1
+
+
+def test_auto_tiles():
+    from lymask import library
+    from lymask.tiling import plan_tiles
+    # a dense cluster of wires at one corner of a mostly empty area
+    cluster = pya.Region()
+    for i in range(120):
+        for j in range(120):
+            cluster.insert(pya.Box(i * 300, j * 300, i * 300 + 200 + (i % 3) * 30, j * 300 + 150))
+    cluster.insert(pya.Box(2000000, 2000000, 2000100, 2000100))
+    nx, ny = plan_tiles([cluster], border=100, thread_count=16)
+    assert nx * ny >= 16
+
+    library.set_threads(16, tiles='auto')
+    try:
+        tiled_space = library.fast_space(cluster, 120)
+        tiled_sized = library.fast_sized(cluster, 60)
+    finally:
+        library.set_threads(None)
+    assert tiled_space.count() == cluster.space_check(120, False, library.Projection, 90).count()
+    assert (tiled_sized ^ cluster.sized(60)).is_empty()
+
+    # a large border makes the tiles so big that there is only one. Scripts still have a _tile
+    big_border = 100000
+    assert plan_tiles([cluster], border=big_border, thread_count=16) == (1, 1)
+    library.set_threads(16, tiles='auto')
+    try:
+        tp = pya.TilingProcessor()
+        tile_region = pya.Region()
+        tp.input('in1', cluster)
+        tp.output('out1', tile_region)
+        tp.queue('_output(out1, _tile & in1.bbox)')
+        assert library._setup_tiles(tp, [cluster], big_border) == (1, 1)
+        tp.execute('One tile job')
+    finally:
+        library.set_threads(None)
+    assert (tile_region ^ pya.Region(cluster.bbox())).is_empty()
+
+
+def test_many_files(tmp_path):
+    infiles = []
+    for die_name in ['die1', 'die2']:
+        infiles.append(str(tmp_path / (die_name + '.oas')))
+        layout = pya.Layout()
+        layout.read(layout_file)
+        layout.write(infiles[-1])
+    batch_drc_main(layout_file, ymlspec='default', outfile=outfile, technology='lymask_example_tech')
+    results = batch_drc_main(str(tmp_path / 'die*.oas'), ymlspec='default', outfile=str(tmp_path / 'out'),
+                             technology='lymask_example_tech', processes=2)
+    assert [result.infile for result in results] == infiles
+    for result in results:
+        assert result.error is None
+        assert os.path.dirname(result.outfile) == str(tmp_path / 'out')
+        assert_equal(result.outfile, outfile)
+
+
+def test_deck_layers(tmp_path):
+    from lymask.invocation import _deck_layers, _read_layout, resolve_ymlspec
+    from lymask.utilities import active_technology
+    extra_file = str(tmp_path / 'annotated.oas')
+    layout = pya.Layout()
+    layout.read(layout_file)
+    layout.top_cell().shapes(layout.layer(63, 0)).insert(pya.Box(0, 0, 1000, 1000))
+    layout.write(extra_file)
+
+    ymlfile = resolve_ymlspec('default', 'lymask_example_tech', category='drc')
+    layer_infos = _deck_layers(ymlfile, active_technology(), 'drc')
+    read_layers = [(info.layer, info.datatype) for info in layer_infos]
+    assert (63, 0) not in read_layers and (91, 0) in read_layers
+    sparse = _read_layout(extra_file, layer_infos)
+    assert sparse.find_layer(63, 0) is None
+
+    batch_drc_main(layout_file, ymlspec='default', outfile=outfile, technology='lymask_example_tech')
+    extra_outfile = str(tmp_path / 'annotated.lyrdb')
+    batch_drc_main(extra_file, ymlspec='default', outfile=extra_outfile, technology='lymask_example_tech')
+    assert_equal(extra_outfile, outfile)
+
+
+def test_result_formats(tmp_path):
+    from lymask.drc_results import query_markers, first_marker_layer
+    batch_drc_main(layout_file, ymlspec='default', outfile=outfile, technology='lymask_example_tech')
+    rdb = pya.ReportDatabase()
+    rdb.load(outfile)
+    expected = dict()
+    for category in rdb.each_category():
+        values = [value for item in rdb.each_item_per_category(category.rdb_id()) for value in item.each_value()]
+        expected[category.name()] = sorted(str(value).split(': ', 1)[1] for value in values)  # like 'edge-pair: (...)'
+    assert sum(len(markers) for markers in expected.values()) > 0
+
+    sqlite_file = str(tmp_path / 'markers.sqlite')
+    batch_drc_main(layout_file, ymlspec='default', outfile=sqlite_file, technology='lymask_example_tech')
+    stored = dict()
+    for category_name, cell_name, shape in query_markers(sqlite_file):
+        stored.setdefault(category_name, []).append(shape)
+    assert {name: sorted(shapes) for name, shapes in stored.items()} == {name: shapes for name, shapes in expected.items() if shapes}
+    category_name, cell_name, shape = query_markers(sqlite_file)[0]
+    box = pya.DEdgePair.from_s(shape).bbox()
+    assert (category_name, cell_name, shape) in query_markers(sqlite_file, box=box, category=category_name)
+    assert query_markers(sqlite_file, box=pya.DBox(-1e6, -1e6, -1e6 + 1, -1e6 + 1)) == []
+
+    oasis_file = str(tmp_path / 'markers.oas')
+    batch_drc_main(layout_file, ymlspec='default', outfile=oasis_file, technology='lymask_example_tech')
+    markers = pya.Layout()
+    markers.read(oasis_file)
+    for i_category, category in enumerate(rdb.each_category()):
+        marker_layer = markers.find_layer(first_marker_layer + i_category, 0)
+        assert markers.get_info(marker_layer).name == category.name().replace(' ', '_')
+        assert markers.top_cell().shapes(marker_layer).size() == len(expected[category.name()])
+
+
+def test_remote_workers(tmp_path):
+    command = [sys.executable, '-c', 'import sys; from lymask.command_line import cm_worker; cm_worker(sys.argv[1:])', '--port', '0']
+    worker = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        address = worker.stdout.readline().split()[-1]  # like "lymask worker listening on 127.0.0.1:40123"
+        with open(drc_file) as fx:
+            deck = fx.read()
+        remote_drc_file = str(tmp_path / 'remote.yml')
+        with open(remote_drc_file, 'w') as fx:
+            fx.write(deck.replace('{thread_count: 1}', '{{thread_count: 2, tiles: 4, remote_host: "{}"}}'.format(address)))
+        batch_drc_main(layout_file, ymlspec='default', outfile=outfile, technology='lymask_example_tech')
+        remote_outfile = str(tmp_path / 'remote.lyrdb')
+        batch_drc_main(layout_file, ymlspec=remote_drc_file, outfile=remote_outfile, technology='lymask_example_tech')
+
+        # set_remote_hosts on its own is enough, in a thread that never called set_threads
+        from lymask import library
+        wires = pya.Region()
+        for i in range(20):
+            wires.insert(pya.Box(i * 3000, 0, i * 3000 + 500, 60000))
+        sized = []
+        def remote_sizing():
+            library.set_remote_hosts(address)
+            sized.append(library.fast_sized(wires, 100))
+        thread = threading.Thread(target=remote_sizing)
+        thread.start()
+        thread.join()
+    finally:
+        worker.terminate()
+        worker.wait()
+    assert_equal(remote_outfile, outfile)
+    assert len(sized) == 1
+    assert (sized[0] ^ wires.sized(100)).is_empty()
+
+
+def test_benchmarks():
+    import copy
+    sys.path.insert(0, os.path.dirname(test_dir))
+    from benchmarks.layout_generator import make_layout
+    from benchmarks.run import run_benchmarks, compare
+    layout = make_layout(8, n_pads=2)
+    counts = {layout.get_info(layer_index).name: layout.top_cell().shapes(layer_index).size() for layer_index in layout.layer_indexes()}
+    assert counts['wg_deep'] == 16 and counts['v3'] == 16 and counts['v5'] == 2  # a label with each waveguide
+    assert layout.top_cell().dbbox() == make_layout(8, n_pads=2).top_cell().dbbox()
+
+    benchmark = run_benchmarks(sizes=[2], categories=['drc'])
+    assert 'width' in [entry['step'] for entry in benchmark['results']]
+    assert compare(benchmark, benchmark) == []
+    slow = copy.deepcopy(benchmark)
+    for entry in slow['results']:
+        entry['wall_time'] = 2 * entry['wall_time'] + 1
+    assert len(compare(slow, benchmark)) == len(benchmark['results'])